@@ -0,0 +1,508 @@
+##  bnBenchmark
+############################################################
+## Benchmarks the hot paths of every bnMariTools script
+## against the fake Mari API in fakeMari.py and reports the
+## results as JSON.
+## -------------------
+## Usage (with the Python version Mari ships with):
+##   python bench/bnBenchmark.py --scale full --output results.json
+##   python bench/bnBenchmark.py --baseline results.json
+## --baseline compares against an earlier run and exits with
+## status 1 if any benchmark got slower than --tolerance.
+## --only runs the benchmarks whose name contains the text.
+## --trace switches bnTrace on and adds its totals per benchmark.
+############################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import platform
+import optparse
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchDir)
+sys.path[:0] = [benchDir, repoDir, os.path.join(repoDir, 'misc')]
+
+import fakeMari
+
+## Scene sizes per scale
+SCALES = {
+    'small': {'channels': 50, 'layers': 10, 'patches': 100, 'shaders': 200, 'selectedLayers': 2},
+    'full': {'channels': 1000, 'layers': 10, 'patches': 1000, 'shaders': 5000, 'selectedLayers': 5},
+}
+
+benchmarks = []
+
+
+def benchmark(function):
+    """Registers a benchmark. The function gets the scale settings and a
+    scratch directory, does its setup and returns (run, items)."""
+    benchmarks.append(function)
+    return function
+
+
+class _ConsoleCounter(object):
+    """Swallows console output and counts the lines written"""
+    def __init__(self):
+        self.lines = 0
+
+    def write(self, text):
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+# ------------------------------------------------------------------------------
+# Tool imports, done after the fake API is installed
+# ------------------------------------------------------------------------------
+
+def importTools():
+    fakeMari.install()
+    fakeMari.buildScene(channels=1, layers=1, patches=1)
+    tools = {}
+    stdout = sys.stdout
+    sys.stdout = _ConsoleCounter()
+    try:
+        for name in ('bnChanLayer', 'bnMaskFromSelection', 'bnImgResize', 'bnExportGUI',
+                     'registerCustomShaders', 'bnLayerUtils', 'bnExportTemplate', 'bnExportScheduler',
+                     'bnTrace', 'bnShaderBundle', 'bnExportSparse', 'bnExportDedup', 'bnExportQueue', 'bnExportHistory', 'bnStackProfiler', 'bnTexelDensity', 'bnPatchUtils'):
+            tools[name] = __import__(name)
+    finally:
+        sys.stdout = stdout
+    return tools
+
+
+tools = {}
+
+
+# ------------------------------------------------------------------------------
+# Benchmarks
+# ------------------------------------------------------------------------------
+
+@benchmark
+def treeWalkChanLayer(scale, scratch):
+    """bnChanLayer findSelection searching every channel (layer selected outside the current channel)"""
+    geo = fakeMari.buildScene(channels=scale['channels'], layers=scale['layers'], patches=1, selectedLayers=0)
+    geo.channelList()[-1].layerList()[0].setSelected(True)
+    fakeMari.mari._state['layer'] = geo.channelList()[0].layerList()[0]
+    finder = tools['bnChanLayer'].getSelectedLayer()
+    return finder.findSelection, scale['channels'] * scale['layers']
+
+
+@benchmark
+def treeWalkMaskFromSelection(scale, scratch):
+    """bnMaskFromSelection findLayerSelection searching every channel"""
+    geo = fakeMari.buildScene(channels=scale['channels'], layers=scale['layers'], patches=1, selectedLayers=0)
+    geo.channelList()[-1].layerList()[0].setSelected(True)
+    fakeMari.mari._state['layer'] = geo.channelList()[0].layerList()[0]
+    return tools['bnMaskFromSelection'].findLayerSelection, scale['channels'] * scale['layers']
+
+
+@benchmark
+def selectionMaskFills(scale, scratch):
+    """selectionMask on several layers with half the patches selected"""
+    count = scale['selectedLayers']
+    fakeMari.buildScene(channels=1, layers=count, patches=scale['patches'], size=64,
+                        selectedPatches=scale['patches'] // 2, selectedLayers=count, nested=0)
+    return lambda: tools['bnMaskFromSelection'].selectionMask(False), count * scale['patches']
+
+
+@benchmark
+def resizeImage(scale, scratch):
+    """resizeImage on every patch of a paintable layer"""
+    fakeMari.buildScene(channels=1, layers=1, patches=scale['patches'], size=64,
+                        selectedPatches=scale['patches'], nested=0)
+    return lambda: tools['bnImgResize'].resizeImage(32), scale['patches']
+
+
+def _stackProfile(scale, scratch, warm):
+    """Project of 'channels' channels, every tenth one with a channel layer of the next"""
+    geo = fakeMari.buildScene(channels=scale['channels'], layers=scale['layers'], patches=scale['patches'])
+    channels = geo.channelList()
+    for index in range(0, len(channels) - 1, 10):
+        channels[index].createChannelLayer('ref%d' % index, channels[index + 1])
+    profiler = tools['bnStackProfiler']
+    profiler.cachePath = os.path.join(scratch, 'stackProfiles.json')
+    profiler._cache = None
+    if warm:
+        profiler.profileProject()
+    return profiler.profileProject, scale['channels'] * scale['layers']
+
+
+@benchmark
+def stackProfileCold(scale, scratch):
+    """profileProject of every channel with an empty cache"""
+    return _stackProfile(scale, scratch, False)
+
+
+@benchmark
+def stackProfileWarm(scale, scratch):
+    """profileProject of every channel again, nothing changed"""
+    return _stackProfile(scale, scratch, True)
+
+
+def writeMesh(path, patches):
+    """OBJ with one quad filling each patch's UV tile, world sizes from 10 to 160 units"""
+    with open(path, 'w') as handle:
+        for index in range(patches):
+            size = 10.0 * 2 ** (index % 5)
+            u, v = index % 10, index // 10
+            handle.write('v %f 0 0\nv %f %f 0\nv %f %f 0\nv %f 0 0\n' % (
+                index * 200.0, index * 200.0, size, index * 200.0 + size, size, index * 200.0 + size))
+            handle.write('vt %d %d\nvt %d %d\nvt %d %d\nvt %d %d\n' % (u, v, u, v + 1, u + 1, v + 1, u + 1, v))
+            first = 4 * index + 1
+            handle.write('f %d/%d %d/%d %d/%d %d/%d\n' % (first, first, first + 1, first + 1,
+                                                          first + 2, first + 2, first + 3, first + 3))
+
+
+@benchmark
+def texelDensityResize(scale, scratch):
+    """autoResizeImages on every patch of a 5 layer channel, mesh measured from an OBJ file"""
+    geo = fakeMari.buildScene(channels=1, layers=5, patches=scale['patches'], size=64, nested=0)
+    geo._meshPath = os.path.join(scratch, 'mesh.obj')
+    writeMesh(geo._meshPath, scale['patches'])
+    tools['bnTexelDensity']._areaCache.clear()
+    return (lambda: tools['bnImgResize'].autoResizeImages(20.0), 5 * scale['patches'])
+
+
+@benchmark
+def selectPatchPick(scale, scratch):
+    """Double click on 100 UDIM entries in turn, as selectPatch in the export list"""
+    geo = fakeMari.buildScene(channels=1, layers=1, patches=scale['patches'], selectedPatches=1)
+    udims = [str(patch.udim()) for patch in geo.patchList()][:100]
+
+    def run():
+        for udim in udims:
+            tools['bnExportGUI'].selectPatch(geo.name(), udim)
+    return run, len(udims) * scale['patches']
+
+
+@benchmark
+def selectChannelUdims(scale, scratch):
+    """Selecting the UDIM sets of 10 export entries in turn, each overlapping the last"""
+    geo = fakeMari.buildScene(channels=1, layers=1, patches=scale['patches'])
+    udims = [str(patch.udim()) for patch in geo.patchList()]
+    step = max(scale['patches'] // 20, 1)
+    sets = [udims[index * step:index * step + scale['patches'] // 2] for index in range(10)]
+
+    def run():
+        for udimSet in sets:
+            tools['bnExportGUI'].selectPatches(geo.name(), udimSet)
+    return run, 10 * scale['patches']
+
+
+@benchmark
+def makeChannelLayerMasks(scale, scratch):
+    """makeChannelLayer in mask mode for several layers and source channels"""
+    geo = fakeMari.buildScene(channels=scale['channels'], layers=scale['selectedLayers'], patches=1,
+                              selectedLayers=scale['selectedLayers'], nested=0)
+    sources = geo.channelList()[1:11]
+    return (lambda: tools['bnChanLayer'].makeChannelLayer(sources, 'mask', 0),
+            len(sources) * scale['selectedLayers'])
+
+
+@benchmark
+def flattenAnalysis(scale, scratch):
+    """flattenBypass over every channel"""
+    geo = fakeMari.buildScene(channels=scale['channels'], layers=scale['layers'], patches=1)
+    channels = geo.channelList()
+
+    def run():
+        for channel in channels:
+            tools['bnLayerUtils'].flattenBypass(channel)
+    return run, len(channels)
+
+
+@benchmark
+def exportPlanning(scale, scratch):
+    """Path plan and schedule for 100 channels with every UDIM"""
+    units = [{'object': 'object0', 'channel': 'channel%d' % index, 'res': 4096, 'height': 4096,
+              'depth': 16, 'layers': 10, 'colorspace': 'linear',
+              'udims': [str(1001 + patch) for patch in range(scale['patches'])]} for index in range(100)]
+    model = tools['bnExportScheduler'].CostModel(os.path.join(scratch, 'timings.json'))
+
+    def run():
+        ordered = tools['bnExportScheduler'].schedule(units, model)
+        tools['bnExportTemplate'].PathPlan('%s/$VERSION/$ENTITY_$CHANNEL.$UDIM.tif' % scratch, ordered, 'v001')
+    return run, len(units) * scale['patches']
+
+
+@benchmark
+def exportMaps(scale, scratch):
+    """Full exportMaps loop with verification, 10 channels of every UDIM written as 16px tiffs"""
+    geo = fakeMari.buildScene(channels=10, layers=scale['layers'], patches=scale['patches'], size=16)
+    gui = tools['bnExportGUI']
+    tools['bnExportScheduler'].timingsPath = os.path.join(scratch, 'timings.json')
+    tools['bnExportHistory'].historyPath = os.path.join(scratch, 'history.db')
+    udims = [str(patch.udim()) for patch in geo.patchList()]
+    objDict = {geo.name(): dict((channel.name(), udims) for channel in geo.channelList())}
+    exportPath = os.path.join(scratch, 'export')
+
+    def run():
+        fakeMari.writeFiles = True
+        try:
+            gui.exportMaps(objDict, exportPath, 'tif', gui.defaultTemplate)
+        finally:
+            fakeMari.writeFiles = False
+    return run, 10 * scale['patches']
+
+
+def _utilityExport(scale, scratch, policy):
+    """exportMaps of 10 single layer channels with every UDIM, half the tiles one flat colour"""
+    fakeMari.paintedTiles = 0.5
+    try:
+        geo = fakeMari.buildScene(channels=10, layers=1, patches=scale['patches'], size=16, nested=0)
+        for channel in geo.channelList():
+            channel.layerList()[0].imageSet()
+    finally:
+        fakeMari.paintedTiles = 1.0
+    gui = tools['bnExportGUI']
+    tools['bnExportScheduler'].timingsPath = os.path.join(scratch, 'timings.json')
+    tools['bnExportHistory'].historyPath = os.path.join(scratch, 'history.db')
+    udims = [str(patch.udim()) for patch in geo.patchList()]
+    objDict = {geo.name(): dict((channel.name(), udims) for channel in geo.channelList())}
+    exportPath = os.path.join(scratch, 'export')
+
+    def run():
+        sparse = tools['bnExportSparse']
+        previous, sparse.constantPolicy = sparse.constantPolicy, policy
+        fakeMari.writeFiles = True
+        try:
+            gui.exportMaps(objDict, exportPath, 'tif', gui.defaultTemplate)
+        finally:
+            fakeMari.writeFiles = False
+            sparse.constantPolicy = previous
+    return run, 10 * scale['patches']
+
+
+@benchmark
+def exportUtilityChannels(scale, scratch):
+    """exportMaps of 10 single layer channels, half the tiles constant, constant tile policy off"""
+    return _utilityExport(scale, scratch, 'off')
+
+
+@benchmark
+def exportUtilityChannelsSparse(scale, scratch):
+    """exportMaps of 10 single layer channels, half the tiles constant, constant tiles to the manifest"""
+    return _utilityExport(scale, scratch, 'manifest')
+
+
+@benchmark
+def exportHistoryQueries(scale, scratch):
+    """Every History palette view and the ETA rates over 100 recorded runs of 'channels' units"""
+    historyModule = tools['bnExportHistory']
+    history = historyModule.History(os.path.join(scratch, 'history.db'))
+    for runIndex in range(100):
+        started = time.time() - (100 - runIndex) * 3600
+        units = []
+        for index in range(scale['channels']):
+            unit = {'object': 'object0', 'channel': 'channel%d' % index, 'source': 'channel%d' % index,
+                    'udims': ['1001', '1002'], 'res': 4096, 'height': 4096, 'depth': 16, 'layers': 10,
+                    'signature': 'stack%d' % (runIndex // 50)}
+            seconds = (1.0 + index % 7) * (2.0 if runIndex >= 50 and index % 5 == 0 else 1.0)
+            units.append(historyModule.unitRecord(unit, 2, 0.01, seconds, 'flattened', 2 << 20))
+        history.record({'started': started, 'seconds': 60.0, 'status': 'done', 'exportSeconds': 50.0,
+                        'units': len(units), 'tiles': 2 * len(units), 'bytes': len(units) << 21}, units)
+
+    def run():
+        for view in historyModule.VIEWS:
+            historyModule.viewTable(history, view)
+        history.rates()
+    return run, 100 * scale['channels']
+
+
+def _queueExport(scale, scratch, workers):
+    """Job of 24 flattened channels queued by queueMaps and exported by worker processes"""
+    channels, latency = 24, 0.05
+    geo = fakeMari.buildScene(channels=channels, layers=2, patches=scale['patches'], size=16, nested=0)
+    gui = tools['bnExportGUI']
+    tools['bnExportScheduler'].timingsPath = os.path.join(scratch, 'timings.json')
+    udims = [str(patch.udim()) for patch in geo.patchList()]
+    objDict = {geo.name(): dict((channel.name(), udims) for channel in geo.channelList())}
+    jobPath = gui.queueMaps(objDict, os.path.join(scratch, 'export'), 'tif', gui.defaultTemplate)
+    command = [sys.executable, os.path.join(benchDir, 'bnQueueWorker.py'), jobPath,
+               str(channels), str(scale['patches']), str(latency)]
+
+    def run():
+        processes = [subprocess.Popen(command, stdout=subprocess.PIPE) for worker in range(workers)]
+        for process in processes:
+            process.communicate()
+        counts = tools['bnExportQueue'].JobQueue(jobPath).counts()
+        if counts['done'] != channels:
+            raise RuntimeError('Queue not finished: %s' % counts)
+    return run, channels * scale['patches']
+
+
+@benchmark
+def exportQueue1(scale, scratch):
+    """Queued export of 24 channels (0.05s per export call) with one worker process"""
+    return _queueExport(scale, scratch, 1)
+
+
+@benchmark
+def exportQueue4(scale, scratch):
+    """Queued export of 24 channels (0.05s per export call) with four worker processes"""
+    return _queueExport(scale, scratch, 4)
+
+
+@benchmark
+def shaderScan(scale, scratch):
+    """registerCustomShaders loadLibraries and loadShaders over a generated library"""
+    shaders = registerLibrary(scratch, scale['shaders'])
+    module = tools['registerCustomShaders']
+    module.default_shader_path = os.path.join(scratch, 'NodeLibrary')
+    module.default_lib_path = os.path.join(scratch, 'FunctionLibrary')
+    module.failuresPath = os.path.join(scratch, 'shaderFailures.json')
+    module.failures = None
+
+    def run():
+        module.loadLibraries()
+        module.loadShaders()
+    return run, shaders
+
+
+@benchmark
+def shaderReload(scale, scratch):
+    """registerCustomShaders reloadChanged after editing one node of a loaded library"""
+    shaders = registerLibrary(scratch, scale['shaders'])
+    module = tools['registerCustomShaders']
+    module.default_shader_path = os.path.join(scratch, 'NodeLibrary')
+    module.default_lib_path = os.path.join(scratch, 'FunctionLibrary')
+    module.failuresPath = os.path.join(scratch, 'shaderFailures.json')
+    module.failures = None
+    module.scanned.clear()
+    module.loadLibraries()
+    module.loadShaders()
+    with open(os.path.join(module.default_shader_path, 'Procedural', 'Sub0', 'node0.xml'), 'a') as handle:
+        handle.write('\n')
+    return module.reloadChanged, shaders
+
+
+@benchmark
+def shaderBundle(scale, scratch):
+    """registerCustomShaders loadBundle of the shaderScan library (bundle already in the local cache)"""
+    shaders = registerLibrary(scratch, scale['shaders'])
+    module = tools['registerCustomShaders']
+    module.default_shader_path = os.path.join(scratch, 'NodeLibrary')
+    module.default_lib_path = os.path.join(scratch, 'FunctionLibrary')
+    module.failuresPath = os.path.join(scratch, 'shaderFailures.json')
+    module.failures = None
+    module.shaderCachePath = os.path.join(scratch, 'shaderCache')
+    bundlePath = tools['bnShaderBundle'].buildBundle(scratch)[0]
+    tools['bnShaderBundle'].cachedBundle(bundlePath, module.shaderCachePath)[0].close()
+    return lambda: module.loadBundle(bundlePath), shaders
+
+
+def registerLibrary(root, count):
+    """Writes count node XMLs and count / 10 function library files, returns the file count"""
+    types = ['Procedural', 'Adjustment', 'Geometry']
+    for index in range(count):
+        shaderType = types[index % len(types)]
+        folder = os.path.join(root, 'NodeLibrary', shaderType, 'Sub%d' % (index % 20))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, 'node%d.xml' % index), 'w') as handle:
+            handle.write('<Node>\n <ID>Node%d</ID>\n <DefaultName>Node%d</DefaultName>\n'
+                         ' <Inputs/>\n <Contexts><Context Type="GLSL"><Shader>'
+                         '<Body><![CDATA[ Output = vec4(1.0); ]]></Body></Shader></Context></Contexts>\n</Node>\n'
+                         % (index, index))
+    libFolder = os.path.join(root, 'FunctionLibrary')
+    if not os.path.isdir(libFolder):
+        os.makedirs(libFolder)
+    libraries = max(count // 10, 1)
+    for index in range(libraries):
+        with open(os.path.join(libFolder, 'lib%d.glslh' % index), 'w') as handle:
+            handle.write('vec4 libFunction%d(vec4 value);\n' % index)
+        with open(os.path.join(libFolder, 'lib%d.glslc' % index), 'w') as handle:
+            handle.write('vec4 libFunction%d(vec4 value) { return value; }\n' % index)
+    return count + 2 * libraries
+
+
+# ------------------------------------------------------------------------------
+
+
+def runBenchmark(function, scale):
+    scratch = tempfile.mkdtemp(prefix='bnBenchmark_')
+    stdout = sys.stdout
+    console = _ConsoleCounter()
+    try:
+        sys.stdout = _ConsoleCounter()
+        run, items = function(scale, scratch)
+        fakeMari.resetCounters()
+        tools['bnTrace'].clear()
+        sys.stdout = console
+        start = time.time()
+        run()
+        seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(scratch, ignore_errors=True)
+    result = {
+        'description': function.__doc__,
+        'seconds': round(seconds, 6),
+        'items': items,
+        'itemsPerSecond': round(items / seconds, 1) if seconds else None,
+        'apiCalls': sum(fakeMari.calls.values()),
+        'consoleLines': console.lines,
+        'messages': list(fakeMari.messages),
+    }
+    if tools['bnTrace'].enabled:
+        result['trace'] = dict(tools['bnTrace'].stats())
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Returns the benchmarks slower than baseline by more than tolerance"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get('results', {}).get(name)
+        if before and before['seconds'] and result['seconds'] > before['seconds'] * (1.0 + tolerance):
+            regressions.append({'name': name, 'before': before['seconds'], 'after': result['seconds']})
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--scale', default='small', choices=sorted(SCALES))
+    parser.add_option('--only', default='', help='run benchmarks whose name contains this text')
+    parser.add_option('--output', help='write the JSON report to this file')
+    parser.add_option('--baseline', help='JSON report of an earlier run to compare against')
+    parser.add_option('--tolerance', type='float', default=0.25, help='allowed slowdown, 0.25 = 25%')
+    parser.add_option('--trace', action='store_true', help='enable bnTrace and report its totals')
+    options, args = parser.parse_args(argv)
+
+    tools.update(importTools())
+    if options.trace:
+        tools['bnTrace'].enable()
+    scale = SCALES[options.scale]
+    results = {}
+    for function in benchmarks:
+        if options.only in function.__name__:
+            results[function.__name__] = runBenchmark(function, scale)
+
+    report = {
+        'scale': options.scale,
+        'settings': scale,
+        'python': platform.python_version(),
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results,
+    }
+    if options.baseline:
+        with open(options.baseline) as handle:
+            report['regressions'] = compare(results, json.load(handle), options.tolerance)
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as handle:
+            handle.write(text)
+    sys.stdout.write(text + '\n')
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
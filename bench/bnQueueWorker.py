@@ -0,0 +1,39 @@
+##  bnQueueWorker
+############################################################
+## One bnExportQueue worker process against the fake Mari API,
+## started by the exportQueue benchmarks to stand in for a
+## Mari session.
+## -------------------
+## Usage:
+##   python bench/bnQueueWorker.py <job folder> <channels> <patches> <latency>
+## The scene is built like the benchmark's, latency is the
+## simulated seconds per flattened export call.
+############################################################
+
+import os
+import sys
+
+import bnBenchmark
+import fakeMari
+
+
+def main(argv):
+    jobPath, channels, patches, latency = argv[1], int(argv[2]), int(argv[3]), float(argv[4])
+    stdout = sys.stdout
+    sys.stdout = bnBenchmark._ConsoleCounter()
+    try:
+        tools = bnBenchmark.importTools()
+        fakeMari.buildScene(channels=channels, layers=2, patches=patches, size=16, nested=0)
+        fakeMari.latency['Channel.exportImagesFlattened'] = latency
+        fakeMari.writeFiles = True
+        queue = tools['bnExportQueue']
+        queue.pollInterval = 0.05
+        exported = queue.work(jobPath)
+    finally:
+        sys.stdout = stdout
+    sys.stdout.write('%s exported %d units\n' % (os.getpid(), exported))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
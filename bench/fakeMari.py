@@ -0,0 +1,710 @@
+##  fakeMari
+############################################################
+## Stand-in for the Mari Python API so the bnMariTools scripts
+## can be imported and benchmarked outside Mari.
+## -------------------
+## install() puts the fake 'mari' module (and permissive
+## PySide/PythonQt stubs) into sys.modules and builtins, the
+## same way Mari makes 'mari' available to startup scripts.
+## buildScene() creates objects, channels, layers and patches
+## at a configurable size. Every API call is counted in
+## 'calls', and 'latency' adds a simulated cost per call:
+##     fakeMari.latency['Channel.exportImagesFlattened'] = 0.01
+############################################################
+
+import os
+import sys
+import time
+import types
+import struct
+import functools
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## Call counts per 'Class.method' and simulated latency in seconds
+calls = {}
+latency = {}
+## Messages shown with mari.utils.message
+messages = []
+## Write small but valid image files on export, needed for verification benchmarks
+writeFiles = False
+## Fraction of the tiles of a paintable layer holding painted, not uniform, pixels
+paintedTiles = 1.0
+
+
+def resetCounters():
+    calls.clear()
+    del messages[:]
+
+
+def _api(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        calls[name] = calls.get(name, 0) + 1
+        delay = latency.get(name)
+        if delay:
+            time.sleep(delay)
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def _apiClass(cls):
+    """Counts calls to every public method of cls"""
+    for attr, value in list(vars(cls).items()):
+        if not attr.startswith('_') and isinstance(value, types.FunctionType):
+            setattr(cls, attr, _api('%s.%s' % (cls.__name__, attr), value))
+    return cls
+
+
+class _Signal(object):
+    def __init__(self):
+        self.slots = []
+
+
+# ------------------------------------------------------------------------------
+# Images
+# ------------------------------------------------------------------------------
+
+@_apiClass
+class Color(object):
+    def __init__(self, r=0.0, g=0.0, b=0.0, a=1.0):
+        self._rgba = (r, g, b, a)
+
+    def r(self):
+        return self._rgba[0]
+
+    def g(self):
+        return self._rgba[1]
+
+    def b(self):
+        return self._rgba[2]
+
+    def a(self):
+        return self._rgba[3]
+
+
+@_apiClass
+class Image(object):
+    def __init__(self, size, depth):
+        self._size = size
+        self._depth = depth
+        self._uniform = Color(0.0, 0.0, 0.0, 0.0)
+        self._pixels = None
+        self._painted = False
+
+    def width(self):
+        return self._size
+
+    def height(self):
+        return self._size
+
+    def depth(self):
+        return self._depth
+
+    def fill(self, color):
+        self._uniform = color
+        self._pixels = None
+        self._painted = False
+
+    def resize(self, size):
+        self._size = size
+        self._pixels = None
+
+    def isUniform(self):
+        return self._pixels is None and not self._painted
+
+    def uniformColor(self):
+        return self._uniform
+
+    def getPixel(self, x, y):
+        if self._painted and self._pixels is None:
+            return Color(self._uniform.r() + float(x) / max(self._size - 1, 1),
+                         self._uniform.g(), self._uniform.b(), self._uniform.a())
+        if self._pixels is not None:
+            return Color(*[float(value) for value in self._pixels[y, x]])
+        return self._uniform
+
+    if numpy is not None:
+        def toNumpyArray(self):
+            if self._pixels is None:
+                pixels = numpy.empty((self._size, self._size, 4), dtype=numpy.float32)
+                pixels[:] = [self._uniform.r(), self._uniform.g(), self._uniform.b(), self._uniform.a()]
+                if self._painted:
+                    pixels[..., 0] += numpy.linspace(0.0, 1.0, self._size, dtype=numpy.float32)
+                return pixels
+            return self._pixels.copy()
+
+        def fromNumpyArray(self, pixels):
+            self._pixels = numpy.array(pixels, dtype=numpy.float32)
+            self._size = pixels.shape[1]
+
+
+def _writeTiff(path, size, depth):
+    """Writes an uncompressed single strip RGB TIFF"""
+    bits = min(depth, 16) if depth != 32 else 32
+    data = b'\x00' * (size * size * 3 * bits // 8)
+    entries = [(256, 4, 1, size), (257, 4, 1, size), (258, 3, 1, bits),
+               (273, 4, 1, 8), (279, 4, 1, len(data))]
+    ifd = struct.pack('<H', len(entries))
+    for tag, fieldType, count, value in entries:
+        if fieldType == 3:
+            ifd += struct.pack('<HHIHH', tag, fieldType, count, value, 0)
+        else:
+            ifd += struct.pack('<HHII', tag, fieldType, count, value)
+    ifd += b'\x00' * 4
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as handle:
+        handle.write(b'II' + struct.pack('<HI', 42, 8 + len(data)) + data + ifd)
+
+
+def _export(template, uvIndexList, geo, channelName, size, depth):
+    """size is one size for every tile or a list with one per patch index"""
+    if not writeFiles:
+        return
+    for index in uvIndexList:
+        path = template.replace('$ENTITY', geo).replace('$CHANNEL', channelName).replace('$UDIM', str(1001 + index))
+        _writeTiff(path, size[index] if isinstance(size, list) else size, depth)
+
+
+@_apiClass
+class ImageSet(object):
+    def __init__(self, geo, size, depth):
+        self._geo = geo
+        self._images = [Image(size, depth) for patch in geo._patches]
+        self._owner = ''
+
+    def imageList(self):
+        return list(self._images)
+
+    def exportImages(self, template, options=0, uvIndexList=()):
+        _export(template, uvIndexList, self._geo._name, self._owner,
+                [image.width() for image in self._images], self._images[0].depth())
+
+
+# ------------------------------------------------------------------------------
+# Layers and stacks
+# ------------------------------------------------------------------------------
+
+NORMAL = 0
+
+
+@_apiClass
+class LayerStack(object):
+    def __init__(self, geo, size=1024, depth=8, name=''):
+        self._geo = geo
+        self._layers = []
+        self._size = size
+        self._depth = depth
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def layerList(self):
+        return list(self._layers)
+
+    def _add(self, layer):
+        self._layers.insert(0, layer)
+        return layer
+
+    def createPaintableLayer(self, name, *args):
+        return self._add(Layer(self._geo, name, 'paintable', self._size, self._depth))
+
+    def createProceduralLayer(self, name, type='', *args):
+        return self._add(Layer(self._geo, name, 'procedural'))
+
+    def createAdjustmentLayer(self, name, type='', *args):
+        return self._add(Layer(self._geo, name, 'adjustment'))
+
+    def createChannelLayer(self, name, channel, *args):
+        layer = Layer(self._geo, name, 'channel')
+        layer._channel = channel
+        return self._add(layer)
+
+    def createGroupLayer(self, name, *args):
+        return self._add(GroupLayer(self._geo, name, self._size, self._depth))
+
+    def groupLayers(self, layers, *args):
+        group = GroupLayer(self._geo, 'Group', self._size, self._depth)
+        for layer in layers if isinstance(layers, list) else [layers]:
+            for item in layer if isinstance(layer, list) else [layer]:
+                if item in self._layers:
+                    self._layers.remove(item)
+                group._stack._layers.append(item)
+        return self._add(group)
+
+    def removeLayers(self, layers):
+        for layer in layers:
+            if layer in self._layers:
+                self._layers.remove(layer)
+
+    def currentLayer(self):
+        return self._layers[0] if self._layers else None
+
+
+@_apiClass
+class Layer(object):
+    def __init__(self, geo, name, kind='paintable', size=1024, depth=8):
+        self._geo = geo
+        self._name = name
+        self._kind = kind
+        self._size = size
+        self._depth = depth
+        self._visible = True
+        self._opacity = 1.0
+        self._blend = NORMAL
+        self._selected = False
+        self._imageSet = None
+        self._mask = None
+        self._maskStack = None
+        self._adjustmentStack = None
+        self._channel = None
+
+    def name(self):
+        return self._name
+
+    def setName(self, name):
+        self._name = name
+
+    def isSelected(self):
+        return self._selected
+
+    def setSelected(self, selected):
+        self._selected = selected
+
+    def isVisible(self):
+        return self._visible
+
+    def setVisibility(self, visible):
+        self._visible = visible
+
+    def opacity(self):
+        return self._opacity
+
+    def setOpacity(self, opacity):
+        self._opacity = opacity
+
+    def blendMode(self):
+        return self._blend
+
+    def isPaintableLayer(self):
+        return self._kind == 'paintable'
+
+    def isProceduralLayer(self):
+        return self._kind == 'procedural'
+
+    def isAdjustmentLayer(self):
+        return self._kind == 'adjustment'
+
+    def isChannelLayer(self):
+        return self._kind == 'channel'
+
+    def isGroupLayer(self):
+        return False
+
+    def isShaderLayer(self):
+        return self._kind == 'shader'
+
+    def channel(self):
+        return self._channel
+
+    def imageSet(self):
+        if self._kind != 'paintable':
+            raise AttributeError('%s is not paintable' % self._name)
+        if self._imageSet is None:
+            self._imageSet = ImageSet(self._geo, self._size, self._depth)
+            self._imageSet._owner = self._name
+            images = self._imageSet._images
+            for image in images[:int(round(paintedTiles * len(images)))]:
+                image._painted = True
+        return self._imageSet
+
+    def hasMask(self):
+        return self._mask is not None
+
+    def makeMask(self):
+        self._mask = ImageSet(self._geo, self._size, 8)
+        return self._mask
+
+    def maskImageSet(self):
+        return self._mask
+
+    def hasMaskStack(self):
+        return self._maskStack is not None
+
+    def maskStack(self):
+        return self._maskStack
+
+    def makeMaskStack(self):
+        self._maskStack = LayerStack(self._geo, self._size, 8)
+        if self._mask is not None:
+            layer = self._maskStack.createPaintableLayer('Mask')
+            layer._imageSet = self._mask
+            self._mask = None
+        else:
+            self._maskStack.createPaintableLayer('Mask').imageSet()
+        return self._maskStack
+
+    def hasAdjustmentStack(self):
+        return self._adjustmentStack is not None
+
+    def adjustmentStack(self):
+        return self._adjustmentStack
+
+    def makeAdjustmentStack(self):
+        self._adjustmentStack = LayerStack(self._geo, self._size, self._depth)
+        return self._adjustmentStack
+
+
+@_apiClass
+class GroupLayer(Layer):
+    def __init__(self, geo, name, size=1024, depth=8):
+        Layer.__init__(self, geo, name, 'group', size, depth)
+        self._stack = LayerStack(geo, size, depth)
+
+    def layerStack(self):
+        return self._stack
+
+    def isGroupLayer(self):
+        return True
+
+
+@_apiClass
+class Channel(LayerStack):
+    def __init__(self, geo, name, size=1024, depth=8):
+        LayerStack.__init__(self, geo, size, depth, name)
+
+    def width(self):
+        return self._size
+
+    def height(self):
+        return self._size
+
+    def depth(self):
+        return self._depth
+
+    def isShaderStack(self):
+        return False
+
+    def exportImages(self, template, options=0, uvIndexList=()):
+        _export(template, uvIndexList, self._geo._name, self._name, self._size, self._depth)
+
+    def exportImagesFlattened(self, template, options=0, uvIndexList=()):
+        _export(template, uvIndexList, self._geo._name, self._name, self._size, self._depth)
+
+
+# ------------------------------------------------------------------------------
+# Geometry
+# ------------------------------------------------------------------------------
+
+@_apiClass
+class Patch(object):
+    def __init__(self, index):
+        self._index = index
+        self._selected = False
+
+    def udim(self):
+        return 1001 + self._index
+
+    def uvIndex(self):
+        return self._index
+
+    def isSelected(self):
+        return self._selected
+
+    def setSelected(self, selected):
+        self._selected = selected
+
+
+@_apiClass
+class _GeoVersion(object):
+    def __init__(self, path):
+        self._path = path
+
+    def path(self):
+        return self._path
+
+
+@_apiClass
+class GeoEntity(object):
+    def __init__(self, name, patches):
+        self._name = name
+        self._patches = [Patch(index) for index in range(patches)]
+        self._channels = []
+        self._current = None
+        self._meshPath = None
+
+    def name(self):
+        return self._name
+
+    def currentVersion(self):
+        return _GeoVersion(self._meshPath)
+
+    def patchList(self):
+        return list(self._patches)
+
+    def patch(self, index):
+        return self._patches[index]
+
+    def selectedPatches(self):
+        return [patch for patch in self._patches if patch._selected]
+
+    def patchImage(self, patch, imageSet):
+        return imageSet._images[patch._index]
+
+    def channelList(self):
+        return list(self._channels)
+
+    def currentChannel(self):
+        return self._current
+
+    def setCurrentChannel(self, channel):
+        self._current = channel
+
+    def findChannel(self, name):
+        for channel in self._channels:
+            if channel._name == name:
+                return channel
+        return None
+
+    def createChannel(self, name, width=1024, height=1024, depth=8, *args):
+        channel = Channel(self, name, width, depth)
+        self._channels.append(channel)
+        if self._current is None:
+            self._current = channel
+        return channel
+
+
+# ------------------------------------------------------------------------------
+# Application namespaces
+# ------------------------------------------------------------------------------
+
+class _Namespace(object):
+    pass
+
+
+class _Version(object):
+    def __init__(self, major, minor, number):
+        self._major, self._minor, self._number = major, minor, number
+
+    def major(self):
+        return self._major
+
+    def minor(self):
+        return self._minor
+
+    def number(self):
+        return self._number
+
+
+class _Project(object):
+    def name(self):
+        return 'benchProject'
+
+
+class _Action(object):
+    def __init__(self, name, script):
+        self.name = name
+        self.script = script
+
+    def setIconPath(self, path):
+        pass
+
+    def setShortcut(self, shortcut):
+        pass
+
+    def setEnabled(self, enabled):
+        pass
+
+
+def _module():
+    mari = types.ModuleType('mari')
+    mari.Color = Color
+    mari.Image = Image
+    mari.ImageSet = ImageSet
+    mari.Layer = Layer
+    mari.Layer.NORMAL = NORMAL
+    mari.Channel = Channel
+    mari.GeoEntity = GeoEntity
+
+    state = {'geos': [], 'current': None, 'layer': None, 'project': _Project(),
+             'version': _Version(2, 6, 20603300)}
+
+    app = _Namespace()
+    app.version = lambda: state['version']
+    app.processEvents = _api('app.processEvents', lambda: None)
+    mari.app = app
+
+    utils = _Namespace()
+    utils.message = lambda text, *args: messages.append(text)
+    utils.connect = lambda signal, slot: None
+    mari.utils = utils
+
+    history = _Namespace()
+    history._enabled = [True]
+    history.startMacro = _api('history.startMacro', lambda name: None)
+    history.stopMacro = _api('history.stopMacro', lambda: None)
+    history.isEnabled = lambda: history._enabled[0]
+    history.setEnabled = lambda enabled: history._enabled.__setitem__(0, enabled)
+    mari.history = history
+
+    resources = _Namespace()
+    resources.ICONS = 'ICONS'
+    resources.path = lambda name: '/mari/resources/%s' % name
+    mari.resources = resources
+
+    actions = _Namespace()
+    actions.create = lambda name, script: _Action(name, script)
+    actions.find = lambda path: _Action(path, '')
+    mari.actions = actions
+
+    menus = _Namespace()
+    menus.addAction = lambda *args: None
+    mari.menus = menus
+
+    palettes = _Namespace()
+    palettes.create = lambda name, widget: None
+    mari.palettes = palettes
+
+    projects = _Namespace()
+    projects.current = lambda: state['project']
+    projects.openedProject = _Signal()
+    projects.projectClosed = _Signal()
+    mari.projects = projects
+
+    images = _Namespace()
+    images.supportedWriteFormats = lambda: ['tif', 'exr', 'png', 'tga', 'jpg']
+    mari.images = images
+
+    geo = _Namespace()
+    geo.current = lambda: state['current']
+    geo.find = lambda name: ([entity for entity in state['geos'] if entity._name == name] or [None])[0]
+    geo.list = lambda: list(state['geos'])
+    mari.geo = geo
+
+    current = _Namespace()
+    current.geo = lambda: state['current']
+    current.channel = lambda: state['current'].currentChannel()
+    current.layer = lambda: state['layer']
+    mari.current = current
+
+    gl_render = _Namespace()
+    for name in ('registerCustomHeaderFile', 'registerCustomCodeFile',
+                 'registerCustomProceduralLayerFromXMLFile', 'registerCustomAdjustmentLayerFromXMLFile'):
+        setattr(gl_render, name, _api('gl_render.%s' % name, lambda *args: None))
+    mari.gl_render = gl_render
+
+    mari._state = state
+    return mari
+
+
+# ------------------------------------------------------------------------------
+# Qt stubs, any attribute is a class that accepts anything
+# ------------------------------------------------------------------------------
+
+class _QtMeta(type):
+    def __getattr__(cls, name):
+        return _QtStub
+
+
+class _QtStub(_QtMeta('_QtBase', (object,), {})):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return _QtStub()
+
+    def __call__(self, *args, **kwargs):
+        return _QtStub()
+
+    def __iter__(self):
+        return iter(())
+
+    def __getitem__(self, index):
+        raise IndexError(index)
+
+    def __int__(self):
+        return 0
+
+    __index__ = __int__
+
+    def __nonzero__(self):
+        return False
+
+    __bool__ = __nonzero__
+
+
+class _QtModule(types.ModuleType):
+    def __getattr__(self, name):
+        return _QtStub
+
+
+def _qtPackage(name):
+    package = types.ModuleType(name)
+    package.__path__ = []
+    for submodule in ('QtGui', 'QtCore'):
+        module = _QtModule('%s.%s' % (name, submodule))
+        setattr(package, submodule, module)
+        sys.modules[module.__name__] = module
+    sys.modules[name] = package
+
+
+# ------------------------------------------------------------------------------
+
+
+mari = None
+
+
+def install(version=(2, 6, 20603300)):
+    """Installs the fake mari module and Qt stubs, returns the mari module"""
+    global mari
+    mari = _module()
+    mari._state['version'] = _Version(*version)
+    sys.modules['mari'] = mari
+    builtins.mari = mari
+    for package in ('PySide', 'PythonQt'):
+        _qtPackage(package)
+    resetCounters()
+    return mari
+
+
+def buildScene(objects=1, channels=10, layers=10, patches=100, size=1024, depth=8, nested=0.2,
+               selectedPatches=0, selectedLayers=1):
+    """Creates a scene. layers is the number of layers per channel, a fraction
+    'nested' of them are groups holding a further paintable layer with a mask
+    stack, so tree walks have something to recurse into."""
+    state = mari._state
+    del state['geos'][:]
+    for objectIndex in range(objects):
+        geo = GeoEntity('object%d' % objectIndex, patches)
+        state['geos'].append(geo)
+        for channelIndex in range(channels):
+            channel = geo.createChannel('channel%d' % channelIndex, size, size, depth)
+            groups = int(layers * nested)
+            for layerIndex in range(layers - groups):
+                channel.createPaintableLayer('layer%d' % layerIndex)
+            for groupIndex in range(groups):
+                group = channel.createGroupLayer('group%d' % groupIndex)
+                inner = group.layerStack().createPaintableLayer('inner%d' % groupIndex)
+                inner.makeMaskStack()
+        for patch in geo._patches[:selectedPatches]:
+            patch._selected = True
+    geo = state['geos'][0]
+    state['current'] = geo
+    channel = geo.channelList()[0]
+    geo.setCurrentChannel(channel)
+    selected = channel.layerList()[:selectedLayers]
+    for layer in selected:
+        layer._selected = True
+    state['layer'] = selected[0] if selected else None
+    return geo
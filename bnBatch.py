@@ -0,0 +1,106 @@
+##  bnBatch
+############################################################
+## Undo history control for bulk operations.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+## -------------------
+## Modes:
+##  'full'    - one undo macro for the whole batch (default)
+##  'chunked' - a new macro every chunkSize operations, keeps
+##              each undo step small on very large batches
+##  'fast'    - history recording is switched off for the
+##              batch, nothing can be undone
+############################################################
+
+import time
+import datetime
+
+import mari
+
+import bnLog
+
+BATCH_MODES = ('full', 'chunked', 'fast')
+
+## Defaults, can be changed from the Python console
+defaultMode = 'full'
+chunkSize = 100
+
+## Results of the most recent batches, newest last
+batchHistory = []
+batchHistoryLength = 50
+
+
+# ------------------------------------------------------------------------------
+
+
+def _canDisableHistory():
+    return hasattr(mari.history, 'isEnabled') and hasattr(mari.history, 'setEnabled')
+
+
+class BatchOperation(object):
+    """Context manager wrapping bulk work in undo macros.
+    Call step() once per operation. The open macro is always closed, also
+    when the wrapped code raises. Console output inside the batch is
+    buffered by bnLog and written when the batch ends."""
+
+    def __init__(self, name, mode=None, chunk=None):
+        self.name = name
+        self.mode = mode or defaultMode
+        if self.mode not in BATCH_MODES:
+            raise ValueError('Unknown batch mode: %s' % self.mode)
+        if self.mode == 'fast' and not _canDisableHistory():
+            bnLog.warning('Batch %s: history cannot be disabled in this version of Mari, using full undo', name)
+            self.mode = 'full'
+        self.chunk = chunk or chunkSize
+        self.operations = 0
+        self.macros = 0
+        self.elapsed = 0.0
+        self.failed = False
+        self._macroOpen = False
+        self._historyWasEnabled = True
+        self._startTime = None
+        self._log = bnLog.operation('Batch %s' % name)
+
+    def _startMacro(self):
+        mari.history.startMacro(self.name)
+        self._macroOpen = True
+        self.macros += 1
+
+    def _stopMacro(self):
+        if self._macroOpen:
+            self._macroOpen = False
+            mari.history.stopMacro()
+
+    def __enter__(self):
+        self._startTime = time.time()
+        self._log.__enter__()
+        if self.mode == 'fast':
+            self._historyWasEnabled = mari.history.isEnabled()
+            mari.history.setEnabled(False)
+        else:
+            self._startMacro()
+        return self
+
+    def step(self, count=1):
+        """Records count operations, rolls the macro over in chunked mode
+        once the open one holds chunk operations"""
+        self.operations += count
+        if self.mode == 'chunked' and self.operations >= self.macros * self.chunk:
+            self._stopMacro()
+            self._startMacro()
+
+    def __exit__(self, excType, excValue, traceback):
+        self._stopMacro()
+        if self.mode == 'fast':
+            mari.history.setEnabled(self._historyWasEnabled)
+        self.elapsed = time.time() - self._startTime
+        self.failed = excType is not None
+        batchHistory.append(self)
+        del batchHistory[:-batchHistoryLength]
+        bnLog.info('Batch %s (%s): %d operations, %d undo macros, %s%s',
+            self.name, self.mode, self.operations, self.macros,
+            datetime.timedelta(seconds=self.elapsed), ' (failed)' if self.failed else '')
+        self._log.__exit__(excType, excValue, traceback)
+        return False
@@ -16,6 +16,9 @@
 
 import mari
 import PySide.QtGui as QtGui
+import bnBatch
+import bnLayerUtils
+import bnTrace
 
 USER_ROLE = 32          # PySide.Qt.UserRole
 
@@ -41,8 +44,10 @@ def _isProjectSuitable():
 # ------------------------------------------------------------------------------
 
 
-def makeChannelLayer(sourceChannel, mode, invert):
-    """Creates Channel Layer, channel Layer Mask or channel Layer mask grouped"""
+@bnTrace.traced()
+def makeChannelLayer(sourceChannel, mode, invert, batchMode=None):
+    """Creates Channel Layer, channel Layer Mask or channel Layer mask grouped.
+    batchMode is a bnBatch mode ('full', 'chunked' or 'fast')"""
 
     selectionData = getSelectedLayer().findSelection()
     currentStack = selectionData[2]
@@ -54,11 +59,12 @@ def makeChannelLayer(sourceChannel, mode, invert):
     
 
     if mode == 'layer':
-        mari.history.startMacro('Create channel Layer')
-        for channel in sourceChannel:
-            channelLayerName = channel.name()
-            currentStack.createChannelLayer(channelLayerName, channel, None, 16)
-        mari.history.stopMacro()
+        with bnBatch.BatchOperation('Create channel Layer', batchMode) as batch:
+            for channel in sourceChannel:
+                channelLayerName = channel.name()
+                currentStack.createChannelLayer(channelLayerName, channel, None, 16)
+                batch.step()
+                bnTrace.count(items=1)
 
     else:
         
@@ -71,60 +77,33 @@ def makeChannelLayer(sourceChannel, mode, invert):
                 try:
                     ## New Group Layer
                     layerName = currentLayer.name()
-                    mari.history.startMacro('Create grouped channel mask')
-                    layerGroupName = '%s_grp' % layerName
-                    selectionData = getSelectedLayer().findSelection()
-                    currentStack = selectionData[2]
-                    groupLayer = currentStack.groupLayers([currentSelection], None, None, 16)
-                    groupLayer.setName(layerGroupName)
-                    layerMaskStack = groupLayer.makeMaskStack()
-                    layerMaskStack.removeLayers(layerMaskStack.layerList()) 
-
-                    ## Create Mask Channel Layer
-                    
-                    for channel in sourceChannel:
-                        channelLayerName = channel.name()
-                        maskChannelLayerName = '%s(Shared Channel)' % channelLayerName
-                        layerMaskStack.createChannelLayer(maskChannelLayerName, channel)
-
-                    if invert == 1:
-                       layerMaskStack.createAdjustmentLayer("Invert","Filter/Invert")
-
-                    mari.history.stopMacro()
+                    with bnBatch.BatchOperation('Create grouped channel mask', batchMode) as batch:
+                        layerGroupName = '%s_grp' % layerName
+                        selectionData = getSelectedLayer().findSelection()
+                        currentStack = selectionData[2]
+                        groupLayer = currentStack.groupLayers([currentSelection], None, None, 16)
+                        groupLayer.setName(layerGroupName)
+                        layerMaskStack = groupLayer.makeMaskStack()
+                        layerMaskStack.removeLayers(layerMaskStack.layerList()) 
+
+                        ## Create Mask Channel Layer
+                        bnLayerUtils.addChannelMasks(layerMaskStack, sourceChannel, invert == 1)
+                        batch.step(len(sourceChannel))
+                        bnTrace.count(items=len(sourceChannel))
         
                 except Exception:
                     pass
 
         elif mode == 'mask':
-            mari.history.startMacro('Create channel mask')
-
-            for layer in currentSelection:          
-                
-                layerName = layer.name()
-                currentLayer = layer
-                
-                ## New Layer Mask Stack.
-                ## If mask exists convert, if stack exists keep, else make new stack
-                if currentLayer.hasMaskStack():
-                    layerMaskStack = currentLayer.maskStack()
-                elif currentLayer.hasMask():
-                    layerMaskStack = currentLayer.makeMaskStack()
-                else:
-                    layerMaskStack = currentLayer.makeMaskStack()
-                    layerMaskStack.removeLayers(layerMaskStack.layerList())
-
-                ## Create Mask Channel Layer
-                
-                for channel in sourceChannel:
-
-                    channelLayerName = channel.name()
-                    maskChannelLayerName = '%s(Shared Channel)' % channelLayerName
-                    layerMaskStack.createChannelLayer(maskChannelLayerName, channel)  
+            with bnBatch.BatchOperation('Create channel mask', batchMode) as batch:
 
-                if invert == 1:
-                    layerMaskStack.createAdjustmentLayer("Invert","Filter/Invert")
-
-            mari.history.stopMacro()
+                for layer in currentSelection:          
+                    
+                    ## New Layer Mask Stack and Mask Channel Layer
+                    layerMaskStack = bnLayerUtils.channelMaskStack(layer)
+                    bnLayerUtils.addChannelMasks(layerMaskStack, sourceChannel, invert == 1)
+                    batch.step(len(sourceChannel))
+                    bnTrace.count(items=len(sourceChannel))
     
 
 # ------------------------------------------------------------------------------
@@ -277,6 +256,7 @@ class getSelectedLayer():
         curLayer = None
           
 
+    @bnTrace.traced('findSelection')
     def findSelection(self):
         """Searches for Layer Selection in Substacks and searches for current channel if currentChannel is not the            
         selected one (when a channel is opened as floating or pinned palette)"""
@@ -298,6 +278,7 @@ class getSelectedLayer():
             chn_layerList = curChannel.layerList()
             layerStacks = self.cl_getLayerList(chn_layerList,curChannel,self.cl_returnTrue)
 
+            bnTrace.count(items=len(layerStacks))
             for item in layerStacks:
                 layer = item[1]
                 stack = item[0]   
@@ -313,6 +294,7 @@ class getSelectedLayer():
                 
                 chn_layerList = channel.layerList()
                 layerStacks = self.cl_getLayerList(chn_layerList,channel,self.cl_returnTrue)
+                bnTrace.count(items=len(layerStacks))
             
                 for item in layerStacks:
                     layer = item[1]
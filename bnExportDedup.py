@@ -0,0 +1,174 @@
+##  bnExportDedup
+############################################################
+## Duplicate tile handling for bnExportGUI.
+## Tiles exported from image sets are keyed by content before
+## export and only the first tile of each key is baked, the
+## others become links to it. After verification, files with
+## the same checksum (flattened channels, shared channels) are
+## replaced by links as well.
+## Keys start as a probe of a few pixels; a tile's pixels are
+## only downloaded and hashed once another tile has the same
+## probe. Linked files are unlinked before anything is baked
+## into their paths, so a bake never writes through a link.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+## -------------------
+## Policies:
+##  'off'      - every tile is written (default)
+##  'hardlink' - duplicates are hard links to the first file,
+##               copies where the file system has no links
+##  'symlink'  - duplicates are relative symbolic links
+##  'manifest' - duplicates are not written, duplicate_tiles.json
+##               in the export path names the file to use instead
+## Content keys need NumPy pixel access, except for tiles Mari
+## knows to be one flat colour.
+############################################################
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import bnImageUtils
+import bnLog
+
+POLICIES = ('off', 'hardlink', 'symlink', 'manifest')
+
+## Defaults
+dedupPolicy = 'off'
+manifestName = 'duplicate_tiles.json'
+## Pixels per side of the probe grid read before a tile is hashed
+probeGrid = 4
+
+
+# ------------------------------------------------------------------------------
+
+
+def tileKey(image, depth, colorspace):
+    """Content key of a patch image, None if it can not be read"""
+    color = bnImageUtils.constantColor(image, probe=False)
+    if color is not None:
+        return ('constant', color, image.width(), image.height(), depth, colorspace)
+    if not bnImageUtils.hasPixelAccess(image):
+        return None
+    pixels = bnImageUtils.downloadPixels(image)
+    return (hashlib.sha1(pixels.tobytes()).hexdigest(), pixels.shape, depth, colorspace)
+
+
+def probeKey(image, depth, colorspace):
+    """Cheap key of a patch image: (key, exact). Flat colour tiles get their
+    exact content key, others their size and a grid of probeGrid x probeGrid
+    pixels where Mari can read single pixels. Tiles with different probe keys
+    differ, tiles with the same one still need tileKey."""
+    color = bnImageUtils.constantColor(image, probe=False)
+    width, height = image.width(), image.height()
+    if color is not None:
+        return ('constant', color, width, height, depth, colorspace), True
+    samples = bnImageUtils.sampleGrid(image, probeGrid)
+    return ('probe', samples, width, height, depth, colorspace), False
+
+
+class TileIndex(object):
+    """First output path per content key of an export job"""
+
+    def __init__(self):
+        self.first = {}
+        self.duplicates = {}
+        ## probe key: [[path, image, depth, colorspace, content key or None]]
+        self._probes = {}
+
+    def add(self, key, path):
+        """Returns True if path duplicates a tile added before"""
+        if key is None:
+            return False
+        original = self.first.setdefault(key, path)
+        if original == path:
+            return False
+        self.duplicates[path] = original
+        return True
+
+    def addImage(self, image, depth, colorspace, path):
+        """add() for a patch image. Its pixels are only hashed, together with
+        the tiles added before with the same probe, once the probe repeats."""
+        key, exact = probeKey(image, depth, colorspace)
+        if exact:
+            return self.add(key, path)
+        group = self._probes.setdefault(key, [])
+        for entry in group:
+            if entry[4] is None:
+                entry[4] = tileKey(entry[1], entry[2], entry[3])
+                entry[1] = None
+                self.add(entry[4], entry[0])
+        if not group:
+            group.append([path, image, depth, colorspace, None])
+            return False
+        contentKey = tileKey(image, depth, colorspace)
+        group.append([path, None, depth, colorspace, contentKey])
+        return self.add(contentKey, path)
+
+
+def unshare(paths):
+    """Removes the files at paths that are links or have other hard links, so
+    baking into them writes a new file instead of through to other tiles.
+    Returns the number removed."""
+    removed = 0
+    for path in paths:
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            continue
+        if os.path.islink(path) or stat.st_nlink > 1:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as exc:
+                bnLog.warning('Could not unlink %s before export: %s', path, exc)
+    return removed
+
+
+def fileDuplicates(records, skip=()):
+    """path: first path of the same content, from verification records with checksums"""
+    first = {}
+    duplicates = {}
+    for record in records:
+        if record['status'] != 'ok' or not record.get('checksum') or record['path'] in skip:
+            continue
+        key = (record['checksum'], record['size'])
+        original = first.setdefault(key, record['path'])
+        if original != record['path']:
+            duplicates[record['path']] = original
+    return duplicates
+
+
+def _link(original, path, policy):
+    if os.path.lexists(path):
+        os.remove(path)
+    try:
+        if policy == 'symlink':
+            os.symlink(os.path.relpath(original, os.path.dirname(path)), path)
+        else:
+            os.link(original, path)
+    except (AttributeError, OSError):
+        ## No links on this platform or across these file systems
+        shutil.copyfile(original, path)
+
+
+def emit(duplicates, policy):
+    """Creates the duplicate files as links, returns the number created"""
+    created = 0
+    for path, original in sorted(duplicates.items()):
+        try:
+            _link(original, path, policy)
+            created += 1
+        except (IOError, OSError) as exc:
+            bnLog.warning('Could not link %s to %s: %s', path, original, exc)
+    return created
+
+
+def writeManifest(path, duplicates):
+    """Writes path: original of the duplicate tiles that were not written"""
+    with open(path, 'w') as handle:
+        json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'duplicates': duplicates}, handle)
@@ -11,8 +11,21 @@
 ## Contact: bneall@gmail.com
 ############################################################
 
+import os
 import time
 import datetime
+import bnExportDedup
+import bnExportHistory
+import bnExportQueue
+import bnExportScheduler
+import bnExportSparse
+import bnExportTemplate
+import bnExportVerify
+import bnImageUtils
+import bnLayerUtils
+import bnLog
+import bnPatchUtils
+import bnTrace
 import PythonQt.QtGui as QtGui
 import PythonQt.QtCore as QtCore
 
@@ -22,14 +35,20 @@ imgFormats = mari.images.supportedWriteFormats()
 ## Defaults ##
 defaultFormat = 'tif'
 defaultTemplate = '$ENTITY_$CHANNEL.$UDIM'
+defaultVersion = 'v001'
+verifyExports = True
+verifyRetries = 1
+
+## Console tally per export path
+exportTallies = {'direct': 'channels direct', 'flattened': 'channels flattened', 'layer': 'layers direct'}
 
 def selectPatch(object, udim):
 	'''Selectes patch indicated in GUI'''
-	geo = mari.geo.find(object)
-	for patch in geo.patchList():
-		patch.setSelected(False)
-	patch = geo.patch(int(udim)-1001)
-	patch.setSelected(True)
+	selectPatches(object, [udim])
+
+def selectPatches(object, udims):
+	'''Selects exactly the given patches, only toggling the ones that change'''
+	return bnPatchUtils.selectPatches(mari.geo.find(object), udims)
 
 def sceneData(mode):
 	'''Gets Mari scene data'''
@@ -52,21 +71,230 @@ def sceneData(mode):
 		return resolution
 	
 def report(reportList, path):
-		'''Report log for complete exports'''
-		print '\n---------------Export Report------------------'
-		print 'Export Path: %s\n' % path
+		'''Report log for complete exports, per channel blocks only at bnLog.DETAIL'''
+		bnLog.info('\n---------------Export Report------------------')
+		bnLog.info('Export Path: %s\n', path)
 		for item in reportList:
 			object = item[0]
 			channel = item[1]
 			udims = item[2]
 			time = item[3]
-			print 'Export for: %s:%s' % (object, channel)
-			print '----------------------------------------------'
-			print 'UDIMs exported:\n%s' % [str(udim) for udim in udims]
-			print 'Elapsed Time: %s' % time
-			print '----------------------------------------------\n'
+			decision = item[4]
+			bnLog.detail('Export for: %s:%s', object, channel)
+			bnLog.detail('----------------------------------------------')
+			bnLog.detail('UDIMs exported:\n%s', [str(udim) for udim in udims])
+			bnLog.detail('Export mode: %s', decision)
+			bnLog.detail('Elapsed Time: %s', time)
+			bnLog.detail('----------------------------------------------\n')
+		bnLog.info('%d channels, %d UDIMs exported', len(reportList), sum(len(item[2]) for item in reportList))
+		bnLog.info('----------------------------------------------\n')
 	
-def exportMaps(objDict, path, format, template):
+def exportChunks(exportImages, file_template, uvs, mariChan, cancelled=None):
+	'''Calls exportImages(file_template, 0, chunk) for chunks of uvs capped by
+	bnExportScheduler.memoryCap, so Mari never holds a whole large channel at once.
+	Stops between chunks once cancelled() is True. Returns a note on the chunking for the report.'''
+	chunks = bnExportScheduler.udimChunks(uvs, mariChan.width(), mariChan.height(), mariChan.depth())
+	for index, chunk in enumerate(chunks):
+		exportImages(file_template, 0, chunk)
+		if len(chunks) > 1:
+			mari.app.processEvents()
+			if cancelled is not None and index + 1 < len(chunks) and cancelled():
+				bnLog.tally('memory capped chunks', index + 1)
+				return ', cancelled after %d of %d chunks' % (index + 1, len(chunks))
+	if len(chunks) > 1:
+		bnLog.tally('memory capped chunks', len(chunks))
+		return ', %d chunks' % len(chunks)
+	return ''
+
+@bnTrace.traced()
+def exportChannel(mariChan, file_template, uvs, cancelled=None):
+	'''Exports the given patch indices of a channel, flattening only if needed.
+	Returns the export path taken, 'direct' or 'flattened', and a description of it.'''
+	layer, reason = bnLayerUtils.flattenBypass(mariChan)
+	if layer is not None:
+		chunks = exportChunks(layer.imageSet().exportImages, file_template, uvs, mariChan, cancelled)
+		kind, decision = 'direct', 'direct from layer %s (%s%s)' % (layer.name(), reason, chunks)
+	elif len(mariChan.layerList()) > 1:
+		chunks = exportChunks(mariChan.exportImagesFlattened, file_template, uvs, mariChan, cancelled)
+		kind, decision = 'flattened', 'flattened (%s%s)' % (reason, chunks)
+	else:
+		chunks = exportChunks(mariChan.exportImages, file_template, uvs, mariChan, cancelled)
+		kind, decision = 'direct', 'direct (%s%s)' % (reason, chunks)
+	bnLog.detail('Export %s: %s', mariChan.name(), decision)
+	bnTrace.count(items=len(uvs))
+	return kind, decision
+
+@bnTrace.traced()
+def exportLayer(layer, mask, file_template, uvs, mariChan, cancelled=None):
+	'''Exports the given patch indices of a layer, or its plain mask, straight from its image set.
+	Returns the export path taken, 'layer', and a description of it.'''
+	if mask:
+		chunks = exportChunks(layer.maskImageSet().exportImages, file_template, uvs, mariChan, cancelled)
+		decision = 'direct from mask of %s%s' % (layer.name(), chunks)
+	else:
+		chunks = exportChunks(layer.imageSet().exportImages, file_template, uvs, mariChan, cancelled)
+		decision = 'direct from layer %s%s' % (layer.name(), chunks)
+	bnLog.detail('Export %s: %s', layer.name(), decision)
+	bnTrace.count(items=len(uvs))
+	return 'layer', decision
+
+def exportSource(object, source, file_template, uvs, cancelled=None):
+	'''Exports a channel or a layer given by its bnLayerUtils layer path.
+	cancelled() is checked between memory capped chunks. Returns a description of the export path taken.'''
+	mariChan, layer, mask = bnLayerUtils.resolveLayerPath(mari.geo.find(object), source)
+	if layer is None:
+		kind, decision = exportChannel(mariChan, file_template, uvs, cancelled)
+	else:
+		kind, decision = exportLayer(layer, mask, file_template, uvs, mariChan, cancelled)
+	bnLog.tally(exportTallies[kind])
+	return decision
+
+def sourceImageSet(object, source):
+	'''Returns the image set a channel or layer entry is exported from directly,
+	None if the channel has to be flattened'''
+	mariChan, layer, mask = bnLayerUtils.resolveLayerPath(mari.geo.find(object), source)
+	if layer is None:
+		layer = bnLayerUtils.flattenBypass(mariChan)[0]
+		if layer is None:
+			return None
+	if mask:
+		return layer.maskImageSet()
+	return layer.imageSet()
+
+def patchSizes(object, source, udims):
+	'''{udim: (width, height)} of the tiles exporting a channel or layer writes: the
+	patch image sizes of the image set it is exported from, for flattened channels
+	the largest over their paintable layers, the channel size without any'''
+	mariGeo = mari.geo.find(object)
+	mariChan, layer, mask = bnLayerUtils.resolveLayerPath(mariGeo, source)
+	imageSet = sourceImageSet(object, source)
+	if imageSet is not None:
+		imageSets = [imageSet]
+	else:
+		imageSets = [paintable.imageSet() for path, paintable in bnLayerUtils.layerPaths(mariChan, bnLayerUtils.isPaintable)]
+	patches = bnPatchUtils.patchMap(mariGeo)
+	sizes = {}
+	for udim in udims:
+		patch = patches.get(int(udim))
+		tileSizes = [bnImageUtils.imageSize(mariGeo.patchImage(patch, tileSet)) for tileSet in imageSets] if patch else []
+		sizes[udim] = max(tileSizes) if tileSizes else (mariChan.width(), mariChan.height())
+	return sizes
+
+@bnTrace.traced()
+def verifyMaps(expected, path):
+	'''Verifies exported files, re-exports missing or broken tiles and writes a manifest.
+	Returns the verification records.'''
+	records, failed = bnExportVerify.verifyExport(expected)
+	bnTrace.count(items=len(expected))
+	recordIndex = dict((record['path'], index) for index, record in enumerate(records))
+	for attempt in range(verifyRetries):
+		if not failed:
+			break
+		## Re-queue failed tiles per channel
+		requeue = {}
+		for record in failed:
+			requeue.setdefault((record['object'], record['source'], record['template']), []).append(record['udim'])
+		bnExportDedup.unshare([record['path'] for record in failed])
+		for (object, source, file_template), udims in requeue.items():
+			bnLog.info('Re-exporting %s:%s %s', object, source, udims)
+			exportSource(object, source, file_template, [(int(x)-1001) for x in udims])
+		retried, failed = bnExportVerify.verifyExport(failed)
+		for record in retried:
+			records[recordIndex[record['path']]] = record
+	bnExportVerify.writeManifest(os.path.join(path, bnExportVerify.manifestName), records)
+	return records
+
+def verifyReport(problems):
+	'''Report log for verification'''
+	bnLog.info('\n---------------Verify Report------------------')
+	if not problems:
+		bnLog.info('All exported files verified.')
+	for record in problems:
+		bnLog.warning('%s: %s', record['status'].upper(), record['path'])
+	bnLog.info('----------------------------------------------\n')
+
+def channelColorspace(mariChan):
+	'''Returns the colorspace of a channel, guessed from bit depth where Mari has no colour management'''
+	try:
+		return mariChan.colorspaceConfig().colorspace(mari.ColorspaceConfig.COLORSPACE_STAGE_NATIVE)
+	except Exception:
+		if mariChan.depth() == 32:
+			return 'linear'
+		return 'sRGB'
+
+@bnTrace.traced()
+def exportUnits(objDict):
+	'''Builds export work units from dictionary supplied by GUI.
+	Entries are channel names or layer paths (see bnLayerUtils), raises ValueError for missing ones.'''
+	units = []
+	for object in objDict:
+		mariGeo = mari.geo.find(object)
+		for source in objDict[object]:
+			mariChan, layer, mask = bnLayerUtils.resolveLayerPath(mariGeo, source)
+			units.append({
+				'object': object,
+				'channel': source if layer is None else bnLayerUtils.layerFileName(source),
+				'source': source,
+				'udims': objDict[object][source],
+				'res': mariChan.width(),
+				'height': mariChan.height(),
+				'depth': mariChan.depth(),
+				'colorspace': channelColorspace(mariChan),
+				'layers': len(mariChan.layerList()) if layer is None else 1,
+				'signature': bnLayerUtils.stackSignature(mariChan),
+				})
+			bnTrace.count(items=1)
+	return units
+
+def planPaths(units, path, format, template, version):
+	'''Expands all output paths of a job, returns None and tells the user if the template is unusable'''
+	try:
+		plan = bnExportTemplate.PathPlan('%s/%s.%s' % (path, template, format), units, version)
+	except ValueError as exc:
+		mari.utils.message(str(exc))
+		return None
+	if plan.collisions:
+		collisions = plan.collisionReport()
+		with bnLog.operation('Path plan'):
+			for line in collisions:
+				bnLog.warning('Path collision: %s', line)
+		mari.utils.message('Template produces %d colliding paths, nothing was exported.\n\n%s' %
+			(len(collisions), '\n'.join(collisions[:10])))
+		return None
+	return plan
+
+def previewPaths(objDict, path, format, template, version):
+	'''Prints the output paths of a job without exporting'''
+	try:
+		units = exportUnits(objDict)
+	except ValueError as exc:
+		mari.utils.message(str(exc))
+		return
+	plan = planPaths(units, path, format, template, version)
+	if plan is None:
+		return
+	with bnLog.operation('Export Preview'):
+		bnLog.info('\n---------------Export Preview-----------------')
+		for directory in plan.directories():
+			bnLog.info('Directory: %s', directory)
+		for index in range(len(units)):
+			for filePath in plan.unitPaths(index):
+				bnLog.info(filePath)
+		bnLog.info('----------------------------------------------\n')
+
+def recordHistory(history, run, unitResults, records):
+	'''Adds an export run and its units to the export history, with file sizes from the verify records'''
+	sizes = dict((record['path'], record['size']) for record in records)
+	units = []
+	for unit, paths, baked, detectSeconds, exportSeconds, decision in unitResults:
+		bytes = sum(sizes.get(filePath, 0) for filePath in paths) if records else None
+		units.append(bnExportHistory.unitRecord(unit, baked, detectSeconds, exportSeconds, decision, bytes))
+	run.update(units=len(units), tiles=sum(unit['baked'] for unit in units),
+		bytes=sum(unit['bytes'] for unit in units) if records else None)
+	history.record(run, units)
+
+@bnTrace.traced()
+def exportMaps(objDict, path, format, template, version=defaultVersion):
 	'''Exports maps from dictionary supplied by GUI'''
 	## Missing options
 	if not objDict:
@@ -76,59 +304,223 @@ def exportMaps(objDict, path, format, template):
 		mari.utils.message('No export path set')
 		return
 	
+	## Longest units first, then expand all output paths before baking anything
+	startPlanTime = time.time()
+	costModel = bnExportScheduler.CostModel()
+	history = None
+	if bnExportHistory.recordHistory:
+		history = bnExportHistory.History()
+		costModel.seed(history.rates())
+	try:
+		units = bnExportScheduler.schedule(exportUnits(objDict), costModel)
+	except ValueError as exc:
+		mari.utils.message(str(exc))
+		return
+	plan = planPaths(units, path, format, template, version)
+	if plan is None:
+		return
+	plan.createDirectories()
+	run = {'started': startPlanTime, 'project': mari.projects.current().name(), 'path': path,
+		'format': format, 'version': version, 'planSeconds': time.time() - startPlanTime}
+	unitResults = []
+	
 	## Report data
 	reportList = []
+	expected = []
+	constantRecords = {}
+	written = []
+	tileIndex = bnExportDedup.TileIndex()
+	## Files of templates with tokens only Mari expands ($FRAME...) can not be
+	## found by path, so they are not verified, left out or linked
+	literalPaths = not plan.template.passThrough
+	if not literalPaths:
+		bnLog.info('Template tokens %s are expanded by Mari, files are not verified',
+			', '.join('$' + token for token in plan.template.passThrough))
+	sparse = literalPaths and bnExportSparse.constantPolicy != 'off'
+	dedup = literalPaths and bnExportDedup.dedupPolicy != 'off'
+	verify = literalPaths and verifyExports
 	
 	## Progress maximum
-	maxStep = 0
-	for x in objDict:
-		for i in objDict[x]:
-			maxStep += 1
+	maxStep = len(units)
 	
 	# Progress Dialog
 	progressDiag = ProgressDialog(maxStep)
 	progressDiag.show()
 	
-	progStep = 0
-	startJobTime = time.time()
-	for object in objDict:
-		mariGeo = mari.geo.find(object)
-		for channel in objDict[object]:
-			mariChan = mariGeo.findChannel(channel)
-			udims = objDict[object][channel]
-			uvs = [(int(x)-1001) for x in udims]
-			file_template = '%s/%s.%s' % (path, template, format)
+	def cancel():
+		costModel.save()
+		progressDiag.close()
+		if history is not None:
+			run.update(status='cancelled', seconds=time.time() - startPlanTime,
+				exportSeconds=time.time() - startJobTime)
+			recordHistory(history, run, unitResults, [])
+	
+	## Console output is buffered until the export is done
+	with bnLog.operation('Export'):
+		progStep = 0
+		eta = bnExportScheduler.EtaTracker(units, costModel)
+		startJobTime = time.time()
+		for index, unit in enumerate(units):
+			object = unit['object']
+			channel = unit['channel']
+			udims = unit['udims']
+			file_template = plan.unitTemplate(index)
+			
+			unitPaths = plan.unitPaths(index)
 			
+			## Constant tiles are left to the sparse policy and duplicate tiles
+			## linked after the export, neither is baked
+			startDetectTime = time.time()
+			constants = {}
+			duplicates = set()
+			imageSet = None
+			if sparse or dedup:
+				imageSet = sourceImageSet(object, unit['source'])
+			if imageSet is not None:
+				mariGeo = mari.geo.find(object)
+				if sparse:
+					constants = bnExportSparse.constantTiles(mariGeo, imageSet, udims)
+				if dedup:
+					patches = bnPatchUtils.patchMap(mariGeo)
+					for udim, filePath in zip(udims, unitPaths):
+						if udim in constants:
+							continue
+						image = mariGeo.patchImage(patches[int(udim)], imageSet)
+						if tileIndex.addImage(image, unit['depth'], unit['colorspace'], filePath):
+							duplicates.add(udim)
+			uvs = [(int(x)-1001) for x in udims if x not in constants and x not in duplicates]
+			bakePaths = [filePath for udim, filePath in zip(udims, unitPaths) if udim not in constants and udim not in duplicates]
+		
 			## Progress settings
-			progressDiag.label.setText('Exporting %s\nUDIM Count: %d' % (channel, len(uvs)))
+			progressDiag.label.setText('Exporting %s\nUDIM Count: %d\nTime left: %s' % (channel, len(uvs),
+				datetime.timedelta(seconds=int(eta.eta()))))
 			mari.app.processEvents()
 			if progressDiag.breakBake == True:
-				progressDiag.close()
+				cancel()
 				return
-			
+		
 			## Export
 			startBakeTime = time.time()
-			if len(mariChan.layerList()) > 1:
-				mariChan.exportImagesFlattened(file_template, 0, uvs)
-			else:
-				mariChan.exportImages(file_template, 0, uvs)
+			decision = 'no tiles to bake'
+			if uvs:
+				## Links from an earlier deduplicated export would be written through
+				bnExportDedup.unshare(bakePaths)
+				decision = exportSource(object, unit['source'], file_template, uvs, lambda: progressDiag.breakBake)
+				if progressDiag.breakBake == True:
+					bnLog.info('Export cancelled in %s:%s, %s', object, channel, decision)
+					cancel()
+					return
+			if constants:
+				decision += ', %d constant tiles (%s)' % (len(constants), bnExportSparse.constantPolicy)
+				bnLog.tally('constant tiles', len(constants))
+			if duplicates:
+				decision += ', %d duplicate tiles' % len(duplicates)
+				bnLog.tally('duplicate tiles', len(duplicates))
 			endBakeTime = time.time()
 			elapsedBakeTime = endBakeTime - startBakeTime
+			eta.done(unit, elapsedBakeTime)
+			costModel.record(unit, elapsedBakeTime, len(uvs))
+			unitResults.append((unit, unitPaths, len(uvs), startBakeTime - startDetectTime, elapsedBakeTime, decision))
 			elapsedBakeTime = str(datetime.timedelta(seconds=elapsedBakeTime))
-			
-			## Report
-			reportList.append([object, channel, udims, elapsedBakeTime])
-			
+		
+			## Report, tiles are expected at their patch size, which per patch resizes change
+			reportList.append([object, channel, udims, elapsedBakeTime, decision])
+			sizes = patchSizes(object, unit['source'], udims) if verify or constants else {}
+			for udim, filePath in zip(udims, unitPaths):
+				width, height = sizes.get(udim, (unit['res'], unit['height']))
+				if udim in constants:
+					constantRecords[filePath] = {'object': object, 'channel': channel, 'udim': udim,
+						'color': constants[udim], 'width': width, 'height': height, 'depth': unit['depth']}
+					continue
+				if udim in duplicates and bnExportDedup.dedupPolicy == 'manifest':
+					continue
+				written.append(filePath)
+				expected.append({'path': filePath, 'template': file_template,
+					'object': object, 'channel': channel, 'source': unit['source'], 'udim': udim,
+					'width': width, 'height': height, 'depth': unit['depth']})
+		
 			## Progress step
 			progStep += 1
 			progressDiag.pbar.setValue(progStep)
 		
-	endJobTime = time.time()
-	elapsedJobTime = endJobTime - startJobTime
-	elapsedJobTime = str(datetime.timedelta(seconds=elapsedJobTime))
-	report(reportList, path)
+		costModel.save()
+		run['exportSeconds'] = time.time() - startJobTime
+		startDedupTime = time.time()
+		if constantRecords:
+			stale = bnExportSparse.removeStale(constantRecords)
+			if stale:
+				bnLog.tally('stale constant tile files removed', stale)
+		if sparse and bnExportSparse.constantPolicy == 'manifest':
+			bnExportSparse.writeManifest(os.path.join(path, bnExportSparse.manifestName), constantRecords, written)
+		if bnExportDedup.dedupPolicy == 'manifest':
+			bnExportSparse.removeStale(tileIndex.duplicates)
+			bnExportDedup.writeManifest(os.path.join(path, bnExportDedup.manifestName), tileIndex.duplicates)
+		elif dedup:
+			bnExportDedup.emit(tileIndex.duplicates, bnExportDedup.dedupPolicy)
+		run['dedupSeconds'] = time.time() - startDedupTime
+		endJobTime = time.time()
+		elapsedJobTime = endJobTime - startJobTime
+		elapsedJobTime = str(datetime.timedelta(seconds=elapsedJobTime))
+		report(reportList, path)
+		problems = []
+		records = []
+		if verify:
+			startVerifyTime = time.time()
+			records = verifyMaps(expected, path)
+			problems = [record for record in records if record['status'] != 'ok']
+			verifyReport(problems)
+			run['verifySeconds'] = time.time() - startVerifyTime
+			## Identical files the content keys could not see, e.g. flattened channels
+			if bnExportDedup.dedupPolicy in ('hardlink', 'symlink'):
+				startDedupTime = time.time()
+				linked = bnExportDedup.emit(bnExportDedup.fileDuplicates(records, tileIndex.duplicates),
+					bnExportDedup.dedupPolicy)
+				run['dedupSeconds'] += time.time() - startDedupTime
+				if linked:
+					bnLog.tally('identical files linked', linked)
+		if history is not None:
+			run.update(status='unverified' if problems else 'done', seconds=time.time() - startPlanTime)
+			recordHistory(history, run, unitResults, records)
+	if problems:
+		mari.utils.message('Exporting finished with %d unverified files, see console.\nElapsed time: %s' % (len(problems), elapsedJobTime))
+		return
 	mari.utils.message('Exporting finished.\nElapsed time: %s' % elapsedJobTime)
 	
+@bnTrace.traced()
+def queueMaps(objDict, path, format, template, version=defaultVersion):
+	'''Publishes the export job to a queue folder in the export path for
+	bnExportQueue workers in other Mari sessions'''
+	if not objDict:
+		mari.utils.message('Nothing to export')
+		return
+	elif not path:
+		mari.utils.message('No export path set')
+		return
+	costModel = bnExportScheduler.CostModel()
+	try:
+		units = bnExportScheduler.schedule(exportUnits(objDict), costModel)
+	except ValueError as exc:
+		mari.utils.message(str(exc))
+		return
+	plan = planPaths(units, path, format, template, version)
+	if plan is None:
+		return
+	project = mari.projects.current()
+	if hasattr(project, 'isModified') and project.isModified():
+		mari.utils.message('Save the project before queueing, workers export the saved project.')
+		return
+	if plan.template.passThrough:
+		mari.utils.message('Queued exports are verified file by file, templates with tokens Mari expands (%s) '
+			'can not be queued.' % ', '.join('$' + token for token in plan.template.passThrough))
+		return
+	plan.createDirectories()
+	jobPath = os.path.join(path, bnExportQueue.queueFolder, '%s_%s' % (version, time.strftime('%Y%m%d_%H%M%S')))
+	settings = dict(bnExportQueue.projectSettings(), path=path, format=format, template=template, version=version)
+	bnExportQueue.publish(jobPath, units, plan, costModel, settings)
+	mari.utils.message('Queued %d export units in\n%s\n\nStart workers in other Mari sessions with\n'
+		'bnExportQueue.work(%r)' % (len(units), jobPath, jobPath))
+	return jobPath
+
 class ProgressDialog(QtGui.QDialog):
 	'''progress thing'''
 	def __init__(self, maxStep):
@@ -196,33 +588,54 @@ class ExportQtGui(QtGui.QWidget):
 		self.exportList.setAlternatingRowColors(True)
 	#--# Create Widgets
 		self.addBtn = QtGui.QToolButton(self)
+		self.addLayerBtn = QtGui.QToolButton(self)
+		self.addMaskBtn = QtGui.QToolButton(self)
 		self.removeBtn = QtGui.QToolButton(self)
 		self.clearBtn = QtGui.QToolButton(self)
+		self.selectBtn = QtGui.QToolButton(self)
 		self.browseBtn = QtGui.QPushButton('Browse')
 		self.exportBtn = QtGui.QPushButton('Export')
+		self.previewBtn = QtGui.QPushButton('Preview')
+		self.queueBtn = QtGui.QPushButton('Queue')
 		self.formatCombo = QtGui.QComboBox()
 		self.exportLabel = QtGui.QLabel('Path: ')
 		self.formatLabel = QtGui.QLabel('Format: ')
 		self.templateLabel = QtGui.QLabel('Template: ')
 		self.templateLn = QtGui.QLineEdit(defaultTemplate)
+		self.versionLabel = QtGui.QLabel('Version: ')
+		self.versionLn = QtGui.QLineEdit(defaultVersion)
 		self.exportLn = QtGui.QLineEdit()
 		## Set Icons
 		self.addBtn.setIcon(QtGui.QIcon('%s/Plus.png' % icon_path))
 		self.removeBtn.setIcon(QtGui.QIcon('%s/Minus.png' % icon_path))
 		self.clearBtn.setIcon(QtGui.QIcon('%s/Quit.png' % icon_path))
+		self.addLayerBtn.setText('Layers')
+		self.addLayerBtn.setToolTip('Add selected paintable layers, exported without flattening')
+		self.addMaskBtn.setText('Masks')
+		self.addMaskBtn.setToolTip('Add the masks or mask stack layers of selected layers')
+		self.selectBtn.setText('Select')
+		self.selectBtn.setToolTip('Select the UDIMs of the selected entries in the viewport')
+		self.queueBtn.setToolTip('Publish the export for bnExportQueue workers in other Mari sessions')
 	#--# Populate Layouts
 		layoutH1_wdg.addWidget(self.exportList)
 		layoutH2_wdg.addWidget(self.addBtn)
+		layoutH2_wdg.addWidget(self.addLayerBtn)
+		layoutH2_wdg.addWidget(self.addMaskBtn)
 		layoutH2_wdg.addWidget(self.removeBtn)
 		layoutH2_wdg.addWidget(self.clearBtn)
+		layoutH2_wdg.addWidget(self.selectBtn)
 		layoutH2_wdg.addStretch()
 		layoutH3_wdg.addWidget(self.exportLabel)
 		layoutH3_wdg.addWidget(self.exportLn)
 		layoutH3_wdg.addWidget(self.browseBtn)
 		layoutH4_wdg.addWidget(self.templateLabel)
 		layoutH4_wdg.addWidget(self.templateLn)
+		layoutH4_wdg.addWidget(self.versionLabel)
+		layoutH4_wdg.addWidget(self.versionLn)
 		layoutH4_wdg.addWidget(self.formatLabel)
 		layoutH4_wdg.addWidget(self.formatCombo)
+		layoutH5_wdg.addWidget(self.previewBtn)
+		layoutH5_wdg.addWidget(self.queueBtn)
 		layoutH5_wdg.addWidget(self.exportBtn)
 		## Final 
 		layoutV1_main.addWidget(self.mainGroup)
@@ -235,10 +648,15 @@ class ExportQtGui(QtGui.QWidget):
 		self.deleteKey = QtGui.QShortcut(QtGui.QKeySequence('Delete'), self)
 	#--# Connections
 		self.addBtn.connect("clicked()", self.addUDIM)
+		self.addLayerBtn.connect("clicked()", lambda: self.addLayers(masks=False))
+		self.addMaskBtn.connect("clicked()", lambda: self.addLayers(masks=True))
 		self.removeBtn.connect("clicked()", lambda: self.manageTree(remove=True))
 		self.clearBtn.connect("clicked()", self.clear)
+		self.selectBtn.connect("clicked()", lambda: self.manageTree(pick=True))
 		self.browseBtn.connect("clicked()", self.getExportPath)
 		self.exportBtn.connect("clicked()", self.export)
+		self.previewBtn.connect("clicked()", self.preview)
+		self.queueBtn.connect("clicked()", self.queue)
 		self.deleteKey.connect("activated()", lambda: self.manageTree(remove=True))
 		self.exportList.connect("itemDoubleClicked (QTreeWidgetItem *,int)", lambda: self.manageTree(pick=True))
 	#--# Init
@@ -311,6 +729,49 @@ class ExportQtGui(QtGui.QWidget):
 		parent.insertChildren(0, chan_items)
 		return chanItem
 	
+	def addLayer(self, parent, path):
+		'''Adds a Layer Item, named by its layer path'''
+		## Check for existing
+		for index in range(parent.childCount()):
+			child = parent.child(index)
+			if child.text(0) == path:
+				return child
+		
+		## Create and Build Layer item
+		mariChan = bnLayerUtils.resolveLayerPath(mari.geo.current(), path)[0]
+		resolution = '%sk' % str(mariChan.width())[0]
+		bitDepth = '%sbit' % mariChan.depth()
+		layerItem = QtGui.QTreeWidgetItem([path, '', bitDepth, resolution])
+		layerItem.setTextAlignment(1, 0x0004)
+		layerItem.setTextAlignment(2, 0x0004)
+		layerItem.setIcon(0, QtGui.QIcon('%s/Layer.png' % icon_path))
+		layerItem.setData(0, 32, 'LAYER')
+		parent.insertChildren(0, [layerItem])
+		return layerItem
+	
+	def addLayers(self, masks=False):
+		'''Adds the selected layers (or their masks) with the selected UDIMs.
+		Nothing will be built if no UDIM selected.
+		'''
+		selected_udim = sceneData('udim')
+		## Exit if no UDIM selected
+		if not selected_udim:
+			return
+		
+		paths = bnLayerUtils.selectedLayerPaths(mari.geo.current(), masks)
+		if not paths:
+			mari.utils.message('Select layers with %s first' % ('masks' if masks else 'paintable layers'))
+			return
+		parent = self.addObject()
+		unusable = []
+		for path in paths:
+			try:
+				self.addUDIMItems(self.addLayer(parent, path), selected_udim)
+			except ValueError as exc:
+				unusable.append(str(exc))
+		if unusable:
+			mari.utils.message('Could not add:\n%s' % '\n'.join(unusable))
+	
 	def addUDIM(self):
 		'''Adds UDIM to list. Note: chain trigger, this function builds everything,
 		Nothing will be built if no UDIM selected.
@@ -320,7 +781,10 @@ class ExportQtGui(QtGui.QWidget):
 		if not selected_udim:
 			return
 		
-		parent = self.addChannel()
+		self.addUDIMItems(self.addChannel(), selected_udim)
+	
+	def addUDIMItems(self, parent, selected_udim):
+		'''Adds UDIM items to a channel or layer item'''
 		exists_udim = []
 		add_udim = []
 		udim_items = []
@@ -373,19 +837,26 @@ class ExportQtGui(QtGui.QWidget):
 	def manageTree(self, remove=False, pick=False):
 		treeWidget=self.exportList
 		selectedItems = treeWidget.selectedItems()
+		## Picked UDIMs per object, selected in one go at the end
+		pickedUdims = {}
 		
 		for item in selectedItems:
 			#Objects
 			if item.data(0,32) == 'OBJECT':
 				objectIndex = treeWidget.indexOfTopLevelItem(item)
 				objectName = item.text(0)
+				if pick:
+					for channelIndex in range(item.childCount()):
+						pickedUdims.setdefault(objectName, set()).update(self.itemUdims(item.child(channelIndex)))
 				if remove:
 					treeWidget.takeTopLevelItem(objectIndex)
-			#Channels
-			elif item.data(0,32) == 'CHANNEL':
+			#Channels and Layers
+			elif item.data(0,32) in ('CHANNEL', 'LAYER'):
 				objectItem = item.parent()
 				channelIndex = objectItem.indexOfChild(item)
 				channelName = item.text(0)
+				if pick:
+					pickedUdims.setdefault(objectItem.text(0), set()).update(self.itemUdims(item))
 				if remove:
 					objectItem.takeChild(channelIndex)
 			#UDIMs
@@ -398,9 +869,15 @@ class ExportQtGui(QtGui.QWidget):
 				if remove:
 					channelItem.takeChild(udimIndex)
 				if pick:
-					selectPatch(objectName, udimName)
+					pickedUdims.setdefault(objectName, set()).add(udimName)
+		for objectName, udims in pickedUdims.items():
+			selectPatches(objectName, udims)
 		if remove:
 			self.resize()
+	
+	def itemUdims(self, channelItem):
+		'''UDIM names under a channel or layer item'''
+		return [channelItem.child(index).text(0) for index in range(channelItem.childCount())]
 		
 	def getExportDict(self):
 		treeWidget=self.exportList
@@ -411,7 +888,7 @@ class ExportQtGui(QtGui.QWidget):
 			object = treeWidget.topLevelItem(objIndex)
 			objectName = object.text(0)
 			channelDict = {}
-			##Channel ITEMS
+			##Channel and Layer ITEMS
 			for chanIndex in range(object.childCount()):
 				channel = object.child(chanIndex)
 				channelName = channel.text(0)
@@ -434,9 +911,59 @@ class ExportQtGui(QtGui.QWidget):
 		#Export
 		objDict = self.getExportDict()
 		template = self.templateLn.text
+		version = self.versionLn.text
 		export_path = self.exportLn.text
 		export_format = self.formatCombo.currentText
-		exportMaps(objDict, export_path, export_format, template)
+		exportMaps(objDict, export_path, export_format, template, version)
+	
+	def preview(self):
+		#Print output paths
+		objDict = self.getExportDict()
+		previewPaths(objDict, self.exportLn.text, self.formatCombo.currentText, self.templateLn.text, self.versionLn.text)
+	
+	def queue(self):
+		#Publish for export workers
+		objDict = self.getExportDict()
+		queueMaps(objDict, self.exportLn.text, self.formatCombo.currentText, self.templateLn.text, self.versionLn.text)
+
+
+class HistoryQtGui(QtGui.QWidget):
+	'''Export history palette'''
+	def __init__(self):
+		super(HistoryQtGui, self).__init__()
+		self.history = bnExportHistory.History()
+	#--# Create Layouts
+		layoutV1_main = QtGui.QVBoxLayout()
+		layoutH1_wdg = QtGui.QHBoxLayout()
+		self.setLayout(layoutV1_main)
+	#--# Create Widgets
+		self.viewCombo = QtGui.QComboBox()
+		self.refreshBtn = QtGui.QPushButton('Refresh')
+		self.historyList = QtGui.QTreeWidget()
+		self.historyList.setRootIsDecorated(False)
+		self.historyList.setSortingEnabled(True)
+		self.historyList.setAlternatingRowColors(True)
+		self.viewCombo.addItems(list(bnExportHistory.VIEWS))
+	#--# Populate Layouts
+		layoutH1_wdg.addWidget(self.viewCombo)
+		layoutH1_wdg.addWidget(self.refreshBtn)
+		layoutV1_main.addLayout(layoutH1_wdg)
+		layoutV1_main.addWidget(self.historyList)
+	#--# Connections
+		self.viewCombo.connect("currentIndexChanged(int)", self.refresh)
+		self.refreshBtn.connect("clicked()", self.refresh)
+		self.refresh()
+	
+	def refresh(self):
+		'''Fills the list with the selected query'''
+		headerTitles, rows = bnExportHistory.viewTable(self.history, self.viewCombo.currentText)
+		self.historyList.clear()
+		self.historyList.setColumnCount(len(headerTitles))
+		self.historyList.setHeaderLabels(list(headerTitles))
+		for row in rows:
+			QtGui.QTreeWidgetItem(self.historyList, list(row))
+		for column in range(len(headerTitles)):
+			self.historyList.resizeColumnToContents(column)
 
 
 ##-------------------------------------------------------------------------------------------------
@@ -447,6 +974,8 @@ exportUI.setDisabled(True)
 mari.palettes.create('bnExporter', exportUI)
 exportPalette = mari.actions.find('/Mari/Palettes/bnExporter')
 exportPalette.setIconPath('%s/ExportFile.png' % icon_path)
+historyUI = HistoryQtGui()
+mari.palettes.create('bnExportHistory', historyUI)
 
 def toggleUI():
 	if mari.projects.current():
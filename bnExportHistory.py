@@ -0,0 +1,245 @@
+##  bnExportHistory
+############################################################
+## Export history for bnExportGUI.
+## Every export run and its units (object, channel, UDIMs,
+## format, bytes, timings, layer stack signature) are kept in
+## a local SQLite database, so runs can be compared long after
+## the console is gone. The recent timings per channel drive
+## the export ETA, the exporter's History palette shows the
+## queries below.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.5+
+############################################################
+
+import os
+import json
+import time
+import socket
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import mari
+except ImportError:
+    mari = None
+
+import bnExportScheduler
+import bnLog
+
+## Defaults
+historyPath = os.path.join(os.path.expanduser('~'), '.bnMariTools', 'exportHistory.db')
+recordHistory = True
+rateRuns = 5                # recent runs per channel the ETA rate is the median of
+regressionFactor = 1.5      # slowdown after a layer stack change reported as a regression
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL, seconds REAL, status TEXT,
+    host TEXT, mariVersion TEXT, project TEXT,
+    path TEXT, format TEXT, version TEXT,
+    units INTEGER, tiles INTEGER, bytes INTEGER,
+    planSeconds REAL, exportSeconds REAL, verifySeconds REAL, dedupSeconds REAL
+);
+CREATE TABLE IF NOT EXISTS units (
+    run INTEGER REFERENCES runs(id),
+    object TEXT, channel TEXT, source TEXT, udims TEXT,
+    tiles INTEGER, baked INTEGER,
+    width INTEGER, height INTEGER, depth INTEGER, layers INTEGER,
+    signature TEXT, work REAL, bytes INTEGER,
+    detectSeconds REAL, exportSeconds REAL, decision TEXT
+);
+CREATE INDEX IF NOT EXISTS unitsChannel ON units (object, channel);
+CREATE INDEX IF NOT EXISTS runsStarted ON runs (started);
+'''
+
+_ERRORS = (IOError, OSError) + ((sqlite3.Error,) if sqlite3 else ())
+
+RUN_FIELDS = ('started', 'seconds', 'status', 'host', 'mariVersion', 'project', 'path', 'format', 'version',
+              'units', 'tiles', 'bytes', 'planSeconds', 'exportSeconds', 'verifySeconds', 'dedupSeconds')
+UNIT_FIELDS = ('object', 'channel', 'source', 'udims', 'tiles', 'baked', 'width', 'height', 'depth', 'layers',
+               'signature', 'work', 'bytes', 'detectSeconds', 'exportSeconds', 'decision')
+
+
+# ------------------------------------------------------------------------------
+
+
+def mariVersion():
+    try:
+        version = mari.app.version()
+        return '%d.%d (%d)' % (version.major(), version.minor(), version.number())
+    except Exception:
+        return None
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class History(object):
+    """Export runs in a SQLite database. Recording never breaks an export:
+    database errors are logged and the call returns None."""
+
+    def __init__(self, path=None):
+        self.path = path or historyPath
+        self._connection = None
+
+    def connect(self):
+        if self._connection is None:
+            if sqlite3 is None:
+                raise IOError('No sqlite3 module in this Python')
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._connection = sqlite3.connect(self.path, timeout=10)
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _query(self, sql, args=()):
+        try:
+            return self.connect().execute(sql, args).fetchall()
+        except _ERRORS as exc:
+            bnLog.warning('Could not read export history: %s', exc)
+            return []
+
+    # --------------------------------------------------------------------------
+
+    def record(self, run, units):
+        """Adds a run dict (RUN_FIELDS) and its unit dicts (UNIT_FIELDS) in one
+        transaction. Returns the run id."""
+        run = dict(run, host=run.get('host') or socket.gethostname(),
+                   mariVersion=run.get('mariVersion') or mariVersion())
+        try:
+            connection = self.connect()
+            with connection:
+                cursor = connection.execute('INSERT INTO runs (%s) VALUES (%s)' % (
+                    ', '.join(RUN_FIELDS), ', '.join('?' * len(RUN_FIELDS))),
+                    [run.get(field) for field in RUN_FIELDS])
+                runId = cursor.lastrowid
+                connection.executemany('INSERT INTO units (run, %s) VALUES (?, %s)' % (
+                    ', '.join(UNIT_FIELDS), ', '.join('?' * len(UNIT_FIELDS))),
+                    [[runId] + [unit.get(field) for field in UNIT_FIELDS] for unit in units])
+            return runId
+        except _ERRORS as exc:
+            bnLog.warning('Could not record export history: %s', exc)
+            return None
+
+    # --------------------------------------------------------------------------
+
+    def runs(self, limit=20):
+        """Recent runs, newest first: (id, started, seconds, status, project, units, tiles, bytes)"""
+        return self._query('SELECT id, started, seconds, status, project, units, tiles, bytes FROM runs '
+                           'ORDER BY started DESC LIMIT ?', (limit,))
+
+    def slowestChannels(self, limit=10, days=30):
+        """Channels by mean export seconds over the last days:
+        (object, channel, exports, mean seconds, mean seconds per baked tile)"""
+        since = time.time() - days * 86400
+        return self._query(
+            'SELECT u.object, u.channel, COUNT(*), AVG(u.exportSeconds), '
+            'SUM(u.exportSeconds) / MAX(SUM(u.baked), 1) '
+            'FROM units u JOIN runs r ON u.run = r.id WHERE r.started >= ? '
+            'GROUP BY u.object, u.channel ORDER BY AVG(u.exportSeconds) DESC LIMIT ?', (since, limit))
+
+    def throughput(self, days=30):
+        """Export throughput per day: (day, runs, tiles, megabytes, megabytes per export second)"""
+        since = time.time() - days * 86400
+        return self._query(
+            "SELECT date(started, 'unixepoch', 'localtime') AS day, COUNT(*), SUM(tiles), "
+            'SUM(bytes) / 1e6, SUM(bytes) / 1e6 / MAX(SUM(exportSeconds), 0.001) '
+            'FROM runs WHERE started >= ? GROUP BY day ORDER BY day', (since,))
+
+    def _channelRates(self):
+        """object, channel: [(started, signature, seconds per unit of work)], oldest first.
+        Only the work of the baked tiles counts, skipped constant and duplicate
+        tiles cost no export time."""
+        rates = {}
+        for object, channel, started, signature, rate in self._query(
+                'SELECT u.object, u.channel, r.started, u.signature, u.exportSeconds * u.tiles / (u.work * u.baked) '
+                'FROM units u JOIN runs r ON u.run = r.id WHERE u.work > 0 AND u.baked > 0 AND u.tiles > 0 '
+                'ORDER BY r.started'):
+            rates.setdefault((object, channel), []).append((started, signature, rate))
+        return rates
+
+    def regressions(self, factor=None):
+        """Channels whose export rate got slower by factor after their layer
+        stack changed: (object, channel, changed at, rate before, rate after)"""
+        factor = factor or regressionFactor
+        found = []
+        for (object, channel), history in sorted(self._channelRates().items()):
+            latest = history[-1][1]
+            before = [rate for started, signature, rate in history if signature != latest]
+            after = [(started, rate) for started, signature, rate in history if signature == latest]
+            if not before or not after:
+                continue
+            rateBefore = _median(before[-rateRuns:])
+            rateAfter = _median([rate for started, rate in after[-rateRuns:]])
+            if rateAfter > rateBefore * factor:
+                found.append((object, channel, after[0][0], rateBefore, rateAfter))
+        return sorted(found, key=lambda row: row[4] / max(row[3], 1e-9), reverse=True)
+
+    def rates(self):
+        """unitKey: median seconds per unit of work of the last rateRuns exports
+        of that channel, for bnExportScheduler.CostModel"""
+        return dict((bnExportScheduler.unitKey({'object': object, 'channel': channel}),
+                     _median([rate for started, signature, rate in history[-rateRuns:]]))
+                    for (object, channel), history in self._channelRates().items())
+
+
+def unitRecord(unit, baked, detectSeconds, exportSeconds, decision, bytes=None):
+    """History row of an exported work unit"""
+    return {
+        'object': unit['object'], 'channel': unit['channel'], 'source': unit['source'],
+        'udims': json.dumps(unit['udims']), 'tiles': len(unit['udims']), 'baked': baked,
+        'width': unit['res'], 'height': unit['height'], 'depth': unit['depth'], 'layers': unit['layers'],
+        'signature': unit.get('signature'), 'work': bnExportScheduler.unitWork(unit),
+        'bytes': bytes, 'detectSeconds': detectSeconds, 'exportSeconds': exportSeconds, 'decision': decision,
+    }
+
+
+# ------------------------------------------------------------------------------
+
+
+def _duration(seconds):
+    return '%.1fs' % (seconds or 0.0)
+
+
+def _date(started):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(started))
+
+
+VIEWS = ('Slowest Channels', 'Throughput', 'Regressions', 'Recent Runs')
+
+
+def viewTable(history, view):
+    """(column titles, rows of text) of one of VIEWS, for the History palette"""
+    if view == 'Slowest Channels':
+        return (('Object', 'Channel', 'Exports', 'Mean Time', 'Per Tile'),
+                [(object, channel, str(count), _duration(mean), '%.3fs' % perTile)
+                 for object, channel, count, mean, perTile in history.slowestChannels()])
+    if view == 'Throughput':
+        return (('Day', 'Runs', 'Tiles', 'MB', 'MB/s'),
+                [(day, str(runs), str(tiles or 0), '%.1f' % (megabytes or 0), '%.2f' % (rate or 0))
+                 for day, runs, tiles, megabytes, rate in history.throughput()])
+    if view == 'Regressions':
+        return (('Object', 'Channel', 'Stack Changed', 'Slowdown'),
+                [(object, channel, _date(changed), '%.1fx' % (after / max(before, 1e-9)))
+                 for object, channel, changed, before, after in history.regressions()])
+    return (('Started', 'Status', 'Project', 'Units', 'Tiles', 'MB', 'Time'),
+            [(_date(started), status or '', project or '', str(units or 0), str(tiles or 0),
+              '%.1f' % ((bytes or 0) / 1e6), _duration(seconds))
+             for runId, started, seconds, status, project, units, tiles, bytes in history.runs()])
@@ -0,0 +1,403 @@
+##  bnExportQueue
+############################################################
+## Shared job queue for bnExportGUI, so several Mari sessions
+## (headless or not, on one or many machines) export one job.
+## "Queue" in the exporter publishes the work units into a job
+## folder next to the maps, workers claim units with leases,
+## export and verify them and mark them done.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+## -------------------
+## Worker (in any Mari session with the project open):
+##   import bnExportQueue
+##   bnExportQueue.work('<export path>/.bnQueue/<job>')
+## Workers refuse jobs published from another project. A unit
+## whose lease was recovered while it exported is left to the
+## queue, the late worker does not mark it done or failed.
+## -------------------
+## Layout of a job folder:
+##   job.json   - job settings
+##   pending/   - units waiting, longest first by name
+##   leased/    - units being exported, the file mtime is the
+##                lease heartbeat
+##   done/      - units exported, with their verify records
+##   failed/    - units that failed maxAttempts times
+## Claims and state changes are file renames, which are atomic
+## on local and network file systems (SQLite locking is not
+## reliable on NFS/SMB shares). A lease that is not renewed
+## for its unit's lease time is recovered into pending; since
+## exports are idempotent, a late worker at worst writes the
+## same files twice.
+############################################################
+
+import os
+import json
+import time
+import socket
+import threading
+
+try:
+    import mari
+except ImportError:
+    mari = None
+
+import bnExportDedup
+import bnExportVerify
+import bnLog
+
+STATES = ('pending', 'leased', 'done', 'failed')
+
+## Defaults
+queueFolder = '.bnQueue'
+minLease = 60.0          # seconds a claimed unit is leased for at least
+leaseFactor = 3.0        # lease time as a multiple of the unit's estimated export time
+maxAttempts = 3          # exports of a unit before it is moved to failed
+pollInterval = 2.0       # seconds an idle worker waits for leased units to finish or go stale
+
+
+# ------------------------------------------------------------------------------
+
+
+def workerName():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _writeJson(path, data):
+    """Writes through a temporary file and a rename, so readers never see half a file"""
+    temporary = '%s.%s.tmp' % (path, workerName().replace(':', '_'))
+    with open(temporary, 'w') as handle:
+        json.dump(data, handle)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary, path)
+
+
+def _readJson(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def projectSettings():
+    """Job settings identifying the open project"""
+    project = mari.projects.current() if mari is not None else None
+    if project is None:
+        return {'project': None, 'projectUuid': None}
+    return {'project': project.name(), 'projectUuid': project.uuid() if hasattr(project, 'uuid') else None}
+
+
+def projectMismatch(settings):
+    """Why the open project is not the one a job was published from, None if it is"""
+    current = projectSettings()
+    for key in ('project', 'projectUuid'):
+        if settings.get(key) and current[key] and settings[key] != current[key]:
+            return 'job is for %s %s, the open project has %s' % (key, settings[key], current[key])
+    if settings.get('project') and not current['project']:
+        return 'job is for project %s, no project is open' % settings['project']
+    return None
+
+
+class JobQueue(object):
+    """Work units of one export job in a job folder"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def folder(self, state):
+        return os.path.join(self.path, state)
+
+    def unitPath(self, state, name):
+        return os.path.join(self.path, state, name)
+
+    def names(self, state):
+        try:
+            return sorted(name for name in os.listdir(self.folder(state)) if name.endswith('.json'))
+        except OSError:
+            return []
+
+    def settings(self):
+        return _readJson(os.path.join(self.path, 'job.json'))
+
+    def counts(self):
+        return dict((state, len(self.names(state))) for state in STATES)
+
+    def finished(self):
+        """True once no unit is pending or leased"""
+        return not self.names('pending') and not self.names('leased')
+
+    def now(self):
+        """Current time of the file server, so lease ages do not depend on
+        the clocks of the worker machines"""
+        clock = os.path.join(self.path, 'clock')
+        try:
+            with open(clock, 'a'):
+                os.utime(clock, None)
+            return os.path.getmtime(clock)
+        except (IOError, OSError):
+            return time.time()
+
+    # --------------------------------------------------------------------------
+
+    def publish(self, units, settings=None):
+        """Writes the job settings and one pending file per unit, in the given order"""
+        for state in STATES:
+            if not os.path.isdir(self.folder(state)):
+                os.makedirs(self.folder(state))
+        _writeJson(os.path.join(self.path, 'job.json'), dict(settings or {}, units=len(units),
+            created=time.strftime('%Y-%m-%d %H:%M:%S'), publisher=workerName()))
+        for index, unit in enumerate(units):
+            _writeJson(self.unitPath('pending', '%05d.json' % index), dict(unit, attempts=0))
+
+    def claim(self):
+        """Leases the first pending unit nobody else got to. Returns (name, unit) or None.
+        The unit is stamped with a claim id, see owns()."""
+        for name in self.names('pending'):
+            pending = self.unitPath('pending', name)
+            leased = self.unitPath('leased', name)
+            try:
+                ## Touched before the rename, so the lease starts fresh
+                os.utime(pending, None)
+                os.rename(pending, leased)
+            except OSError:
+                continue
+            try:
+                unit = dict(_readJson(leased), claim='%s:%.6f' % (workerName(), time.time()))
+                _writeJson(leased, unit)
+                return name, unit
+            except (IOError, OSError, ValueError):
+                continue
+        return None
+
+    def owns(self, name, unit):
+        """True while the lease of a claimed unit was not recovered and claimed again"""
+        try:
+            return _readJson(self.unitPath('leased', name)).get('claim') == unit.get('claim')
+        except (IOError, OSError, ValueError):
+            return False
+
+    def renew(self, name):
+        """Heartbeat of a lease, False if it was recovered by another worker"""
+        try:
+            os.utime(self.unitPath('leased', name), None)
+            return True
+        except OSError:
+            return False
+
+    def complete(self, name, unit, result):
+        _writeJson(self.unitPath('done', name), dict(unit, result=result))
+        self._release(name)
+
+    def fail(self, name, unit, error):
+        """Puts a unit back into pending, or into failed after maxAttempts"""
+        unit = dict(unit, attempts=unit.get('attempts', 0) + 1, error=error)
+        state = 'failed' if unit['attempts'] >= maxAttempts else 'pending'
+        _writeJson(self.unitPath(state, name), unit)
+        self._release(name)
+        return state
+
+    def _release(self, name):
+        try:
+            os.remove(self.unitPath('leased', name))
+        except OSError:
+            pass
+
+    def recover(self):
+        """Moves leases that were not renewed in time back to pending. Returns their names."""
+        now = self.now()
+        recovered = []
+        for name in self.names('leased'):
+            leased = self.unitPath('leased', name)
+            try:
+                age = now - os.path.getmtime(leased)
+                if age <= _readJson(leased).get('lease', minLease):
+                    continue
+                os.rename(leased, self.unitPath('pending', name))
+            except (IOError, OSError, ValueError):
+                continue
+            recovered.append(name)
+        return recovered
+
+    # --------------------------------------------------------------------------
+
+    def records(self):
+        """Verify records of every finished unit"""
+        records = []
+        for name in self.names('done'):
+            try:
+                records.extend(_readJson(self.unitPath('done', name))['result']['records'])
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        return records
+
+    def claimCollect(self):
+        """True for the one worker that gets to collect a finished job"""
+        try:
+            os.close(os.open(os.path.join(self.path, 'collected'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError:
+            return False
+
+    def collect(self):
+        """Writes the export manifest of the whole job. Returns the records that are not ok."""
+        records = self.records()
+        exportPath = self.settings().get('path')
+        if exportPath:
+            manifest = os.path.join(exportPath, bnExportVerify.manifestName)
+            temporary = '%s.%s.tmp' % (manifest, workerName().replace(':', '_'))
+            bnExportVerify.writeManifest(temporary, records)
+            if os.name == 'nt' and os.path.exists(manifest):
+                os.remove(manifest)
+            os.rename(temporary, manifest)
+        return [record for record in records if record['status'] != 'ok']
+
+
+class _Heartbeat(threading.Thread):
+    """Renews a lease while the unit exports"""
+
+    def __init__(self, queue, name, lease):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.unitName = name
+        self.interval = max(lease / 3.0, 0.1)
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            if not self.queue.renew(self.unitName):
+                self.lost = True
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+# ------------------------------------------------------------------------------
+
+
+def publish(jobPath, units, plan, model, settings=None):
+    """Publishes the scheduled units of an export job with their output paths
+    and lease times. Returns the JobQueue."""
+    queue = JobQueue(jobPath)
+    published = []
+    for index, unit in enumerate(units):
+        published.append(dict(unit,
+            template=plan.unitTemplate(index),
+            paths=plan.unitPaths(index),
+            lease=max(minLease, model.estimate(unit) * leaseFactor)))
+    queue.publish(published, settings)
+    return queue
+
+
+def _exportSource(object, source, file_template, uvs):
+    import bnExportGUI
+    return bnExportGUI.exportSource(object, source, file_template, uvs)
+
+
+def _patchSizes(object, source, udims):
+    import bnExportGUI
+    return bnExportGUI.patchSizes(object, source, udims)
+
+
+def exportUnit(unit, exporter, sizer=None):
+    """Exports and verifies one unit. Returns (result, error).
+    sizer(object, source, udims) gives the expected tile sizes, default
+    bnExportGUI.patchSizes."""
+    uvs = [int(udim) - 1001 for udim in unit['udims']]
+    bnExportDedup.unshare(unit['paths'])
+    start = time.time()
+    decision = exporter(unit['object'], unit['source'], unit['template'], uvs)
+    seconds = time.time() - start
+    sizes = (sizer or _patchSizes)(unit['object'], unit['source'], unit['udims'])
+    expected = [{'path': filePath, 'template': unit['template'], 'object': unit['object'],
+        'channel': unit['channel'], 'source': unit['source'], 'udim': udim,
+        'width': sizes[udim][0], 'height': sizes[udim][1], 'depth': unit['depth']}
+        for udim, filePath in zip(unit['udims'], unit['paths'])]
+    records, failed = bnExportVerify.verifyExport(expected)
+    result = {'worker': workerName(), 'seconds': seconds, 'decision': decision, 'records': records}
+    if failed:
+        return result, '%d files failed verification' % len(failed)
+    return result, None
+
+
+def work(jobPath, exporter=None, model=None, once=False):
+    """Claims and exports units of a job until none are pending or leased.
+    exporter(object, source, file_template, uvs) defaults to bnExportGUI.exportSource,
+    model is a bnExportScheduler.CostModel that learns from the timings.
+    once stops when nothing is pending instead of waiting for other workers.
+    Returns the number of units this worker exported."""
+    exporter = exporter or _exportSource
+    queue = JobQueue(jobPath)
+    exported = 0
+    with bnLog.operation('Export Queue %s' % os.path.basename(jobPath.rstrip('/\\'))):
+        ## Units name objects and channels, in another project they would export other data
+        mismatch = projectMismatch(queue.settings())
+        if mismatch:
+            bnLog.error('Not working on %s: %s', jobPath, mismatch)
+            return 0
+        while True:
+            recovered = queue.recover()
+            if recovered:
+                bnLog.warning('Recovered stale leases: %s', ', '.join(recovered))
+                bnLog.tally('stale leases', len(recovered))
+            claim = queue.claim()
+            if claim is None:
+                if once or queue.finished():
+                    break
+                time.sleep(pollInterval)
+                continue
+            name, unit = claim
+            heartbeat = _Heartbeat(queue, name, unit.get('lease', minLease))
+            heartbeat.start()
+            try:
+                result, error = exportUnit(unit, exporter)
+            except Exception as exc:
+                result, error = None, '%s: %s' % (type(exc).__name__, exc)
+            finally:
+                heartbeat.stop()
+            ## A recovered unit is pending again or another worker's, its state is not ours to change
+            if heartbeat.lost or not queue.owns(name, unit):
+                bnLog.warning('Lease of %s:%s was recovered by another worker', unit['object'], unit['channel'])
+                bnLog.tally('lost leases')
+                continue
+            if error:
+                state = queue.fail(name, unit, error)
+                bnLog.warning('%s:%s %s, %s', unit['object'], unit['channel'], error, state)
+                bnLog.tally('failed units')
+                continue
+            queue.complete(name, unit, result)
+            if model is not None:
+                model.record(unit, result['seconds'])
+            bnLog.detail('%s:%s %s (%.2fs)', unit['object'], unit['channel'], result['decision'], result['seconds'])
+            bnLog.tally('units')
+            exported += 1
+        if model is not None:
+            model.save()
+        if queue.finished() and queue.claimCollect():
+            problems = queue.collect()
+            counts = queue.counts()
+            bnLog.info('Job finished: %d units done, %d failed, %d unverified files',
+                counts['done'], counts['failed'], len(problems))
+    return exported
+
+
+def jobs(queueRoot):
+    """Job folders under a queue root, oldest first"""
+    try:
+        names = sorted(os.listdir(queueRoot))
+    except OSError:
+        return []
+    return [os.path.join(queueRoot, name) for name in names
+        if os.path.isfile(os.path.join(queueRoot, name, 'job.json'))]
+
+
+def workAll(queueRoot, exporter=None, model=None):
+    """Works on every unfinished job under a queue root"""
+    exported = 0
+    for jobPath in jobs(queueRoot):
+        if not JobQueue(jobPath).finished():
+            exported += work(jobPath, exporter, model)
+    return exported
@@ -0,0 +1,147 @@
+##  bnExportScheduler
+############################################################
+## Orders export work units by estimated cost.
+## Cost is estimated from UDIM count, resolution, bit depth
+## and layer count, scaled by timings learned from earlier
+## exports, so long channels run first and the progress ETA
+## means something.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.5+
+############################################################
+
+import os
+import json
+import time
+
+import bnLog
+
+## Defaults
+timingsPath = os.path.join(os.path.expanduser('~'), '.bnMariTools', 'exportTimings.json')
+defaultRate = 0.02          # seconds per unit of work before anything is learned
+learnWeight = 0.3           # weight of a new timing against the learned rate
+memoryCap = 4096            # megabytes of tiles per Mari export call, 0 for no cap
+
+
+# ------------------------------------------------------------------------------
+
+
+def unitWork(unit):
+    """Size of a work unit in megabytes of pixels times layers to composite"""
+    pixels = unit.get('res', 0) * unit.get('height', unit.get('res', 0))
+    bytesPerPixel = 4 * unit.get('depth', 8) // 8
+    layers = max(unit.get('layers', 1), 1)
+    return len(unit['udims']) * pixels * bytesPerPixel * layers / 1e6
+
+
+def tileBytes(width, height, depth):
+    """Bytes of one RGBA tile"""
+    return width * height * 4 * depth // 8
+
+
+def udimChunks(uvs, width, height, depth, cap=None):
+    """Splits patch indices into chunks of at most cap megabytes of tiles,
+    at least one tile per chunk"""
+    cap = memoryCap if cap is None else cap
+    if not cap or not uvs:
+        return [uvs]
+    perChunk = max(int(cap * 1024 * 1024 // max(tileBytes(width, height, depth), 1)), 1)
+    return [uvs[start:start + perChunk] for start in range(0, len(uvs), perChunk)]
+
+
+def unitKey(unit):
+    return '%s:%s' % (unit['object'], unit['channel'])
+
+
+class CostModel(object):
+    """Seconds per unit of work, learned per channel and overall.
+    Timings are kept between sessions in a small JSON file."""
+
+    def __init__(self, path=None):
+        self.path = path or timingsPath
+        self.rates = {}
+        self.rate = defaultRate
+        try:
+            with open(self.path) as handle:
+                data = json.load(handle)
+            self.rates = data.get('rates', {})
+            self.rate = data.get('rate', defaultRate)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def seed(self, rates):
+        """Takes unitKey: rate measurements from the export history over the
+        learned rates, e.g. bnExportHistory.History().rates()"""
+        self.rates.update(rates)
+
+    def estimate(self, unit):
+        """Estimated seconds to export a unit"""
+        return unitWork(unit) * self.rates.get(unitKey(unit), self.rate)
+
+    def record(self, unit, seconds, baked=None):
+        """Learns from the measured export time of a unit of which baked tiles
+        were exported (default all)"""
+        work = unitWork(unit)
+        if baked is not None and unit['udims']:
+            work = work * baked / len(unit['udims'])
+        if work <= 0:
+            return
+        rate = seconds / work
+        key = unitKey(unit)
+        previous = self.rates.get(key)
+        self.rates[key] = rate if previous is None else previous + learnWeight * (rate - previous)
+        self.rate += learnWeight * (rate - self.rate)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'w') as handle:
+                json.dump({'rate': self.rate, 'rates': self.rates, 'saved': time.time()}, handle)
+        except (IOError, OSError) as exc:
+            bnLog.warning('Could not save export timings: %s', exc)
+
+
+# ------------------------------------------------------------------------------
+
+
+def schedule(units, model):
+    """Returns units ordered longest first"""
+    return sorted(units, key=model.estimate, reverse=True)
+
+
+def binPack(units, workers, model):
+    """Splits units across workers, longest first onto the least loaded
+    worker. Returns one list of units per worker."""
+    bins = [[] for worker in range(max(workers, 1))]
+    loads = [0.0] * len(bins)
+    for unit in schedule(units, model):
+        worker = loads.index(min(loads))
+        bins[worker].append(unit)
+        loads[worker] += model.estimate(unit)
+    return bins
+
+
+class EtaTracker(object):
+    """Remaining time of a job, estimates corrected by how far off the
+    finished units were"""
+
+    def __init__(self, units, model):
+        self.estimates = dict((id(unit), model.estimate(unit)) for unit in units)
+        self.remaining = sum(self.estimates.values())
+        self.estimatedDone = 0.0
+        self.actualDone = 0.0
+
+    def done(self, unit, seconds):
+        estimate = self.estimates.get(id(unit), 0.0)
+        self.remaining = max(self.remaining - estimate, 0.0)
+        self.estimatedDone += estimate
+        self.actualDone += seconds
+
+    def eta(self):
+        """Seconds left"""
+        if self.estimatedDone > 0:
+            return self.remaining * self.actualDone / self.estimatedDone
+        return self.remaining
@@ -0,0 +1,88 @@
+##  bnExportSparse
+############################################################
+## Constant tile handling for bnExportGUI.
+## Before a unit is exported its tiles are checked for being
+## one flat colour, which is what selectionMask fills and most
+## utility channels produce. A constant tile is handled by
+## constantPolicy instead of being baked at full resolution.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+## -------------------
+## Policies:
+##  'off'      - constant tiles are exported like any other
+##               (default, renderers do not read the manifest)
+##  'manifest' - not written, their colour is recorded in
+##               constant_tiles.json in the export path
+##  'skip'     - not written and not recorded
+## Files left at a constant tile's path by an earlier export
+## are removed, they would hold the old content.
+## Only image set sources (layer entries and channels that
+## reduce to one paintable layer) are checked, a channel that
+## needs flattening would have to be flattened to be read.
+############################################################
+
+import os
+import json
+import time
+
+import bnImageUtils
+import bnLog
+import bnPatchUtils
+
+POLICIES = ('off', 'manifest', 'skip')
+
+## Defaults
+constantPolicy = 'off'
+manifestName = 'constant_tiles.json'
+## Sample pixels when Mari can not tell if an image is uniform, tiles whose
+## samples all match are read whole (needs NumPy)
+probePixels = True
+
+
+# ------------------------------------------------------------------------------
+
+
+def constantTiles(geo, imageSet, udims):
+    """Returns udim: rgba of the tiles of imageSet that are one flat colour"""
+    constants = {}
+    patches = bnPatchUtils.patchMap(geo)
+    for udim in udims:
+        image = geo.patchImage(patches[int(udim)], imageSet)
+        color = bnImageUtils.constantColor(image, probePixels)
+        if color is not None:
+            constants[udim] = color
+    return constants
+
+
+def removeStale(paths):
+    """Removes files of earlier exports at the paths of tiles that were not
+    written (constant or duplicate tiles), returns the number removed"""
+    removed = 0
+    for filePath in paths:
+        try:
+            if os.path.lexists(filePath):
+                os.remove(filePath)
+                removed += 1
+        except OSError as exc:
+            bnLog.warning('Could not remove stale file at unwritten tile path %s: %s', filePath, exc)
+    return removed
+
+
+def writeManifest(path, tiles, exported=()):
+    """Merges tiles, file path: record with a 'color', into the constant tile
+    manifest at path. Paths in exported were written as files this time and
+    are dropped from the manifest."""
+    try:
+        with open(path) as handle:
+            manifest = json.load(handle).get('tiles', {})
+    except (IOError, OSError, ValueError):
+        manifest = {}
+    for filePath in exported:
+        manifest.pop(filePath, None)
+    manifest.update(tiles)
+    if not manifest and not os.path.exists(path):
+        return
+    with open(path, 'w') as handle:
+        json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'tiles': manifest}, handle)
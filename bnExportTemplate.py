@@ -0,0 +1,130 @@
+##  bnExportTemplate
+############################################################
+## Export path templates for bnExportGUI.
+## A template is compiled once into a format string, then the
+## output paths of a whole job are expanded upfront so that
+## directories can be created in one go and path collisions
+## between work units are found before anything is baked.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.5+
+## -------------------
+## Tokens:
+##  $ENTITY     - object name
+##  $CHANNEL    - channel name, or the layer path of a layer entry
+##  $UDIM       - UDIM number, left for Mari to fill in on export
+##  $VERSION    - job version string from the GUI
+##  $DEPTH      - channel bit depth (8, 16, 32)
+##  $RES        - channel width in pixels
+##  $COLORSPACE - channel colorspace
+## Any other $TOKEN (Mari's own $FRAME, $LAYER, $NUMBER...) is
+## passed through to Mari unchanged.
+############################################################
+
+import os
+import re
+
+TOKENS = ('ENTITY', 'CHANNEL', 'UDIM', 'VERSION', 'DEPTH', 'RES', 'COLORSPACE')
+
+_tokenPattern = re.compile(r'\$([A-Z]+)')
+
+
+# ------------------------------------------------------------------------------
+
+
+class PathTemplate(object):
+    """A template compiled into a % format string and its token order.
+    passThrough lists the tokens left for Mari to expand."""
+
+    def __init__(self, template):
+        self.template = template
+        self.tokens = []
+        self.passThrough = []
+        parts = []
+        position = 0
+        for match in _tokenPattern.finditer(template):
+            token = match.group(1)
+            if token not in TOKENS:
+                self.passThrough.append(token)
+                continue
+            parts.append(template[position:match.start()].replace('%', '%%'))
+            parts.append('%s')
+            self.tokens.append(token)
+            position = match.end()
+        parts.append(template[position:].replace('%', '%%'))
+        self._format = ''.join(parts)
+
+    def expand(self, values):
+        """Returns the template with every token replaced from values.
+        Tokens missing from values are kept as $TOKEN."""
+        return self._format % tuple(str(values.get(token, '$' + token)) for token in self.tokens)
+
+
+# ------------------------------------------------------------------------------
+
+
+class PathPlan(object):
+    """Output paths of every work unit in an export job.
+    units are dicts with object, channel, udims, depth, res and colorspace."""
+
+    def __init__(self, fileTemplate, units, version=''):
+        self.template = PathTemplate(fileTemplate)
+        self.units = units
+        self.version = version
+        self.unitTemplates = []
+        self.paths = []
+        owners = {}
+        for index, unit in enumerate(units):
+            values = self.unitValues(unit)
+            self.unitTemplates.append(self.template.expand(values))
+            unitPaths = []
+            for udim in unit['udims']:
+                values['UDIM'] = udim
+                path = self.template.expand(values)
+                unitPaths.append(path)
+                key = os.path.normcase(os.path.normpath(path))
+                owners.setdefault(key, (path, []))[1].append((index, udim))
+            self.paths.append(unitPaths)
+        self.collisions = [(path, entries) for path, entries in owners.values() if len(entries) > 1]
+
+    def unitValues(self, unit):
+        """Token values for a unit, everything but $UDIM"""
+        return {
+            'ENTITY': unit['object'],
+            'CHANNEL': unit['channel'],
+            'VERSION': self.version,
+            'DEPTH': unit.get('depth', ''),
+            'RES': unit.get('res', ''),
+            'COLORSPACE': unit.get('colorspace', ''),
+        }
+
+    def unitTemplate(self, index):
+        """Template to hand to Mari for a unit, only $UDIM left to expand"""
+        return self.unitTemplates[index]
+
+    def unitPaths(self, index):
+        """Expanded output paths of a unit, in udim order"""
+        return self.paths[index]
+
+    def directories(self):
+        """Every output directory of the job"""
+        return sorted(set(os.path.dirname(path) for unitPaths in self.paths for path in unitPaths))
+
+    def createDirectories(self):
+        """Creates all missing output directories, returns the ones created"""
+        created = []
+        for directory in self.directories():
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+                created.append(directory)
+        return created
+
+    def collisionReport(self):
+        """Readable lines describing colliding paths"""
+        lines = []
+        for path, entries in self.collisions:
+            owners = ', '.join('%s:%s(%s)' % (self.units[index]['object'], self.units[index]['channel'], udim)
+                               for index, udim in entries)
+            lines.append('%s <- %s' % (path, owners))
+        return lines
@@ -0,0 +1,251 @@
+##  bnExportVerify
+############################################################
+## Post-export verification for bnExportGUI.
+## Checks every expected output file exists, is complete and
+## has the expected resolution and bit depth, and writes a
+## checksum manifest next to the exported maps.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.5+
+############################################################
+
+import os
+import json
+import time
+import struct
+import hashlib
+import multiprocessing.pool
+
+## Defaults
+verifyWorkers = 16
+checksumAlgorithm = 'sha1'
+manifestName = 'export_manifest.json'
+
+## Failures worth exporting again, resolution/depth mismatches are only reported
+RETRY_STATUS = ('missing', 'empty', 'truncated', 'unreadable')
+
+## Bit depths each format can store, other formats skip the depth check
+formatDepths = {
+    'tif': (8, 16, 32), 'tiff': (8, 16, 32),
+    'exr': (16, 32),
+    'png': (8, 16),
+    'tga': (8,),
+    'jpg': (8,), 'jpeg': (8,),
+}
+
+
+# ------------------------------------------------------------------------------
+# Header readers. Each returns (width, height, depth, complete) or None.
+# ------------------------------------------------------------------------------
+
+def _readTiff(handle, fileSize):
+    order = handle.read(2)
+    endian = {b'II': '<', b'MM': '>'}.get(order)
+    if endian is None or struct.unpack(endian + 'H', handle.read(2))[0] != 42:
+        return None
+    ifdOffset = struct.unpack(endian + 'I', handle.read(4))[0]
+    handle.seek(ifdOffset)
+    count = struct.unpack(endian + 'H', handle.read(2))[0]
+    typeSizes = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4)}
+    tags = {}
+    for entry in range(count):
+        tag, fieldType, valueCount = struct.unpack(endian + 'HHI', handle.read(8))
+        raw = handle.read(4)
+        if fieldType not in typeSizes:
+            continue
+        code, size = typeSizes[fieldType]
+        if size * valueCount <= 4:
+            data = raw[:size * valueCount]
+        else:
+            position = handle.tell()
+            handle.seek(struct.unpack(endian + 'I', raw)[0])
+            data = handle.read(size * valueCount)
+            handle.seek(position)
+        if len(data) < size * valueCount:
+            return None
+        tags[tag] = struct.unpack(endian + code * valueCount, data)
+    width = tags.get(256, (0,))[0]
+    height = tags.get(257, (0,))[0]
+    depth = tags.get(258, (1,))[0]
+    offsets = tags.get(273) or tags.get(324) or ()
+    sizes = tags.get(279) or tags.get(325) or ()
+    complete = bool(offsets and sizes) and max(o + s for o, s in zip(offsets, sizes)) <= fileSize
+    return width, height, depth, complete
+
+
+def _readPng(handle, fileSize):
+    if handle.read(8) != b'\x89PNG\r\n\x1a\n':
+        return None
+    length, chunk = struct.unpack('>I4s', handle.read(8))
+    if chunk != b'IHDR':
+        return None
+    width, height, depth = struct.unpack('>IIB', handle.read(9))
+    handle.seek(max(fileSize - 12, 0))
+    complete = handle.read(12)[4:8] == b'IEND'
+    return width, height, depth, complete
+
+
+def _readExr(handle, fileSize):
+    if struct.unpack('<I', handle.read(4))[0] != 20000630:
+        return None
+    flags = struct.unpack('<I', handle.read(4))[0]
+    attributes = {}
+    while True:
+        name = b''
+        char = handle.read(1)
+        while char not in (b'\x00', b''):
+            name += char
+            char = handle.read(1)
+        if not name:
+            break
+        attrType = b''
+        char = handle.read(1)
+        while char not in (b'\x00', b''):
+            attrType += char
+            char = handle.read(1)
+        size = struct.unpack('<I', handle.read(4))[0]
+        attributes[name] = handle.read(size)
+    xMin, yMin, xMax, yMax = struct.unpack('<iiii', attributes[b'dataWindow'])
+    width, height = xMax - xMin + 1, yMax - yMin + 1
+    ## Channel list: name\0, pixel type (0 uint, 1 half, 2 float), ...
+    channels = attributes.get(b'channels', b'')
+    pixelType = struct.unpack('<i', channels[channels.index(b'\x00') + 1:][:4])[0] if channels else 1
+    depth = 16 if pixelType == 1 else 32
+    complete = True
+    if not flags & 0x200:
+        compression = ord(attributes.get(b'compression', b'\x00')[:1])
+        linesPerChunk = {0: 1, 1: 1, 2: 1, 3: 16, 4: 32, 5: 16, 6: 32, 7: 32, 8: 32, 9: 256}.get(compression, 1)
+        chunks = (height + linesPerChunk - 1) // linesPerChunk
+        table = handle.read(8 * chunks)
+        if len(table) < 8 * chunks:
+            return width, height, depth, False
+        lastOffset = max(struct.unpack('<%dQ' % chunks, table))
+        complete = lastOffset + 8 <= fileSize
+    return width, height, depth, complete
+
+
+def _readTga(handle, fileSize):
+    header = handle.read(18)
+    if len(header) < 18:
+        return None
+    idLength, mapType, imageType = struct.unpack('<BBB', header[:3])
+    width, height, bits = struct.unpack('<HHB', header[12:17])
+    ## Run length encoded images (9, 10, 11) have no fixed size
+    complete = imageType > 8 or fileSize >= 18 + idLength + width * height * bits // 8
+    return width, height, 8, complete
+
+
+def _readJpeg(handle, fileSize):
+    if handle.read(2) != b'\xff\xd8':
+        return None
+    width = height = 0
+    while True:
+        marker = handle.read(2)
+        if len(marker) < 2 or marker[:1] != b'\xff':
+            break
+        length = struct.unpack('>H', handle.read(2))[0]
+        if marker[1:2] in (b'\xc0', b'\xc1', b'\xc2'):
+            depth, height, width = struct.unpack('>BHH', handle.read(5))
+            break
+        handle.seek(length - 2, 1)
+    handle.seek(max(fileSize - 2, 0))
+    return width, height, 8, handle.read(2) == b'\xff\xd9'
+
+
+headerReaders = {
+    'tif': _readTiff, 'tiff': _readTiff,
+    'png': _readPng,
+    'exr': _readExr,
+    'tga': _readTga,
+    'jpg': _readJpeg, 'jpeg': _readJpeg,
+}
+
+
+def readHeader(path):
+    """Returns (width, height, depth, complete) for supported formats,
+    None if the format is not supported, raises on unreadable files"""
+    reader = headerReaders.get(os.path.splitext(path)[1][1:].lower())
+    if reader is None:
+        return None
+    with open(path, 'rb') as handle:
+        return reader(handle, os.path.getsize(path))
+
+
+# ------------------------------------------------------------------------------
+
+
+def checksum(path, blockSize=1 << 20):
+    """Returns the hex digest of a file"""
+    digest = hashlib.new(checksumAlgorithm)
+    with open(path, 'rb') as handle:
+        block = handle.read(blockSize)
+        while block:
+            digest.update(block)
+            block = handle.read(blockSize)
+    return digest.hexdigest()
+
+
+def verifyFile(expected):
+    """Verifies one file. expected is a dict with path, width, height, depth.
+    Returns a manifest record with a status of 'ok' or the first problem found."""
+    path = expected['path']
+    record = dict(expected, status='ok', size=0, checksum=None)
+    try:
+        record['size'] = os.path.getsize(path)
+    except OSError:
+        record['status'] = 'missing'
+        return record
+    if not record['size']:
+        record['status'] = 'empty'
+        return record
+    try:
+        header = readHeader(path)
+    except Exception:
+        record['status'] = 'unreadable'
+        return record
+    if header is not None:
+        width, height, depth, complete = header
+        record.update(fileWidth=width, fileHeight=height, fileDepth=depth)
+        extension = os.path.splitext(path)[1][1:].lower()
+        if not complete:
+            record['status'] = 'truncated'
+        elif expected.get('width') and (width, height) != (expected['width'], expected['height']):
+            record['status'] = 'resolution'
+        elif expected.get('depth') in formatDepths.get(extension, ()) and depth != expected['depth']:
+            record['status'] = 'depth'
+    if record['status'] == 'ok':
+        try:
+            record['checksum'] = checksum(path)
+        except (IOError, OSError):
+            record['status'] = 'unreadable'
+    return record
+
+
+def verifyExport(expected, manifestPath=None, workers=None):
+    """Verifies a list of expected file dicts in a thread pool.
+    Returns (records, failed) where failed are the records worth re-exporting.
+    Writes a JSON manifest if manifestPath is given."""
+    if not expected:
+        return [], []
+    pool = multiprocessing.pool.ThreadPool(min(workers or verifyWorkers, len(expected)))
+    try:
+        records = pool.map(verifyFile, expected)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [record for record in records if record['status'] in RETRY_STATUS]
+    if manifestPath:
+        writeManifest(manifestPath, records)
+    return records, failed
+
+
+def writeManifest(manifestPath, records):
+    """Writes verification records as a JSON manifest"""
+    manifest = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'algorithm': checksumAlgorithm,
+        'files': records,
+    }
+    with open(manifestPath, 'w') as handle:
+        json.dump(manifest, handle, indent=1, sort_keys=True)
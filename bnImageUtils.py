@@ -0,0 +1,250 @@
+##  bnImageUtils
+############################################################
+## Shared helpers for reading and writing patch image pixels.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+## NumPy is optional, pixel buffer access is disabled without it.
+############################################################
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import collections
+
+import mari
+
+
+# ------------------------------------------------------------------------------
+
+
+def hasPixelAccess(image=None):
+    """Returns True if pixel buffers can be moved between Mari and NumPy"""
+    if numpy is None:
+        return False
+    if image is None:
+        return True
+    return hasattr(image, 'toNumpyArray') and hasattr(image, 'fromNumpyArray')
+
+
+def udimOffset(udim):
+    """Returns the (u, v) origin of a UDIM tile in UV space"""
+    index = int(udim) - 1001
+    return index % 10, index // 10
+
+
+def imageSize(image):
+    """Returns width, height of a patch image"""
+    return image.width(), image.height()
+
+
+def pixelBytes(width, height):
+    """Bytes of a (height, width, 4) float32 pixel array"""
+    return width * height * 16
+
+
+def colorTuple(color):
+    """Returns a mari.Color as an rgba tuple"""
+    return color.r(), color.g(), color.b(), color.a()
+
+
+def sampleGrid(image, grid=4):
+    """Returns the rgba tuples of grid x grid pixels spread evenly over image,
+    None if Mari can not read single pixels"""
+    if not hasattr(image, 'getPixel'):
+        return None
+    width, height = image.width(), image.height()
+    try:
+        return tuple(colorTuple(image.getPixel(width * (column * 2 + 1) // (grid * 2),
+                                               height * (row * 2 + 1) // (grid * 2)))
+                     for row in range(grid) for column in range(grid))
+    except Exception:
+        return None
+
+
+def constantColor(image, probe=True, grid=4):
+    """Returns the rgba tuple of an image that is one flat colour, else None.
+    Uses Mari's uniform colour flag where there is one. Otherwise, with probe,
+    reads a grid x grid sample of single pixels first and only downloads the
+    whole tile if they all match."""
+    if hasattr(image, 'isUniform'):
+        if image.isUniform():
+            return colorTuple(image.uniformColor())
+        return None
+    if not probe:
+        return None
+    samples = sampleGrid(image, grid)
+    if samples is not None and len(set(samples)) > 1:
+        return None
+    if not hasPixelAccess(image):
+        return None
+    pixels = downloadPixels(image)
+    first = pixels[0, 0]
+    if not (pixels == first).all():
+        return None
+    return tuple(float(value) for value in first)
+
+
+# ------------------------------------------------------------------------------
+
+
+def downloadPixels(image):
+    """Returns the pixels of image as a (height, width, 4) float32 array.
+    Row 0 is the bottom of the tile (v = 0)."""
+    if not hasPixelAccess(image):
+        raise RuntimeError('Pixel buffer access is not available in this version of Mari')
+    return numpy.asarray(image.toNumpyArray(), dtype=numpy.float32)
+
+
+def uploadPixels(image, pixels):
+    """Writes a (height, width, 4) array into image in a single upload.
+    This is the only path used to push computed pixels back into Mari."""
+    if not hasPixelAccess(image):
+        raise RuntimeError('Pixel buffer access is not available in this version of Mari')
+    image.fromNumpyArray(numpy.ascontiguousarray(pixels, dtype=numpy.float32))
+
+
+# ------------------------------------------------------------------------------
+# Resampling
+# Separable filters applied one axis at a time. Each output pixel gathers a
+# fixed number of taps, so memory stays at one output-sized buffer per axis.
+# ------------------------------------------------------------------------------
+
+def _boxKernel(x):
+    return (numpy.abs(x) <= 0.5).astype(numpy.float32)
+
+
+def _lanczosKernel(x):
+    x = numpy.abs(x)
+    return numpy.where(x < 3.0, numpy.sinc(x) * numpy.sinc(x / 3.0), 0.0).astype(numpy.float32)
+
+
+resampleKernels = {
+    'box': (_boxKernel, 0.5),
+    'lanczos': (_lanczosKernel, 3.0),
+}
+
+
+def _axisTaps(inSize, outSize, kernel, support):
+    """Returns (indices, weights) of shape (outSize, taps) for one axis"""
+    scale = float(inSize) / outSize
+    stretch = max(scale, 1.0)
+    centres = (numpy.arange(outSize) + 0.5) * scale
+    radius = support * stretch
+    first = numpy.floor(centres - radius).astype(numpy.int64)
+    taps = int(numpy.ceil(2 * radius)) + 1
+    indices = first[:, numpy.newaxis] + numpy.arange(taps)[numpy.newaxis, :]
+    weights = kernel((indices + 0.5 - centres[:, numpy.newaxis]) / stretch)
+    totals = weights.sum(axis=1)
+    totals[totals == 0.0] = 1.0
+    weights /= totals[:, numpy.newaxis]
+    return numpy.clip(indices, 0, inSize - 1), weights
+
+
+def resampleAxis(pixels, outSize, axis, filter='lanczos'):
+    """Resamples pixels along axis 0 (rows) or 1 (columns) to outSize"""
+    kernel, support = resampleKernels[filter]
+    source = pixels.swapaxes(0, axis)
+    indices, weights = _axisTaps(source.shape[0], outSize, kernel, support)
+    result = numpy.zeros((outSize,) + source.shape[1:], dtype=numpy.float32)
+    broadcast = (-1,) + (1,) * (source.ndim - 1)
+    for tap in range(indices.shape[1]):
+        result += weights[:, tap].reshape(broadcast) * source[indices[:, tap]]
+    return result.swapaxes(0, axis)
+
+
+def halve(pixels):
+    """Returns the next mip level down of pixels (2x2 box average)"""
+    height, width = pixels.shape[:2]
+    pixels = pixels[:height - height % 2, :width - width % 2]
+    return pixels.reshape(height // 2, 2, width // 2, 2, -1).mean(axis=(1, 3)).astype(numpy.float32)
+
+
+def mipChain(pixels, minSize=1, chain=None):
+    """Returns [pixels, pixels/2, pixels/4, ...] down to minSize.
+    An existing chain of pixels is extended instead of rebuilt."""
+    chain = chain or [pixels]
+    while min(chain[-1].shape[:2]) // 2 >= max(minSize, 1):
+        chain.append(halve(chain[-1]))
+    return chain
+
+
+def chainBytes(width, height, minSize=1):
+    """Bytes of the mip chain of a width x height tile down to minSize"""
+    total = pixelBytes(width, height)
+    while min(width, height) // 2 >= max(minSize, 1):
+        width, height = width // 2, height // 2
+        total += pixelBytes(width, height)
+    return total
+
+
+def resample(pixels, size, filter='lanczos', chain=None):
+    """Resamples square tile pixels to size x size.
+    'mip' uses successive halving, the other filters start from the closest
+    mip level at or above size when a chain is given."""
+    if chain is None:
+        chain = [pixels]
+    source = chain[0]
+    for level in chain:
+        if level.shape[0] >= size and level.shape[1] >= size:
+            source = level
+    if filter == 'mip':
+        while source.shape[0] // 2 >= size and source.shape[1] // 2 >= size:
+            source = halve(source)
+        filter = 'box'
+    if source.shape[:2] == (size, size):
+        return source
+    return resampleAxis(resampleAxis(source, size, 0, filter), size, 1, filter)
+
+
+class MipChainCache(object):
+    """Keeps the mip chain of each tile's original pixels so repeated
+    downres/upres previews resample from the closest level instead of the
+    last (already reduced) result. Chains only go down as far as the sizes
+    asked for. Least recently used chains are dropped once maxBytes is
+    exceeded."""
+
+    def __init__(self, maxBytes=2048 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def chain(self, key, pixels, minSize=1):
+        """Returns the cached chain for key, extended down to minSize, if pixels
+        still match the last size written from it, otherwise starts a new
+        chain from pixels."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            chain, written = entry
+            self._bytes -= sum(level.nbytes for level in chain)
+            if written is not None and written.shape == pixels.shape and \
+                    numpy.allclose(written, pixels, atol=1.0 / 255):
+                chain = mipChain(chain[0], minSize, chain)
+                self._store(key, chain, written)
+                return chain
+        chain = mipChain(pixels, minSize)
+        self._store(key, chain, None)
+        return chain
+
+    def written(self, key, pixels):
+        """Records the pixels last written for key"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = (entry[0], pixels)
+
+    def _store(self, key, chain, written):
+        size = sum(level.nbytes for level in chain)
+        if size > self.maxBytes:
+            return
+        self._entries[key] = (chain, written)
+        self._bytes += size
+        while self._bytes > self.maxBytes:
+            oldKey, (oldChain, oldWritten) = self._entries.popitem(last=False)
+            self._bytes -= sum(level.nbytes for level in oldChain)
@@ -11,14 +11,103 @@
 ############################################################
 
 #import PythonQt.QtCore as QtCore
+import PythonQt.QtGui as QtGui
+import multiprocessing
+import multiprocessing.pool
+import bnBatch
+import bnImageUtils
+import bnLayerUtils
+import bnLog
+import bnTexelDensity
+import bnTrace
 
 icon_path = mari.resources.path('ICONS')
 
-def resizeImage(res):
-	"""This function resizes the targeted imageSet"""
+## Resample filters, 'mari' leaves resampling to image.resize()
+resizeFilters = ['mari', 'box', 'lanczos', 'mip']
+resizeWorkers = multiprocessing.cpu_count()
+## Pixels (tiles, mip levels and results) held per resize batch, one 8k tile is 1GB
+resizeBatchBytes = 2048 * 1024 * 1024
+resizeCache = bnImageUtils.MipChainCache()
+
+def resampleTiles(tiles, res, filter):
+	'''Resamples a list of (key, chain) tuples in a worker pool, returns the pixels in order.
+	res is one size for all tiles or a list with one size per tile.'''
+	sizes = res if isinstance(res, list) else [res] * len(tiles)
+	def work(job):
+		tile, size = job
+		return bnImageUtils.resample(tile[1][0], size, filter, tile[1])
+	jobs = list(zip(tiles, sizes))
+	if len(jobs) < 2:
+		return [work(job) for job in jobs]
+	pool = multiprocessing.pool.ThreadPool(min(resizeWorkers, len(jobs)))
+	try:
+		return pool.map(work, jobs)
+	finally:
+		pool.close()
+		pool.join()
+
+def resizeBatches(mariObj, layerImageSet, sizes):
+	'''Splits (patch, size) pairs into batches of at most resizeWorkers tiles whose
+	pixels, mip levels down to the new size and results fit in resizeBatchBytes.
+	A tile larger than that is a batch of its own.'''
+	batches = [[]]
+	batchBytes = 0
+	for patch, res in sizes:
+		image = mariObj.patchImage(patch, layerImageSet)
+		tileBytes = bnImageUtils.chainBytes(image.width(), image.height(), res) + bnImageUtils.pixelBytes(res, res)
+		if batches[-1] and (batchBytes + tileBytes > resizeBatchBytes or len(batches[-1]) >= resizeWorkers):
+			batches.append([])
+			batchBytes = 0
+		batches[-1].append((patch, res))
+		batchBytes += tileBytes
+	return [sizeBatch for sizeBatch in batches if sizeBatch]
+
+def cacheKey(mariObj, path, role):
+	'''resizeCache key prefix of a layer's 'paint' or 'mask' image set, by layer path
+	so layers of the same name in different groups and a layer's mask stay apart'''
+	return (mariObj.name(), path, role)
+
+def resizePatches(mariObj, mariLayer, layerImageSet, sizes, filter, batch, keyPrefix):
+	'''Resizes the patch images of an image set, sizes is a list of (patch, size).
+	keyPrefix (see cacheKey) names the image set in resizeCache.'''
+	if filter == 'mari':
+		##resize paint layer
+		for patch, res in sizes:
+			image = mariObj.patchImage(patch, layerImageSet)
+			image.resize(res)
+			batch.step()
+			bnTrace.count(items=1)
+			bnLog.detail('Resized %s(%s) to %sx%s', mariLayer.name(), patch.udim(), res, res)
+		return
+	## Pull a batch of tiles, resample in parallel, push back
+	for sizeBatch in resizeBatches(mariObj, layerImageSet, sizes):
+		tiles = []
+		for patch, res in sizeBatch:
+			key = keyPrefix + (patch.udim(),)
+			pixels = bnImageUtils.downloadPixels(mariObj.patchImage(patch, layerImageSet))
+			tiles.append((key, resizeCache.chain(key, pixels, res)))
+		results = resampleTiles(tiles, [res for patch, res in sizeBatch], filter)
+		for (patch, res), tile, pixels in zip(sizeBatch, tiles, results):
+			image = mariObj.patchImage(patch, layerImageSet)
+			image.resize(res)
+			bnImageUtils.uploadPixels(image, pixels)
+			resizeCache.written(tile[0], pixels)
+			batch.step()
+			bnTrace.count(items=1)
+			bnLog.detail('Resized %s(%s) to %sx%s (%s)', mariLayer.name(), patch.udim(), res, res, filter)
+
+@bnTrace.traced()
+def resizeImage(res, filter='mari', batchMode=None):
+	"""This function resizes the targeted imageSet.
+	batchMode is a bnBatch mode ('full', 'chunked' or 'fast')"""
 	#img_size = QtCore.QSize(256, 256)
 	img_size = res
 
+	if filter != 'mari' and not bnImageUtils.hasPixelAccess():
+		mari.utils.message('Filtered resize needs NumPy and Mari pixel buffer access.')
+		return
+
 	mariObj = mari.geo.current()
 	mariChan = mariObj.currentChannel()
 	mariLayer = mariChan.currentLayer()
@@ -26,20 +115,106 @@ def resizeImage(res):
 		
 	try:
 		layerImageSet = mariLayer.imageSet()
-		mari.history.startMacro('Image Resize')
-		##resize paint layer
-		for patch in udimList:
-			image = mariObj.patchImage(patch, layerImageSet)
-			image.resize(img_size)
-			print "Resized %s(%s) to %sx%s" % (mariLayer.name(), patch.udim(), res, res)
-		mari.history.stopMacro()
+		keyPrefix = None
+		if filter != 'mari':
+			paths = [path for path, layer in bnLayerUtils.layerPaths(mariChan, lambda layer: layer == mariLayer)]
+			path = paths[0] if paths else mariChan.name() + bnLayerUtils.PATH_SEPARATOR + mariLayer.name()
+			keyPrefix = cacheKey(mariObj, path, 'paint')
+		with bnBatch.BatchOperation('Image Resize', batchMode) as batch:
+			resizePatches(mariObj, mariLayer, layerImageSet,
+				[(patch, img_size) for patch in udimList], filter, batch, keyPrefix)
 	except:
 		mari.utils.message('Error. Make sure layer is paintable')
 
+@bnTrace.traced()
+def autoResizeImages(density=None, filter='mari', batchMode=None, preview=False):
+	"""Resizes the selected patches (all patches if none are selected) of every
+	paintable layer and plain mask in the current channel to the power of two size
+	matching their texel density (see bnTexelDensity). Patches already at their
+	size are left alone. With preview the plan is only logged."""
+	if filter != 'mari' and not bnImageUtils.hasPixelAccess():
+		mari.utils.message('Filtered resize needs NumPy and Mari pixel buffer access.')
+		return
+
+	mariObj = mari.geo.current()
+	mariChan = mariObj.currentChannel()
+	udimList = mariObj.selectedPatches() or mariObj.patchList()
+	try:
+		plan = bnTexelDensity.resolutionPlan(mariObj, udimList, density)
+	except (ValueError, IOError) as exc:
+		mari.utils.message(str(exc))
+		return
+	patches = [patch for patch in udimList if patch.udim() in plan]
+
+	## Every paintable image set of the channel, substacks included, and the
+	## plain masks of all layers
+	imageSets = []
+	for path, layer in bnLayerUtils.layerPaths(mariChan, lambda layer: True):
+		if bnLayerUtils.isPaintable(layer):
+			imageSets.append((layer, layer.imageSet(), cacheKey(mariObj, path, 'paint')))
+		if layer.hasMask() and not layer.hasMaskStack():
+			imageSets.append((layer, layer.maskImageSet(), cacheKey(mariObj, path, 'mask')))
+
+	with bnLog.operation('Texel Density'):
+		pixelsBefore = pixelsAfter = 0
+		work = []
+		for layer, imageSet, keyPrefix in imageSets:
+			sizes = []
+			for patch in patches:
+				current = mariObj.patchImage(patch, imageSet).width()
+				pixelsBefore += current * current
+				pixelsAfter += plan[patch.udim()] * plan[patch.udim()]
+				if current != plan[patch.udim()]:
+					sizes.append((patch, plan[patch.udim()]))
+			work.append((layer, imageSet, keyPrefix, sizes))
+		for patch in patches:
+			bnLog.detail('%s: %sx%s', patch.udim(), plan[patch.udim()], plan[patch.udim()])
+		bnLog.info('Texel density %s px/unit: %d patches on %d image sets, %d tiles to resize, '
+			'%.0f%% of the current pixels', density or bnTexelDensity.targetDensity, len(patches),
+			len(imageSets), sum(len(sizes) for layer, imageSet, keyPrefix, sizes in work),
+			100.0 * pixelsAfter / max(pixelsBefore, 1))
+		if preview:
+			return plan
+		with bnBatch.BatchOperation('Texel Density Resize', batchMode) as batch:
+			for layer, imageSet, keyPrefix, sizes in work:
+				resizePatches(mariObj, layer, imageSet, sizes, filter, batch, keyPrefix)
+	return plan
+
+def autoResizeDialog(filter='mari'):
+	"""Asks for the target density and resizes by texel density"""
+	## PythonQt's getDouble() returns the initial value on Cancel
+	dialog = QtGui.QInputDialog()
+	dialog.setWindowTitle('Resize by Texel Density')
+	dialog.setLabelText('Pixels per scene unit:')
+	dialog.setInputMode(QtGui.QInputDialog.DoubleInput)
+	dialog.setDoubleRange(0.01, 100000.0)
+	dialog.setDoubleDecimals(2)
+	dialog.setDoubleValue(bnTexelDensity.targetDensity)
+	if not dialog.exec_():
+		return
+	density = dialog.doubleValue()
+	bnTexelDensity.targetDensity = density
+	autoResizeImages(density, filter)
+
 ## UI
 resOptions = [256, 512, 1024, 2048, 4096, 8192]
 for item in resOptions:
 	resizeITEM = mari.actions.create('%s x %s' % (str(item),str(item)), 'resizeImage(%d)' % item)
 	resizeITEM.setIconPath('%s/TransformScale.png' % icon_path)
 	## Recursive menu creation
-	mari.menus.addAction(resizeITEM, 'MainWindow/P&atches/Resize Selected Image')
\ No newline at end of file
+	mari.menus.addAction(resizeITEM, 'MainWindow/P&atches/Resize Selected Image')
+	## Filtered resize, one sub menu per filter
+	for filterName in resizeFilters[1:]:
+		resizeITEM = mari.actions.create('%s x %s (%s)' % (str(item),str(item),filterName), 'resizeImage(%d, %r)' % (item, filterName))
+		resizeITEM.setIconPath('%s/TransformScale.png' % icon_path)
+		mari.menus.addAction(resizeITEM, 'MainWindow/P&atches/Resize Selected Image (Filtered)/%s' % filterName.capitalize())
+
+clearCacheITEM = mari.actions.create('Clear Resize Cache', 'resizeCache.clear()')
+mari.menus.addAction(clearCacheITEM, 'MainWindow/P&atches/Resize Selected Image (Filtered)')
+
+## Texel density
+autoITEM = mari.actions.create('By Texel Density...', 'autoResizeDialog()')
+autoITEM.setIconPath('%s/TransformScale.png' % icon_path)
+mari.menus.addAction(autoITEM, 'MainWindow/P&atches/Resize Selected Image')
+previewITEM = mari.actions.create('Preview Texel Density Sizes', 'autoResizeImages(preview=True)')
+mari.menus.addAction(previewITEM, 'MainWindow/P&atches/Resize Selected Image')
@@ -0,0 +1,242 @@
+##  bnLayerUtils
+############################################################
+## Shared layer stack helpers used by bnChanLayer and
+## bnMaskFromSelection.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+############################################################
+
+import hashlib
+
+import mari
+
+
+# ------------------------------------------------------------------------------
+
+
+def channelMaskStack(layer):
+    """Returns a mask stack on layer ready for channel masks.
+    If mask exists convert, if stack exists keep, else make new empty stack"""
+    if layer.hasMaskStack():
+        return layer.maskStack()
+    if layer.hasMask():
+        return layer.makeMaskStack()
+    layerMaskStack = layer.makeMaskStack()
+    layerMaskStack.removeLayers(layerMaskStack.layerList())
+    return layerMaskStack
+
+
+def addChannelMasks(layerMaskStack, sourceChannel, invert=False):
+    """Adds a shared channel layer for each source channel to a mask stack"""
+    for channel in sourceChannel:
+        maskChannelLayerName = '%s(Shared Channel)' % channel.name()
+        layerMaskStack.createChannelLayer(maskChannelLayerName, channel)
+
+    if invert:
+        layerMaskStack.createAdjustmentLayer("Invert", "Filter/Invert")
+
+    return layerMaskStack
+
+
+# ------------------------------------------------------------------------------
+# Flatten bypass
+# Walks a channel stack the same way getLayerList() does and works out whether
+# its result is just one paintable layer, in which case the layer images can be
+# exported directly instead of flattening the channel.
+# ------------------------------------------------------------------------------
+
+NORMAL_BLEND = getattr(getattr(mari, 'Layer', None), 'NORMAL', 0)
+
+
+def _isUniformBlack(image):
+    """True if an image is known to be a single black colour without reading pixels"""
+    if not hasattr(image, 'isUniform') or not image.isUniform():
+        return False
+    color = image.uniformColor()
+    return color.r() == 0.0 and color.g() == 0.0 and color.b() == 0.0
+
+
+def isFullyMasked(layer):
+    """True if layer has a plain mask that is black on every patch"""
+    if not layer.hasMask() or layer.hasMaskStack():
+        return False
+    if hasattr(layer, 'isMaskEnabled') and not layer.isMaskEnabled():
+        return False
+    images = layer.maskImageSet().imageList()
+    return bool(images) and all(_isUniformBlack(image) for image in images)
+
+
+def _hasActiveMask(layer):
+    if hasattr(layer, 'isMaskEnabled') and not layer.isMaskEnabled():
+        return False
+    return layer.hasMask() or layer.hasMaskStack()
+
+
+def _isPassthrough(layer):
+    """True if layer leaves what is below it unchanged"""
+    return not layer.isVisible() or layer.opacity() == 0.0 or isFullyMasked(layer)
+
+
+def _contributingLayers(layer_list):
+    """Returns (paintable layers, reason) for the layers that change the result.
+    reason is set when something other than plain paintable layers contributes."""
+    paintable = []
+    for layer in layer_list:
+        if _isPassthrough(layer):
+            continue
+        if layer.opacity() != 1.0 or layer.blendMode() != NORMAL_BLEND:
+            return None, '%s has opacity or blend mode' % layer.name()
+        if _hasActiveMask(layer):
+            return None, '%s is masked' % layer.name()
+        if hasattr(layer, 'hasAdjustmentStack') and layer.hasAdjustmentStack():
+            adjustments, reason = _contributingLayers(layer.adjustmentStack().layerList())
+            if adjustments is None or adjustments:
+                return None, '%s has adjustments' % layer.name()
+        if hasattr(layer, 'layerStack'):
+            children, reason = _contributingLayers(layer.layerStack().layerList())
+            if children is None:
+                return None, reason
+            paintable.extend(children)
+        elif layer.isPaintableLayer():
+            paintable.append(layer)
+        else:
+            return None, '%s is not paintable' % layer.name()
+    return paintable, None
+
+
+def flattenBypass(channel):
+    """Returns (layer, reason). layer is the single paintable layer the channel
+    reduces to, or None if the channel has to be flattened."""
+    paintable, reason = _contributingLayers(channel.layerList())
+    if paintable is None:
+        return None, reason
+    if len(paintable) != 1:
+        return None, '%d contributing paintable layers' % len(paintable)
+    return paintable[0], 'only contributing layer'
+
+
+# ------------------------------------------------------------------------------
+# Layer paths
+# Name a layer inside a channel so it can be an export list entry:
+#   channel/group/layer               a layer, also inside groups
+#   channel/layer/[Mask]              a layer's plain mask
+#   channel/layer/[Mask]/maskLayer    a layer in a layer's mask stack
+# ------------------------------------------------------------------------------
+
+PATH_SEPARATOR = '/'
+MASK = '[Mask]'
+ADJUSTMENTS = '[Adjustments]'
+
+
+def _walkLayers(layer_list, prefix, criterionFn, found, substacks=True):
+    """Appends (path, layer) of the layers matching criterionFn, walking groups
+    and, if substacks is set, mask and adjustment stacks"""
+    for layer in layer_list:
+        path = prefix + PATH_SEPARATOR + layer.name()
+        if criterionFn(layer):
+            found.append((path, layer))
+        if hasattr(layer, 'layerStack'):
+            _walkLayers(layer.layerStack().layerList(), path, criterionFn, found, substacks)
+        if not substacks:
+            continue
+        if layer.hasMaskStack():
+            _walkLayers(layer.maskStack().layerList(), path + PATH_SEPARATOR + MASK, criterionFn, found)
+        if hasattr(layer, 'hasAdjustmentStack') and layer.hasAdjustmentStack():
+            _walkLayers(layer.adjustmentStack().layerList(), path + PATH_SEPARATOR + ADJUSTMENTS,
+                        criterionFn, found)
+    return found
+
+
+def layerPaths(channel, criterionFn):
+    """Returns (path, layer) of every layer in a channel matching criterionFn, substacks included"""
+    return _walkLayers(channel.layerList(), channel.name(), criterionFn, [])
+
+
+def resolveLayerPath(geo, path):
+    """Returns (channel, layer, mask) for a layer path. layer is None if the path
+    is just a channel name, mask is True if it ends at a layer's plain mask.
+    Raises ValueError if the path does not exist, ends at a mask or adjustment
+    stack instead of a layer in it, or names one of several layers of the same
+    name."""
+    parts = path.split(PATH_SEPARATOR)
+    channel = geo.findChannel(parts[0])
+    if channel is None:
+        raise ValueError('Channel not found: %s' % parts[0])
+    layer = None
+    layer_list = channel.layerList()
+    last = len(parts) - 2
+    for index, part in enumerate(parts[1:]):
+        if part == MASK and layer is not None:
+            if layer.hasMaskStack() and index < last:
+                layer_list = layer.maskStack().layerList()
+                continue
+            if layer.hasMask() and not layer.hasMaskStack() and index == last:
+                return channel, layer, True
+            raise ValueError('No plain mask: %s' % path)
+        if part == ADJUSTMENTS and layer is not None:
+            if layer.hasAdjustmentStack() and index < last:
+                layer_list = layer.adjustmentStack().layerList()
+                continue
+            raise ValueError('No adjustment layer: %s' % path)
+        matches = [candidate for candidate in layer_list if candidate.name() == part]
+        if not matches:
+            raise ValueError('Layer not found: %s' % path)
+        if len(matches) > 1:
+            raise ValueError('%d layers named %s: %s' % (len(matches), part, path))
+        layer = matches[0]
+        layer_list = layer.layerStack().layerList() if hasattr(layer, 'layerStack') else []
+    return channel, layer, False
+
+
+def isPaintable(layer):
+    return layer.isPaintableLayer()
+
+
+def selectedLayerPaths(geo, masks=False):
+    """Layer paths of the paintable layers selected anywhere in geo, a selected
+    group adds the paintable layers in it. With masks, the plain mask or the
+    paintable mask stack layers of every selected layer instead."""
+    paths = []
+    for channel in geo.channelList():
+        for path, layer in layerPaths(channel, lambda layer: layer.isSelected()):
+            if masks:
+                if layer.hasMaskStack():
+                    paths.extend(maskPath for maskPath, maskLayer in _walkLayers(
+                        layer.maskStack().layerList(), path + PATH_SEPARATOR + MASK, isPaintable, []))
+                elif layer.hasMask():
+                    paths.append(path + PATH_SEPARATOR + MASK)
+            elif layer.isPaintableLayer():
+                paths.append(path)
+            elif hasattr(layer, 'layerStack'):
+                paths.extend(childPath for childPath, child in _walkLayers(
+                    layer.layerStack().layerList(), path, isPaintable, [], substacks=False))
+    ## A group and a layer in it can both be selected
+    seen = set()
+    return [path for path in paths if not (path in seen or seen.add(path))]
+
+
+def layerKind(layer):
+    """One of paintable, procedural, adjustment, channel, group, shader or other"""
+    for kind, test in (('paintable', 'isPaintableLayer'), ('procedural', 'isProceduralLayer'),
+                       ('adjustment', 'isAdjustmentLayer'), ('channel', 'isChannelLayer'),
+                       ('group', 'isGroupLayer'), ('shader', 'isShaderLayer')):
+        if getattr(layer, test)():
+            return kind
+    return 'other'
+
+
+def stackSignature(channel):
+    """Hash of a channel's layer paths and kinds, changes when layers are
+    added, removed, renamed or regrouped"""
+    digest = hashlib.sha1()
+    for path, layer in layerPaths(channel, lambda layer: True):
+        digest.update(('%s:%s\n' % (path, layerKind(layer))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def layerFileName(path):
+    """A layer path as a single file name part, channel_group_layer or channel_layer_mask"""
+    return '_'.join(part.strip('[]').lower() if part in (MASK, ADJUSTMENTS) else part
+                    for part in path.split(PATH_SEPARATOR))
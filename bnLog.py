@@ -0,0 +1,133 @@
+##  bnLog
+############################################################
+## Buffered console output for bnMariTools.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.5+
+## -------------------
+## Messages logged inside an operation() are kept in a buffer
+## and written to the console in one go when the outermost
+## operation ends (or the buffer fills up). Per-item detail()
+## messages are only formatted and kept when the level is
+## DETAIL, otherwise they are just counted and the operation
+## ends with a one line summary of its tallies.
+## Flushing happens on the calling thread, Mari's console must
+## not be written to from worker threads.
+############################################################
+
+import os
+import sys
+import time
+
+DETAIL, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+level = int(os.environ.get('BN_LOG_LEVEL', INFO))
+maxBuffer = 500
+
+_buffer = []
+_operations = []
+
+
+# ------------------------------------------------------------------------------
+
+
+class _Operation(object):
+    def __init__(self, name):
+        self.name = name
+        self.tallies = []
+        self.counts = {}
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        _operations.append(self)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        _operations.remove(self)
+        if self.counts:
+            totals = ', '.join('%d %s' % (self.counts[key], key) for key in self.tallies)
+            _emit('%s: %s (%.2fs)' % (self.name, totals, time.time() - self.start))
+        if not _operations:
+            flush()
+        return False
+
+
+def operation(name):
+    """Context manager grouping the output of one operation:
+        with bnLog.operation('Image Resize'):
+            bnLog.detail('Resized %s', name)
+            bnLog.tally('patches resized')
+    """
+    return _Operation(name)
+
+
+def _emit(line):
+    _buffer.append(line)
+    if not _operations or len(_buffer) >= maxBuffer:
+        flush()
+
+
+def flush():
+    """Writes buffered lines to the console in one write"""
+    if _buffer:
+        text = '\n'.join(_buffer) + '\n'
+        del _buffer[:]
+        sys.stdout.write(text)
+
+
+def setLevel(newLevel):
+    global level
+    level = newLevel
+
+
+# ------------------------------------------------------------------------------
+
+
+def tally(key, amount=1):
+    """Adds to a summary counter of the current operation"""
+    if _operations:
+        current = _operations[-1]
+        if key not in current.counts:
+            current.tallies.append(key)
+            current.counts[key] = 0
+        current.counts[key] += amount
+
+
+def detail(message, *args):
+    """Per-item message, dropped unless the level is DETAIL"""
+    if level <= DETAIL:
+        _emit(message % args if args else message)
+
+
+def info(message, *args):
+    if level <= INFO:
+        _emit(message % args if args else message)
+
+
+def warning(message, *args):
+    if level <= WARNING:
+        _emit('Warning: ' + (message % args if args else message))
+
+
+def error(message, *args):
+    _emit('Error: ' + (message % args if args else message))
+
+
+# ------------------------------------------------------------------------------
+## Mari UI Init ##
+# ------------------------------------------------------------------------------
+
+try:
+    import mari
+except ImportError:
+    mari = None
+
+## Only register the menu from the imported module, Mari may also run this
+## file as a startup script and the tools import it by name.
+if mari is not None and __name__ == 'bnLog':
+    menu_path = 'MainWindow/Scripts/bnMariTools/Logging'
+    for label, script in (('Summary Output', 'import bnLog; bnLog.setLevel(bnLog.INFO)'),
+                          ('Detailed Output', 'import bnLog; bnLog.setLevel(bnLog.DETAIL)')):
+        mari.menus.addAction(mari.actions.create(label, script), menu_path)
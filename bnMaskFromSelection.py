@@ -12,6 +12,12 @@
 
 
 import mari
+import PySide.QtGui as QtGui
+import bnBatch
+import bnImageUtils
+import bnLayerUtils
+import bnTrace
+from bnImageUtils import numpy
 
 def _isProjectSuitable():
     """Checks project state."""
@@ -64,6 +70,7 @@ def getLayerList(layer_list, criterionFn):
     return matching
 # ------------------------------------------------------------------------------
 
+@bnTrace.traced()
 def findLayerSelection():
     """Searches for the current selection if mari.current.layer is not the same as layer.isSelected"""
     
@@ -81,6 +88,7 @@ def findLayerSelection():
    
         chn_layerList = curChannel.layerList()
         layers = getLayerList(chn_layerList,returnTrue)
+        bnTrace.count(items=len(layers))
         
         for layer in layers:
     
@@ -95,6 +103,7 @@ def findLayerSelection():
             
             chn_layerList = channel.layerList()
             layers = getLayerList(chn_layerList,returnTrue)
+            bnTrace.count(items=len(layers))
         
             for layer in layers:
     
@@ -113,66 +122,237 @@ def findLayerSelection():
 
 
 # ------------------------------------------------------------------------------
+# Mask generation engine
+# Coverage is worked out per tile: fully covered and empty tiles are written
+# with a single fill, only partially covered tiles have their pixels computed
+# in bulk with NumPy and uploaded through bnImageUtils.uploadPixels().
+# ------------------------------------------------------------------------------
+
+EMPTY, PARTIAL, FULL = range(3)
+
+SHARED_MASK_DEPTH = 8
+
+
+class MaskRegion(object):
+    """A set of whole UDIMs and UV-space rectangles to generate a mask from.
+    Rectangles are (u0, v0, u1, v1) in UV space and may span several tiles,
+    feather is the width in UV units of the soft edge inside each rectangle."""
+
+    def __init__(self, udims=(), rects=(), feather=0.0):
+        self.udims = set(int(udim) for udim in udims)
+        self.rects = []
+        self.feather = max(float(feather), 0.0)
+        for rect in rects:
+            self.addRect(*rect)
+
+    def addPatches(self, patches):
+        """Adds whole patches"""
+        self.udims.update(patch.udim() for patch in patches)
+
+    def addUdimRange(self, first, last):
+        """Adds every UDIM from first to last inclusive"""
+        self.udims.update(range(int(first), int(last) + 1))
+
+    def addRect(self, u0, v0, u1, v1):
+        """Adds a UV-space rectangle"""
+        self.rects.append((min(u0, u1), min(v0, v1), max(u0, u1), max(v0, v1)))
+
+    def isEmpty(self):
+        return not self.udims and not self.rects
+
+    def _rectCoverage(self, rect, tileU, tileV):
+        u0, v0, u1, v1 = rect
+        if u1 <= tileU or u0 >= tileU + 1 or v1 <= tileV or v0 >= tileV + 1:
+            return EMPTY
+        inset = self.feather
+        if u0 + inset <= tileU and u1 - inset >= tileU + 1 and v0 + inset <= tileV and v1 - inset >= tileV + 1:
+            return FULL
+        return PARTIAL
+
+    def tileCoverage(self, udim):
+        """Returns EMPTY, PARTIAL or FULL for a UDIM"""
+        if udim in self.udims:
+            return FULL
+        tileU, tileV = bnImageUtils.udimOffset(udim)
+        coverage = EMPTY
+        for rect in self.rects:
+            coverage = max(coverage, self._rectCoverage(rect, tileU, tileV))
+            if coverage == FULL:
+                break
+        return coverage
+
+    def _edgeRamp(self, coords, lo, hi):
+        """1D coverage of pixel centres between lo and hi, feathered inwards"""
+        if self.feather > 0.0:
+            distance = numpy.minimum(coords - lo, hi - coords)
+            return numpy.clip(distance / self.feather, 0.0, 1.0)
+        return ((coords >= lo) & (coords < hi)).astype(numpy.float32)
+
+    def tileMask(self, udim, width, height):
+        """Returns a (height, width) float32 coverage array for a UDIM"""
+        mask = numpy.zeros((height, width), dtype=numpy.float32)
+        if udim in self.udims:
+            mask[:] = 1.0
+            return mask
+        tileU, tileV = bnImageUtils.udimOffset(udim)
+        coordsU = tileU + (numpy.arange(width, dtype=numpy.float32) + 0.5) / width
+        coordsV = tileV + (numpy.arange(height, dtype=numpy.float32) + 0.5) / height
+        for rect in self.rects:
+            if self._rectCoverage(rect, tileU, tileV) == EMPTY:
+                continue
+            u0, v0, u1, v1 = rect
+            numpy.maximum(mask, numpy.outer(self._edgeRamp(coordsV, v0, v1),
+                                            self._edgeRamp(coordsU, u0, u1)), out=mask)
+        return mask
+
+
+def parseRegion(text, feather=0.0):
+    """Builds a MaskRegion from text such as '1001-1010, 1015, 0.2 0.1 1.5 0.9'.
+    Single numbers and ranges are UDIMs, groups of four numbers are UV rectangles."""
+    region = MaskRegion(feather=feather)
+    for token in text.replace(';', ',').split(','):
+        token = token.strip()
+        if not token:
+            continue
+        values = token.split()
+        if len(values) == 4:
+            region.addRect(*[float(value) for value in values])
+        elif '-' in token:
+            first, last = token.split('-')
+            region.addUdimRange(first, last)
+        else:
+            region.udims.add(int(token))
+    return region
+
+
+def writeMask(geo, imageSet, region, invert=False, batch=None):
+    """Writes the coverage of region into every patch image of imageSet.
+    Each tile is a step of batch if given.
+    Returns the number of tiles that needed per pixel work."""
+    white = mari.Color(1.0, 1.0, 1.0, 1.0)
+    black = mari.Color(0.0, 0.0, 0.0, 1.0)
+    onColor, offColor = (black, white) if invert else (white, black)
+    partialTiles = 0
+
+    for patch in geo.patchList():
+        image = geo.patchImage(patch, imageSet)
+        coverage = region.tileCoverage(patch.udim())
+        if coverage == FULL:
+            image.fill(onColor)
+        elif coverage == EMPTY:
+            image.fill(offColor)
+        else:
+            width, height = bnImageUtils.imageSize(image)
+            mask = region.tileMask(patch.udim(), width, height)
+            if invert:
+                mask = 1.0 - mask
+            pixels = numpy.empty((height, width, 4), dtype=numpy.float32)
+            pixels[..., :3] = mask[..., numpy.newaxis]
+            pixels[..., 3] = 1.0
+            bnImageUtils.uploadPixels(image, pixels)
+            partialTiles += 1
+        if batch is not None:
+            batch.step()
+        bnTrace.count(items=1)
+
+    return partialTiles
+
+
+# ------------------------------------------------------------------------------
+
+def createMaskImageSet(layer):
+    """Adds an empty paintable mask to layer and returns its image set"""
+    if layer.hasMaskStack():
+        newMask = layer.maskStack().createPaintableLayer('MaskFromSelection')
+        return newMask.imageSet()
+    if layer.isShaderLayer() or layer.hasMask():
+        newMask = layer.makeMaskStack().createPaintableLayer('MaskFromSelection')
+        return newMask.imageSet()
+    return layer.makeMask()
+
+
+def uniqueChannelName(geo, name):
+    """name, or name_2, name_3... if geo already has a channel called name"""
+    taken = set(channel.name() for channel in geo.channelList())
+    unique = name
+    number = 1
+    while unique in taken:
+        number += 1
+        unique = '%s_%d' % (name, number)
+    return unique
+
+
+def createSharedMaskChannel(geo, region, invert=False, batch=None, sourceChannel=None):
+    """Generates the mask once into a new channel sized like sourceChannel,
+    the channel of the selected layers (default the current channel)"""
+    sourceChannel = sourceChannel or geo.currentChannel()
+    maskChannel = geo.createChannel(uniqueChannelName(geo, 'MaskFromSelection'), sourceChannel.width(),
+                                    sourceChannel.height(), SHARED_MASK_DEPTH)
+    maskLayer = maskChannel.createPaintableLayer('MaskFromSelection')
+    writeMask(geo, maskLayer.imageSet(), region, invert, batch)
+    return maskChannel
+
+
+@bnTrace.traced()
+def regionMask(region, invert=False, shared=False, batchMode=None):
+    """Creates a mask from region on every selected layer.
+    With shared=True the mask is generated once into its own channel and
+    attached to each layer as a channel mask instead of one paintable mask per layer.
+    batchMode is a bnBatch mode ('full', 'chunked' or 'fast')"""
+    suitable = _isProjectSuitable()
+    if not suitable[0]:
+        return
+    _regionMask(region, invert, shared, batchMode)
+
+
+def _regionMask(region, invert, shared, batchMode):
+    """regionMask() without the project check"""
+    if region.rects and not bnImageUtils.hasPixelAccess():
+        mari.utils.message('UV region masks need NumPy and Mari pixel buffer access.')
+        return
+
+    geo_data = findLayerSelection()
+    currentObj = geo_data[0]
+    currentChannel = geo_data[2]
+    currentSelection = geo_data[3]
+
+    with bnBatch.BatchOperation('Create Mask from Selection', batchMode) as batch:
+        if shared:
+            maskChannel = createSharedMaskChannel(currentObj, region, invert, batch, currentChannel)
+            for layer in currentSelection:
+                bnLayerUtils.addChannelMasks(bnLayerUtils.channelMaskStack(layer), [maskChannel])
+                batch.step()
+        else:
+            for layer in currentSelection:
+                newMaskImageSet = createMaskImageSet(layer)
+                writeMask(currentObj, newMaskImageSet, region, invert, batch)
+
+
+def regionMaskUI(invert, shared=False):
+    """Asks for UDIMs/UV rectangles and creates a mask from them"""
+    text, ok = QtGui.QInputDialog.getText(None, 'Mask from Region',
+        'UDIMs, UDIM ranges or UV rectangles (u0 v0 u1 v1):\n e.g. 1001-1010, 1015, 0.2 0.1 1.5 0.9')
+    if not ok or not text.strip():
+        return
+    try:
+        region = parseRegion(text)
+    except ValueError:
+        mari.utils.message('Could not read region: %s' % text)
+        return
+    regionMask(region, invert, shared)
 
-def selectionMask(invert):
- 	suitable = _isProjectSuitable()
- 	if not suitable[0]:
- 	      return
-
-	mari.history.startMacro('Create Mask from Selection')
-
-	geo_data = findLayerSelection()
-	currentObj = geo_data[0]
-	currentLayer = geo_data[1]
-	currentSelection = geo_data[3]
-	selectedPatches = currentObj.selectedPatches()
-
-	
-	for layer in currentSelection:
-
-		currentLayer = layer
-
-		if currentLayer.isShaderLayer():
-
-			if currentLayer.hasMaskStack():
-				layerMaskStack = currentLayer.maskStack()
-				newMask = layerMaskStack.createPaintableLayer('MaskFromSelection')
-				newMaskImageSet = newMask.imageSet()
-			else:
-				layerMaskStack = currentLayer.makeMaskStack()
-				newMask = layerMaskStack.createPaintableLayer('MaskFromSelection')
-				newMaskImageSet = newMask.imageSet()
-
-		else:
-
-			if currentLayer.hasMaskStack():
-				layerMaskStack = currentLayer.maskStack()
-				newMask = layerMaskStack.createPaintableLayer('MaskFromSelection')
-				newMaskImageSet = newMask.imageSet()		
-
-			elif currentLayer.hasMask():
-				layerMaskStack = currentLayer.makeMaskStack()
-				newMask = layerMaskStack.createPaintableLayer('MaskFromSelection')
-				newMaskImageSet = newMask.imageSet()
-			else:
-				newMask = currentLayer.makeMask()
-				newMaskImageSet = newMask
-	
-	
-		for image in newMaskImageSet.imageList():
-			if invert == False:
-				image.fill(mari.Color(0.0, 0.0, 0.0, 1.0))
-			else:
-				image.fill(mari.Color(1.0, 1.0, 1.0, 1.0))
-		
-		for patch in selectedPatches:
-			selectedImage = currentObj.patchImage(patch, newMaskImageSet)
-			if invert == False:
-				selectedImage.fill(mari.Color(1.0, 1.0, 1.0, 1.0))
-			else:
-				selectedImage.fill(mari.Color(0.0, 0.0, 0.0, 1.0))
-
-	mari.history.stopMacro()
+
+# ------------------------------------------------------------------------------
+
+@bnTrace.traced()
+def selectionMask(invert, shared=False, batchMode=None):
+	suitable = _isProjectSuitable()
+	if not suitable[0]:
+		return
+
+	region = MaskRegion()
+	region.addPatches(mari.geo.current().selectedPatches())
+	_regionMask(region, invert, shared, batchMode)
 
 
 # ------------------------------------------------------------------------------
@@ -186,7 +366,19 @@ selectMaskITEM.setIconPath('%s/SelectAll.png' % icon_path)
 selectMaskInvertITEM = mari.actions.create('From Selection(Invert)', 'selectionMask(invert=True)')
 selectMaskInvertITEM.setIconPath('%s/SelectInvert.png' % icon_path)
 
+## Shared channel mask from selection ACTION
+selectMaskSharedITEM = mari.actions.create('From Selection(Shared Channel)', 'selectionMask(invert=False, shared=True)')
+selectMaskSharedITEM.setIconPath('%s/linked.png' % icon_path)
+
+## Layer mask from UDIMs/UV region ACTION
+regionMaskITEM = mari.actions.create('From UDIMs/UV Region', 'regionMaskUI(invert=False)')
+regionMaskITEM.setIconPath('%s/SelectAll.png' % icon_path)
+
 mari.menus.addAction(selectMaskITEM, 'MainWindow/&Layers/Layer Mask/Add Mask')
 mari.menus.addAction(selectMaskInvertITEM, 'MainWindow/&Layers/Layer Mask/Add Mask')
+mari.menus.addAction(selectMaskSharedITEM, 'MainWindow/&Layers/Layer Mask/Add Mask')
+mari.menus.addAction(regionMaskITEM, 'MainWindow/&Layers/Layer Mask/Add Mask')
 mari.menus.addAction(selectMaskITEM, 'MainWindow/Scripts/Layers/Layer Mask')
-mari.menus.addAction(selectMaskInvertITEM, 'MainWindow/Scripts/Layers/Layer Mask')
\ No newline at end of file
+mari.menus.addAction(selectMaskInvertITEM, 'MainWindow/Scripts/Layers/Layer Mask')
+mari.menus.addAction(selectMaskSharedITEM, 'MainWindow/Scripts/Layers/Layer Mask')
+mari.menus.addAction(regionMaskITEM, 'MainWindow/Scripts/Layers/Layer Mask')
\ No newline at end of file
@@ -0,0 +1,72 @@
+##  bnPatchUtils
+############################################################
+## Patch selection helpers for bnMariTools.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.5+
+## -------------------
+## Mari selects patches one setSelected() call at a time.
+## selectPatches() reads the current selection once and only
+## toggles the patches that differ from the wanted selection,
+## so the calls scale with the change, not the patch count.
+############################################################
+
+
+def patchMap(geo):
+    """udim: patch of geo. Patch indices follow patchList(), not the UDIM
+    number, as soon as UDIMs are skipped."""
+    return dict((patch.udim(), patch) for patch in geo.patchList())
+
+
+def _indexedPatch(geo, udim):
+    """The patch at index udim - 1001 if it is the one at udim, else None"""
+    if udim < 1001:
+        return None
+    try:
+        patch = geo.patch(udim - 1001)
+    except Exception:
+        return None
+    if patch is None or patch.udim() != udim:
+        return None
+    return patch
+
+
+def patchForUdim(geo, udim, patches=None):
+    """The patch of geo at udim. Index udim - 1001 is tried first, patches (a
+    patchMap, built if not given) only used when UDIMs are skipped."""
+    udim = int(udim)
+    patch = _indexedPatch(geo, udim)
+    if patch is not None:
+        return patch
+    if patches is None:
+        patches = patchMap(geo)
+    return patches[udim]
+
+
+def selectionDiff(selected, wanted, add=False):
+    """(to select, to deselect) UDIM sets turning the selected UDIMs into the
+    wanted ones, or adding them with add"""
+    selected = set(int(udim) for udim in selected)
+    wanted = set(int(udim) for udim in wanted)
+    deselect = set() if add else selected - wanted
+    return wanted - selected, deselect
+
+
+def selectPatches(geo, udims, add=False):
+    """Makes udims the patch selection of geo (adds them with add).
+    Returns the number of patches toggled."""
+    current = dict((patch.udim(), patch) for patch in geo.selectedPatches())
+    select, deselect = selectionDiff(current, udims, add)
+    for udim in sorted(deselect):
+        current[udim].setSelected(False)
+    ## Built once, the first time a UDIM is not at its index
+    patches = {}
+    for udim in sorted(select):
+        patch = _indexedPatch(geo, udim)
+        if patch is None:
+            if not patches:
+                patches.update(patchMap(geo))
+            patch = patches[udim]
+        patch.setSelected(True)
+    return len(select) + len(deselect)
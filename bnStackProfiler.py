@@ -0,0 +1,270 @@
+##  bnStackProfiler
+############################################################
+## Layer stack complexity of every object/channel in the
+## project: stack depth, layers by kind, masks and mask
+## stacks, channel layer references and estimated paint
+## memory, heaviest stacks first, plus the chains of channels
+## that channel layers make a flatten or export wait on.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+## -------------------
+## Profiles are cached per channel between sessions. A scan
+## only reads a stamp of each channel (size, patch count and
+## the names of its top level layers) and serves the cached
+## profile while the stamp matches; channels with a new stamp
+## are walked and profiled again. Changes that leave the top
+## level alone (a layer renamed inside a group, a new mask
+## stack layer) are only seen by a full rescan, the
+## "Profile Layer Stacks (Full Rescan)" menu item or
+## report(full=True).
+############################################################
+
+import os
+import json
+import hashlib
+
+import mari
+
+import bnExportScheduler
+import bnLayerUtils
+import bnLog
+import bnTrace
+
+## Defaults
+cachePath = os.path.join(os.path.expanduser('~'), '.bnMariTools', 'stackProfiles.json')
+reportCount = 20
+
+## project name: {'object/channel': profile}
+_cache = None
+
+
+# ------------------------------------------------------------------------------
+
+
+def _walk(layer_list, prefix, depth, digest, profile=None):
+    """Walks a stack the way bnLayerUtils._walkLayers does, adding every layer's
+    structure to digest. With a profile, also counts kinds, masks and channel
+    layer references. Returns the deepest nesting level below."""
+    deepest = depth
+    for layer in layer_list:
+        path = prefix + bnLayerUtils.PATH_SEPARATOR + layer.name()
+        isGroup = hasattr(layer, 'layerStack')
+        hasMaskStack = layer.hasMaskStack()
+        hasMask = not hasMaskStack and layer.hasMask()
+        hasAdjustments = hasattr(layer, 'hasAdjustmentStack') and layer.hasAdjustmentStack()
+        kind = bnLayerUtils.layerKind(layer)
+        reference = layer.channel().name() if kind == 'channel' else ''
+        digest.update(('%s|%s|%s|%d%d%d%d\n' % (path, kind, reference, isGroup, hasMaskStack, hasMask,
+                                                 hasAdjustments)).encode('utf-8'))
+        if profile is not None:
+            profile['kinds'][kind] = profile['kinds'].get(kind, 0) + 1
+            profile['layers'] += 1
+            profile['masks'] += hasMask
+            profile['maskStacks'] += hasMaskStack
+            profile['adjustmentStacks'] += hasAdjustments
+            if kind == 'channel':
+                profile['references'].append(reference)
+        if isGroup:
+            deepest = max(deepest, _walk(layer.layerStack().layerList(), path, depth + 1, digest, profile))
+        if hasMaskStack:
+            deepest = max(deepest, _walk(layer.maskStack().layerList(),
+                path + bnLayerUtils.PATH_SEPARATOR + bnLayerUtils.MASK, depth + 1, digest, profile))
+        if hasAdjustments:
+            deepest = max(deepest, _walk(layer.adjustmentStack().layerList(),
+                path + bnLayerUtils.PATH_SEPARATOR + bnLayerUtils.ADJUSTMENTS, depth + 1, digest, profile))
+    return deepest
+
+
+def stamp(channel, patches):
+    """Cheap key of a channel's stack: size, patch count and top level layer names"""
+    digest = hashlib.sha1()
+    digest.update(('%d %d %d %d\n' % (channel.width(), channel.height(), channel.depth(), patches)).encode('utf-8'))
+    for layer in channel.layerList():
+        digest.update((layer.name() + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fingerprint(channel):
+    """Hash of a channel's stack structure"""
+    digest = hashlib.sha1()
+    _walk(channel.layerList(), channel.name(), 1, digest)
+    return digest.hexdigest()
+
+
+def profileChannel(geo, channel, patches=None):
+    """Profile dict of one channel's layer stack"""
+    profile = {
+        'object': geo.name(), 'channel': channel.name(),
+        'width': channel.width(), 'height': channel.height(), 'depth': channel.depth(),
+        'patches': patches if patches is not None else len(geo.patchList()),
+        'layers': 0, 'kinds': {}, 'masks': 0, 'maskStacks': 0, 'adjustmentStacks': 0, 'references': [],
+    }
+    digest = hashlib.sha1()
+    profile['stackDepth'] = _walk(channel.layerList(), channel.name(), 1, digest, profile)
+    profile['fingerprint'] = digest.hexdigest()
+    ## Paintable layers hold a full tile per patch, plain masks one 8 bit channel
+    tile = bnExportScheduler.tileBytes(profile['width'], profile['height'], profile['depth'])
+    profile['memory'] = profile['patches'] * (profile['kinds'].get('paintable', 0) * tile +
+                                              profile['masks'] * profile['width'] * profile['height'])
+    return profile
+
+
+# ------------------------------------------------------------------------------
+
+
+def _projectKey():
+    project = mari.projects.current()
+    return project.name() if project is not None else ''
+
+
+def loadCache():
+    global _cache
+    if _cache is None:
+        try:
+            with open(cachePath) as handle:
+                _cache = json.load(handle)
+        except (IOError, OSError, ValueError):
+            _cache = {}
+    return _cache.setdefault(_projectKey(), {})
+
+
+def saveCache():
+    if _cache is None:
+        return
+    try:
+        directory = os.path.dirname(cachePath)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(cachePath, 'w') as handle:
+            json.dump(_cache, handle)
+    except (IOError, OSError) as exc:
+        bnLog.warning('Could not save stack profiles: %s', exc)
+
+
+def clearCache():
+    global _cache
+    _cache = {}
+    saveCache()
+
+
+# ------------------------------------------------------------------------------
+
+
+def _chains(profiles):
+    """Adds referencedBy, the longest channel layer chain and the flatten cost
+    including referenced channels to every profile"""
+    byKey = dict(('%s/%s' % (profile['object'], profile['channel']), profile) for profile in profiles)
+    for profile in profiles:
+        profile['referencedBy'] = 0
+    for profile in profiles:
+        for name in set(profile['references']):
+            referenced = byKey.get('%s/%s' % (profile['object'], name))
+            if referenced is not None:
+                referenced['referencedBy'] += 1
+
+    done = {}
+
+    def visit(key, visiting):
+        if key in done:
+            return done[key]
+        profile = byKey[key]
+        own = profile['patches'] * bnExportScheduler.tileBytes(
+            profile['width'], profile['height'], profile['depth']) * max(profile['layers'], 1) / 1e6
+        chain, cost = [profile['channel']], own
+        visiting.add(key)
+        for name in sorted(set(profile['references'])):
+            reference = '%s/%s' % (profile['object'], name)
+            if reference not in byKey or reference in visiting:
+                continue
+            referenceChain, referenceCost = visit(reference, visiting)
+            cost += referenceCost
+            if len(referenceChain) + 1 > len(chain):
+                chain = [profile['channel']] + referenceChain
+        visiting.discard(key)
+        done[key] = (chain, cost)
+        return done[key]
+
+    for key, profile in byKey.items():
+        profile['chain'], profile['cost'] = visit(key, set())
+
+
+@bnTrace.traced()
+def profileProject(geos=None, useCache=True, full=False):
+    """Profiles every channel of geos (default all objects), heaviest first.
+    Channels whose stamp matches the cache are not walked, unless full is set.
+    A profile's 'changed' is True if it was profiled again and differs from
+    the cached one."""
+    cache = loadCache() if useCache else {}
+    profiles = []
+    profiled = 0
+    for geo in geos or mari.geo.list():
+        patches = len(geo.patchList())
+        for channel in geo.channelList():
+            key = '%s/%s' % (geo.name(), channel.name())
+            cached = cache.get(key)
+            channelStamp = stamp(channel, patches)
+            if cached is not None and not full and cached.get('stamp') == channelStamp:
+                cached['changed'] = False
+                profiles.append(cached)
+                continue
+            profile = profileChannel(geo, channel, patches)
+            profile['stamp'] = channelStamp
+            profile['changed'] = cached is None or any(
+                cached.get(field) != profile[field] for field in ('fingerprint', 'patches', 'width', 'height', 'depth'))
+            cache[key] = profile
+            profiled += 1
+            profiles.append(profile)
+    bnTrace.count(items=len(profiles))
+    if useCache:
+        ## Deleted channels
+        if geos is None:
+            seen = set('%s/%s' % (profile['object'], profile['channel']) for profile in profiles)
+            for key in [key for key in cache if key not in seen]:
+                del cache[key]
+        if profiled:
+            saveCache()
+    _chains(profiles)
+    return sorted(profiles, key=lambda profile: profile['cost'], reverse=True)
+
+
+def _megabytes(size):
+    return '%.0fMB' % (size / 1048576.0)
+
+
+def report(count=None, full=False):
+    """Logs the heaviest stacks and the channel layer chains of the project,
+    full profiles every channel again"""
+    profiles = profileProject(full=full)
+    count = count or reportCount
+    with bnLog.operation('Stack Profile'):
+        bnLog.info('\n---------------Stack Profile------------------')
+        bnLog.info('%d channels (%d changed since the last scan), %d layers, %s of paint', len(profiles),
+                   sum(profile['changed'] for profile in profiles), sum(profile['layers'] for profile in profiles),
+                   _megabytes(sum(profile['memory'] for profile in profiles)))
+        for profile in profiles[:count]:
+            kinds = ', '.join('%d %s' % (number, kind) for kind, number in sorted(profile['kinds'].items()))
+            bnLog.info('%s:%s  depth %d, %s, %d masks, %d mask stacks, %d adjustment stacks, %s, '
+                       'referenced by %d, flatten cost %.0f',
+                       profile['object'], profile['channel'], profile['stackDepth'], kinds or 'no layers',
+                       profile['masks'], profile['maskStacks'], profile['adjustmentStacks'],
+                       _megabytes(profile['memory']), profile['referencedBy'], profile['cost'])
+        chains = [profile for profile in profiles if len(profile['chain']) > 1]
+        if chains:
+            bnLog.info('\nChannel layer chains:')
+        for profile in sorted(chains, key=lambda profile: len(profile['chain']), reverse=True)[:count]:
+            bnLog.info('%s: %s', profile['object'], ' -> '.join(profile['chain']))
+        bnLog.info('----------------------------------------------\n')
+    return profiles
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == 'bnStackProfiler':
+    menu_path = 'MainWindow/Scripts/bnMariTools/Stack Profile'
+    for label, script in (('Profile Layer Stacks', 'import bnStackProfiler; bnStackProfiler.report()'),
+                          ('Profile Layer Stacks (Full Rescan)', 'import bnStackProfiler; bnStackProfiler.report(full=True)'),
+                          ('Clear Profile Cache', 'import bnStackProfiler; bnStackProfiler.clearCache()')):
+        mari.menus.addAction(mari.actions.create(label, script), menu_path)
@@ -0,0 +1,125 @@
+##  bnTexelDensity
+############################################################
+## Texel density per patch, for bnImgResize's automatic
+## resolution. Each patch gets the smallest power of two size
+## that gives at least the target pixels per scene unit over
+## the world space area its UVs cover.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.6+
+## -------------------
+## Areas are measured on the object's current version mesh
+## file (OBJ), in that file's units, and cached per file until
+## it changes.
+############################################################
+
+import os
+import math
+
+## Defaults
+targetDensity = 40.96       # pixels per scene unit, 4k per metre in centimetres
+minResolution = 256
+maxResolution = 8192
+
+## path: ((mtime, size), {udim: (world area, uv area)})
+_areaCache = {}
+
+
+# ------------------------------------------------------------------------------
+
+
+def _triangleArea3(a, b, c):
+    ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    x, y, z = uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx
+    return 0.5 * math.sqrt(x * x + y * y + z * z)
+
+
+def _triangleArea2(a, b, c):
+    return 0.5 * abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1]))
+
+
+def udimOf(u, v):
+    """UDIM of a UV position"""
+    return 1001 + int(math.floor(u)) + 10 * int(math.floor(v))
+
+
+def objPatchAreas(path):
+    """{udim: (world area, uv area in tiles)} of an OBJ file. Polygons are fanned
+    into triangles and go to the UDIM of their UV centre; faces without UVs are
+    ignored."""
+    vertices = []
+    uvs = []
+    areas = {}
+    with open(path) as handle:
+        for line in handle:
+            if line.startswith('v '):
+                vertices.append(tuple(float(value) for value in line.split()[1:4]))
+            elif line.startswith('vt '):
+                uvs.append(tuple(float(value) for value in line.split()[1:3]))
+            elif line.startswith('f '):
+                corners = [corner.split('/') for corner in line.split()[1:]]
+                if len(corners) < 3 or any(len(corner) < 2 or not corner[1] for corner in corners):
+                    continue
+                points = [vertices[int(corner[0]) - 1 if int(corner[0]) > 0 else int(corner[0])]
+                          for corner in corners]
+                coords = [uvs[int(corner[1]) - 1 if int(corner[1]) > 0 else int(corner[1])]
+                          for corner in corners]
+                udim = udimOf(sum(uv[0] for uv in coords) / len(coords), sum(uv[1] for uv in coords) / len(coords))
+                world, uv = areas.get(udim, (0.0, 0.0))
+                for index in range(1, len(corners) - 1):
+                    world += _triangleArea3(points[0], points[index], points[index + 1])
+                    uv += _triangleArea2(coords[0], coords[index], coords[index + 1])
+                areas[udim] = (world, uv)
+    return areas
+
+
+def meshPath(geo):
+    """Mesh file of an object's current version, raises ValueError if it can not be measured"""
+    try:
+        path = geo.currentVersion().path()
+    except Exception:
+        path = None
+    if not path or not os.path.isfile(path):
+        raise ValueError('No mesh file found for %s' % geo.name())
+    if not path.lower().endswith('.obj'):
+        raise ValueError('Texel density needs an OBJ mesh, %s is loaded from %s' % (geo.name(), path))
+    return path
+
+
+def patchAreas(geo):
+    """{udim: (world area, uv area)} of an object, cached per mesh file"""
+    path = meshPath(geo)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    cached = _areaCache.get(path)
+    if cached is None or cached[0] != stamp:
+        cached = _areaCache[path] = (stamp, objPatchAreas(path))
+    return cached[1]
+
+
+def resolution(world, uv, density=None, smallest=None, largest=None):
+    """Power of two size giving density pixels per unit over a patch whose UVs
+    cover uv tiles of world area, clamped to the smallest and largest sizes"""
+    density = density or targetDensity
+    smallest = smallest or minResolution
+    largest = largest or maxResolution
+    if world <= 0.0 or uv <= 0.0:
+        return smallest
+    needed = density * math.sqrt(world / uv)
+    size = smallest
+    while size < needed and size < largest:
+        size *= 2
+    return size
+
+
+def resolutionPlan(geo, patches, density=None):
+    """{udim: size} for the given patches, patches without faces are left out"""
+    areas = patchAreas(geo)
+    plan = {}
+    for patch in patches:
+        udim = patch.udim()
+        if udim in areas:
+            plan[udim] = resolution(areas[udim][0], areas[udim][1], density)
+    return plan
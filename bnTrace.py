@@ -0,0 +1,320 @@
+##  bnTrace
+############################################################
+## Opt-in timing of bnMariTools operations.
+## -------------------
+## Install: Copy this file to your user Mari/Scripts folder.
+## (Create a Scripts directory if there is none)
+## Versions supported: 2.5+
+## -------------------
+## Off by default. Switch on with the Scripts/bnMariTools menu,
+## bnTrace.enable() in the Python console or BN_TRACE=1 in the
+## environment. While on, every traced operation records call
+## count, wall time, item count and Mari API call count into a
+## rolling buffer that dump() writes as a Chrome trace
+## (open in chrome://tracing or ui.perfetto.dev).
+## Mari API calls are counted by wrapping the mari.geo,
+## mari.projects... entry points (countedModules) while tracing
+## is on: every object they return is wrapped in turn, and each
+## method call on one counts into the innermost open span.
+## Objects fetched before tracing was switched on are not
+## counted.
+############################################################
+
+import os
+import json
+import time
+import tempfile
+import threading
+import functools
+import collections
+
+enabled = os.environ.get('BN_TRACE', '') not in ('', '0')
+bufferLength = 100000
+## mari attributes whose calls, and the calls on what they return, are counted
+countedModules = ('geo', 'projects', 'current', 'history', 'images', 'gl_render')
+
+## Rolling buffer of finished spans and totals per operation name
+events = collections.deque(maxlen=bufferLength)
+totals = {}
+
+_local = threading.local()
+_startTime = time.time()
+
+
+# ------------------------------------------------------------------------------
+
+
+class Span(object):
+    """One traced operation. items are added to with count(), apiCalls by
+    the counting wrappers."""
+    __slots__ = ('name', 'start', 'items', 'apiCalls', 'thread')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.items = 0
+        self.apiCalls = 0
+        self.thread = threading.current_thread().ident
+
+
+class _NullSpan(object):
+    """Returned while tracing is off, does nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+_nullSpan = _NullSpan()
+
+
+class _SpanContext(object):
+    def __init__(self, name):
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        self.span = Span(self.name)
+        _stack().append(self.span)
+        return self.span
+
+    def __exit__(self, excType, excValue, traceback):
+        _stack().pop()
+        _finish(self.span, time.time())
+        return False
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _finish(span, end):
+    duration = end - span.start
+    events.append((span.name, span.start, duration, span.items, span.apiCalls, span.thread))
+    total = totals.get(span.name)
+    if total is None:
+        total = totals[span.name] = {'calls': 0, 'seconds': 0.0, 'items': 0, 'apiCalls': 0}
+    total['calls'] += 1
+    total['seconds'] += duration
+    total['items'] += span.items
+    total['apiCalls'] += span.apiCalls
+
+
+# ------------------------------------------------------------------------------
+# Mari API call counting
+# ------------------------------------------------------------------------------
+
+## Results that are plain data, not Mari objects
+_plainTypes = (type(None), bool, int, long, float, basestring, dict, set, frozenset)
+## mari attribute: original object, while instrumented
+_originals = {}
+
+
+def _countCall():
+    if not enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].apiCalls += 1
+
+
+def _unwrap(value):
+    if isinstance(value, _Counted):
+        return value._target
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(item) for item in value)
+    return value
+
+
+def _wrap(value):
+    if isinstance(value, (_plainTypes, _Counted)) or hasattr(value, '__array__'):
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_wrap(item) for item in value)
+    return _Counted(value)
+
+
+class _Counted(object):
+    """Counting stand-in for a Mari object. Method calls are counted and
+    forwarded with their arguments unwrapped, their results wrapped."""
+    __slots__ = ('_target',)
+
+    def __init__(self, target):
+        object.__setattr__(self, '_target', target)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            _countCall()
+            return _wrap(value(*[_unwrap(arg) for arg in args],
+                               **dict((key, _unwrap(arg)) for key, arg in kwargs.items())))
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, _unwrap(value))
+
+    def __eq__(self, other):
+        return self._target == _unwrap(other)
+
+    def __ne__(self, other):
+        return self._target != _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __nonzero__(self):
+        return bool(self._target)
+
+    def __len__(self):
+        return len(self._target)
+
+    def __iter__(self):
+        return (_wrap(item) for item in self._target)
+
+    def __repr__(self):
+        return repr(self._target)
+
+
+def _instrument():
+    """Replaces the counted mari attributes with counting wrappers"""
+    if mari is None:
+        return
+    for name in countedModules:
+        if name in _originals or not hasattr(mari, name):
+            continue
+        _originals[name] = getattr(mari, name)
+        setattr(mari, name, _Counted(_originals[name]))
+
+
+def _restore():
+    if mari is None:
+        return
+    for name, original in _originals.items():
+        setattr(mari, name, original)
+    _originals.clear()
+
+
+# ------------------------------------------------------------------------------
+
+
+def enable():
+    global enabled
+    enabled = True
+    _instrument()
+
+
+def disable():
+    global enabled
+    enabled = False
+    _restore()
+
+
+def clear():
+    events.clear()
+    totals.clear()
+
+
+def span(name):
+    """Context manager tracing a block:
+        with bnTrace.span('exportMaps'):
+            ...
+    """
+    if not enabled:
+        return _nullSpan
+    return _SpanContext(name)
+
+
+def traced(name=None):
+    """Decorator tracing every call of a function"""
+    def decorate(function):
+        spanName = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _SpanContext(spanName):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(items=0):
+    """Adds to the item count of the innermost open span"""
+    if not enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].items += items
+
+
+# ------------------------------------------------------------------------------
+
+
+def stats():
+    """Totals per operation name, slowest first"""
+    return sorted(((name, dict(total)) for name, total in totals.items()),
+                  key=lambda item: item[1]['seconds'], reverse=True)
+
+
+def summary():
+    """Readable totals per operation"""
+    lines = ['%-30s %8s %12s %10s %10s' % ('Operation', 'Calls', 'Seconds', 'Items', 'API calls')]
+    for name, total in stats():
+        lines.append('%-30s %8d %12.4f %10d %10d' % (name, total['calls'], total['seconds'],
+                                                    total['items'], total['apiCalls']))
+    return '\n'.join(lines)
+
+
+def dump(path=None):
+    """Writes the buffer as a Chrome trace JSON file and returns its path"""
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), 'bnMariTools_trace_%d.json' % time.time())
+    pid = os.getpid()
+    traceEvents = []
+    for name, start, duration, items, apiCalls, thread in list(events):
+        traceEvents.append({
+            'name': name, 'ph': 'X', 'pid': pid, 'tid': thread,
+            'ts': int((start - _startTime) * 1e6), 'dur': int(duration * 1e6),
+            'args': {'items': items, 'apiCalls': apiCalls},
+        })
+    with open(path, 'w') as handle:
+        json.dump({'traceEvents': traceEvents, 'displayTimeUnit': 'ms', 'totals': totals}, handle)
+    return path
+
+
+def dumpAndReport():
+    """Dumps the trace and prints the totals, used by the menu action"""
+    path = dump()
+    print summary()
+    print 'Trace written to %s' % path
+    return path
+
+
+# ------------------------------------------------------------------------------
+## Mari UI Init ##
+# ------------------------------------------------------------------------------
+
+try:
+    import mari
+except ImportError:
+    mari = None
+
+## Only register the menu from the imported module, Mari may also run this
+## file as a startup script and the tools import it by name.
+if mari is not None and __name__ == 'bnTrace':
+    if enabled:
+        _instrument()
+    menu_path = 'MainWindow/Scripts/bnMariTools/Tracing'
+    for label, script in (('Enable Tracing', 'import bnTrace; bnTrace.enable()'),
+                          ('Disable Tracing', 'import bnTrace; bnTrace.disable()'),
+                          ('Dump Trace', 'import bnTrace; bnTrace.dumpAndReport()'),
+                          ('Clear Trace', 'import bnTrace; bnTrace.clear()')):
+        mari.menus.addAction(mari.actions.create(label, script), menu_path)
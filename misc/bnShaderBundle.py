@@ -0,0 +1,225 @@
+##  bnShaderBundle
+############################################################
+## Compiles NodeLibrary and FunctionLibrary into one bundle
+## file that registerCustomShaders memory maps at startup,
+## instead of walking and parsing the shared library folders
+## on every workstation.
+## -------------------
+## Build (outside Mari, with the Python version Mari ships with):
+##   python bnShaderBundle.py <folder with NodeLibrary> [bundle]
+## The bundle defaults to shaders.bnbundle in that folder,
+## which is where registerCustomShaders looks for it.
+## -------------------
+## Layout: 8 byte magic, 8 byte catalogue length, catalogue
+## JSON, then the packed file payloads. Each catalogue entry
+## holds the file's library relative path, payload offset and
+## length, (mtime, size) stamp, its references for dependency
+## order and, for nodes, type, name and menu location. Nodes
+## that could not be read are listed with their stamps, so the
+## catalogue covers every file in the folders.
+############################################################
+
+import os
+import re
+import sys
+import json
+import mmap
+import shutil
+import struct
+import xml.etree.ElementTree as ET
+
+MAGIC = 'BNSHDR01'
+_HEADER = struct.Struct('<8sQ')
+
+LIBRARY_FOLDER = 'FunctionLibrary'
+SHADER_FOLDER = 'NodeLibrary'
+LIBRARY_EXTENSIONS = ('.glslh', '.glslc')
+SHADER_EXTENSIONS = ('.xml',)
+
+INCLUDE_PATTERN = re.compile(r'#include\s*[<"]([^>"]+)[>"]')
+FUNCTION_PATTERN = re.compile(r'^[ \t]*(?!return\b|else\b)(?:\w+[ \t]+)+(\w+)[ \t]*\([^;{)]*\)\s*[;{]', re.M)
+CALL_PATTERN = re.compile(r'\b([A-Za-z_]\w*)\s*\(')
+
+## Written into an extracted cache folder once every file is in place
+_COMPLETE = '.complete'
+
+
+# ------------------------------------------------------------------------------
+
+
+def textReferences(text, library):
+    """Returns (provides, calls, includes) of a library or node file's text.
+    provides are the functions a library declares or defines, calls every
+    identifier followed by a bracket, includes the #include'd library names."""
+    provides = set()
+    if library:
+        provides = set(FUNCTION_PATTERN.findall(text))
+    calls = set(CALL_PATTERN.findall(text)) - provides
+    includes = set(os.path.basename(name).split('.')[0] for name in INCLUDE_PATTERN.findall(text))
+    return provides, calls, includes
+
+
+def nodeInfo(nodePath, shaderRoot):
+    """Returns (shaderType, shaderName, shaderLocation) of a node XML, the
+    category comes from its folder under shaderRoot"""
+    root = ET.parse(nodePath).getroot()
+    shaderName = root.find('DefaultName').text
+
+    shaderPath = os.path.dirname(nodePath).replace(shaderRoot, "")
+    shaderPath = shaderPath.replace("\\", "/")
+    parts = shaderPath.split("/")
+    shaderType = parts[1]
+
+    #Sub Category
+    if len(parts) > 2:
+        shaderLocation = '/%s/Custom/%s/%s' % (shaderType, parts[2], shaderName)
+    else:
+        shaderLocation = '/%s/Custom/%s' % (shaderType, shaderName)
+    return shaderType, shaderName, shaderLocation
+
+
+def _libraryFiles(root, extensions):
+    for path, subdirs, names in os.walk(root):
+        for name in sorted(names):
+            if name.endswith(extensions):
+                yield '%s/%s' % (path, name)
+
+
+# ------------------------------------------------------------------------------
+
+
+def buildBundle(base, bundlePath=None):
+    """Packs base/FunctionLibrary and base/NodeLibrary into one bundle file.
+    Returns (bundle path, entry count, unreadable node paths)."""
+    bundlePath = bundlePath or os.path.join(base, 'shaders.bnbundle')
+    shaderRoot = '%s/%s' % (base, SHADER_FOLDER)
+    sources = [(path, 'library') for path in _libraryFiles('%s/%s' % (base, LIBRARY_FOLDER), LIBRARY_EXTENSIONS)]
+    sources += [(path, 'shader') for path in _libraryFiles(shaderRoot, SHADER_EXTENSIONS)]
+
+    entries = []
+    payloads = []
+    unreadable = []
+    offset = 0
+    for path, kind in sources:
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        entry = {'kind': kind, 'path': os.path.relpath(path, base).replace('\\', '/'),
+                 'offset': offset, 'length': len(data)}
+        stat = os.stat(path)
+        entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+        provides, calls, includes = textReferences(data, kind == 'library')
+        entry['provides'], entry['calls'], entry['includes'] = sorted(provides), sorted(calls), sorted(includes)
+        if kind == 'shader':
+            try:
+                entry['info'] = nodeInfo(path, shaderRoot)
+            except Exception:
+                unreadable.append(entry)
+                continue
+        entries.append(entry)
+        payloads.append(data)
+        offset += len(data)
+
+    catalogue = json.dumps({'entries': entries, 'unreadable': [
+        {'path': entry['path'], 'mtime': entry['mtime'], 'size': entry['size']} for entry in unreadable]})
+    temporary = bundlePath + '.tmp'
+    with open(temporary, 'wb') as handle:
+        handle.write(_HEADER.pack(MAGIC, len(catalogue)))
+        handle.write(catalogue)
+        for data in payloads:
+            handle.write(data)
+    if os.path.exists(bundlePath):
+        os.remove(bundlePath)
+    os.rename(temporary, bundlePath)
+    return bundlePath, len(entries), [os.path.join(base, entry['path']) for entry in unreadable]
+
+
+class Bundle(object):
+    """Read only, memory mapped shader bundle"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = _HEADER.unpack(self._map[:_HEADER.size])
+            if magic != MAGIC:
+                raise ValueError('Not a shader bundle: %s' % path)
+            self._payloadStart = _HEADER.size + length
+            catalogue = json.loads(self._map[_HEADER.size:self._payloadStart])
+            self.entries = catalogue['entries']
+            self.unreadable = catalogue.get('unreadable', [])
+        except Exception:
+            self.close()
+            raise
+
+    def payload(self, entry):
+        start = self._payloadStart + entry['offset']
+        return self._map[start:start + entry['length']]
+
+    def extract(self, directory):
+        """Writes every payload under directory, once. Returns entry path: file path."""
+        files = dict((entry['path'], os.path.join(directory, entry['path'])) for entry in self.entries)
+        if os.path.exists(os.path.join(directory, _COMPLETE)):
+            return files
+        for entry in self.entries:
+            filePath = files[entry['path']]
+            folder = os.path.dirname(filePath)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(filePath, 'wb') as handle:
+                handle.write(self.payload(entry))
+        open(os.path.join(directory, _COMPLETE), 'w').close()
+        return files
+
+    def close(self):
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+def staleFiles(bundle, stamps):
+    """Entry paths that differ between a bundle and stamps, entry path:
+    (mtime, size) of the files in the folders now, sorted"""
+    built = dict((entry['path'], (entry['mtime'], entry['size'])) for entry in bundle.entries + bundle.unreadable)
+    return sorted(path for path in set(built) | set(stamps) if built.get(path) != stamps.get(path))
+
+
+def cachedBundle(bundlePath, cacheRoot):
+    """Copies a (shared) bundle to a local cache folder named after its size and
+    mtime, opens the local copy and extracts it there.
+    Mari registers shaders from file paths, so the payloads have to exist as
+    files; that happens once per bundle version. Returns (bundle, files)."""
+    stat = os.stat(bundlePath)
+    name = os.path.splitext(os.path.basename(bundlePath))[0]
+    directory = os.path.join(cacheRoot, '%s_%d_%d' % (name, int(stat.st_mtime), stat.st_size))
+    localPath = os.path.join(directory, os.path.basename(bundlePath))
+    if not os.path.isfile(localPath):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        shutil.copyfile(bundlePath, localPath + '.tmp')
+        os.rename(localPath + '.tmp', localPath)
+    bundle = Bundle(localPath)
+    try:
+        return bundle, bundle.extract(directory)
+    except Exception:
+        bundle.close()
+        raise
+
+
+# ------------------------------------------------------------------------------
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        sys.stderr.write('Usage: python bnShaderBundle.py <folder with NodeLibrary> [bundle]\n')
+        return 2
+    bundlePath, entries, unreadable = buildBundle(*argv[1:])
+    for path in unreadable:
+        sys.stderr.write('Skipped unreadable node: %s\n' % path)
+    sys.stdout.write('Wrote %d files to %s\n' % (entries, bundlePath))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,6 +1,37 @@
 import mari
 import os
-import xml.etree.ElementTree as ET
+import json
+import heapq
+
+import bnShaderBundle
+
+try:
+    import bnTrace
+    traced, count = bnTrace.traced, bnTrace.count
+except ImportError:
+    traced = lambda name=None: lambda function: function
+    count = lambda items=0: None
+
+try:
+    import bnLog
+except ImportError:
+    class bnLog(object):
+        '''Stand-in printing summaries when bnLog.py is not installed, per item
+        detail messages are dropped'''
+        class operation(object):
+            def __init__(self, name):
+                pass
+            def __enter__(self):
+                return self
+            def __exit__(self, excType, excValue, traceback):
+                return False
+
+        @staticmethod
+        def info(message, *args):
+            print message % args if args else message
+        warning = error = info
+        detail = staticmethod(lambda message, *args: None)
+        tally = staticmethod(lambda key, amount=1: None)
 
 mari_version = '%d.%d' % (mari.app.version().major(), mari.app.version().minor())
 
@@ -8,75 +39,371 @@ base_path = os.path.dirname(__file__)
 default_shader_path = '%s/NodeLibrary' % base_path
 default_lib_path = '%s/FunctionLibrary' % base_path
 
-def loadLibraries():
-    '''Loads custom shader libraries'''
+## Precompiled bundle, used instead of the folders when present (see bnShaderBundle.py)
+bundle_path = '%s/shaders.bnbundle' % base_path
+shaderCachePath = os.path.join(os.path.expanduser('~'), '.bnMariTools', 'shaderCache')
+
+LIBRARY_EXTENSIONS = bnShaderBundle.LIBRARY_EXTENSIONS
+SHADER_EXTENSIONS = bnShaderBundle.SHADER_EXTENSIONS
 
-    libDict = {}
-    for path, subdirs, files in os.walk(default_lib_path):
-        for name in files:
-            libDict[name]=path
+## Watch mode poll interval in milliseconds
+watchInterval = 2000
 
-    for lib in libDict:
-        full_lib_path = libDict[lib]
-        libPath = '%s/%s' % (full_lib_path, lib)
-        libName = lib.split(".")[0]
+## Last scan, path: (mtime, size) of every library and node file
+scanned = {}
+_watchTimer = None
 
+## Files that failed to register, path: [mtime, size]. Skipped until they change.
+failuresPath = os.path.join(os.path.expanduser('~'), '.bnMariTools', 'shaderFailures.json')
+failures = None
+## Files skipped this session because something they depend on failed
+skipped = set()
+
+_references = {}
+
+def scanFiles(root, extensions):
+    '''Returns path: (mtime, size) of the files under root with the given extensions'''
+    files = {}
+    for path, subdirs, names in os.walk(root):
+        for name in names:
+            if name.endswith(extensions):
+                filePath = '%s/%s' % (path, name)
+                try:
+                    stat = os.stat(filePath)
+                except OSError:
+                    continue
+                files[filePath] = (stat.st_mtime, stat.st_size)
+    return files
+
+def registerLibrary(libPath):
+    '''Registers one .glslh or .glslc file, returns True on success'''
+    libName = os.path.basename(libPath).split(".")[0]
+    count(items=1)
+    try:
+        if libPath.endswith('glslh'):
+            mari.gl_render.registerCustomHeaderFile(libName, libPath)
+        else:
+            mari.gl_render.registerCustomCodeFile(libName, libPath)
+        bnLog.detail('Registered Library: %s', libName)
+        bnLog.tally('libraries registered')
+        return True
+    except Exception as exc:
+        bnLog.error('Error Registering Library: %s : %s', libName, str(exc))
+        bnLog.tally('failed')
+        return False
+
+def registerShader(nodePath, info=None):
+    '''Registers one node XML, its category comes from the folder under NodeLibrary.
+    info is (type, name, location) from a bundle catalogue. Returns True on success'''
+    if info is None:
         try:
-            if lib.endswith('glslh'):
-                mari.gl_render.registerCustomHeaderFile(libName, libPath)
-                print 'Registered Library: %s' % libName
-            elif lib.endswith('glslc'):
-                mari.gl_render.registerCustomCodeFile(libName, libPath)
-                print 'Registered Library: %s' % libName
+            info = bnShaderBundle.nodeInfo(nodePath, default_shader_path)
         except Exception as exc:
-                print 'Error Registering Library: %s : %s' % (libName, str(exc))
-
-def loadShaders():
-    '''Loads custom shaders'''
-
-    #Find Shaders
-    shaderDict = {}
-    for path, subdirs, files in os.walk(default_shader_path):
-        for name in files:
-            shaderDict[name]=path
-
-    #Determine attributes
-    for shader in shaderDict:
-        full_shader_path = shaderDict[shader]
-        xml = ET.parse('%s/%s' % (full_shader_path,shader))
-        root = xml.getroot()
-
-        #Shader info
-        shaderPath= full_shader_path.replace(default_shader_path, "")
-        shaderPath = shaderPath.replace("\\", "/")
-        shaderType = shaderPath.split("/")[1]
-        shaderName = root.find('DefaultName').text
-        #Register info
-        nodeName = "/%s/Custom/%s" % (shaderType, shaderName)
-        nodePath = "%s/%s" % (full_shader_path, shader)
-
-        #Sub Category
+            bnLog.error('Error Reading Node : %s : %s', nodePath, str(exc))
+            bnLog.tally('failed')
+            return False
+    shaderType, shaderName, shaderLocation = info
+
+    count(items=1)
+    try:
+        if shaderType == 'Procedural' or shaderType == 'Geometry':
+            mari.gl_render.registerCustomProceduralLayerFromXMLFile(shaderLocation, nodePath)
+        elif shaderType == 'Adjustment':
+            mari.gl_render.registerCustomAdjustmentLayerFromXMLFile('/Custom/%s' % shaderName, nodePath)
+        bnLog.detail('Registered %s Node: %s', shaderType, shaderName)
+        bnLog.tally('nodes registered')
+        return True
+    except Exception as exc:
+        bnLog.error('Error Registering %s Node : %s : %s', shaderType, shaderName, str(exc))
+        bnLog.tally('failed')
+        return False
+
+# ------------------------------------------------------------------------------
+## Dependency order
+# ------------------------------------------------------------------------------
+
+def fileReferences(path):
+    '''Returns (provides, calls, includes) of a library or node file, see
+    bnShaderBundle.textReferences. Cached until the file changes.'''
+    stamp = scanned.get(path)
+    cached = _references.get(path)
+    if cached is not None and stamp is not None and cached[0] == stamp:
+        return cached[1]
+    try:
+        with open(path) as handle:
+            text = handle.read()
+    except (IOError, OSError):
+        text = ''
+    references = bnShaderBundle.textReferences(text, path.endswith(LIBRARY_EXTENSIONS))
+    _references[path] = (stamp, references)
+    return references
+
+def dependencies(paths):
+    '''Returns path: set of library paths it depends on, for the given paths.
+    Libraries are looked up among all scanned libraries, so a node can
+    depend on a library that is already registered.'''
+    libraries = set(path for path in scanned if path.endswith(LIBRARY_EXTENSIONS))
+    libraries.update(path for path in paths if path.endswith(LIBRARY_EXTENSIONS))
+    providers = {}
+    names = {}
+    for libPath in libraries:
+        for function in fileReferences(libPath)[0]:
+            providers.setdefault(function, set()).add(libPath)
+        names.setdefault(os.path.basename(libPath).split('.')[0], set()).add(libPath)
+
+    graph = {}
+    for path in paths:
+        provides, calls, includes = fileReferences(path)
+        depends = set()
+        for function in calls:
+            depends.update(providers.get(function, ()))
+        for name in includes:
+            depends.update(names.get(name, ()))
+        if path.endswith('.glslc'):
+            ## Code files need their own header first
+            depends.update(libPath for libPath in names.get(os.path.basename(path).split('.')[0], ())
+                           if libPath.endswith('.glslh'))
+        depends.discard(path)
+        graph[path] = depends
+    return graph
+
+def dependencyOrder(graph):
+    '''Returns the paths of graph with dependencies first. Dependencies outside
+    graph are taken as registered. Files in a cycle come last, in name order.'''
+    paths = set(graph)
+    waiting = dict((path, depends & paths) for path, depends in graph.items())
+    dependents = {}
+    for path, depends in waiting.items():
+        for depend in depends:
+            dependents.setdefault(depend, []).append(path)
+    ready = [path for path, depends in waiting.items() if not depends]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        path = heapq.heappop(ready)
+        order.append(path)
+        for dependent in dependents.get(path, ()):
+            waiting[dependent].discard(path)
+            if not waiting[dependent]:
+                heapq.heappush(ready, dependent)
+    if len(order) < len(graph):
+        cycle = sorted(set(graph) - set(order))
+        bnLog.warning('Dependency cycle between %d shader files: %s', len(cycle), ', '.join(cycle[:5]))
+        order.extend(cycle)
+    return order
+
+def _loadFailures():
+    global failures
+    if failures is None:
         try:
-            shaderSub = shaderPath.split("/")[2]
-            shaderLocation = '/%s/Custom/%s/%s' % (shaderType, shaderSub, shaderName)
-        except:
-            shaderLocation = '/%s/Custom/%s' % (shaderType, shaderName)
-            pass
+            with open(failuresPath) as handle:
+                failures = json.load(handle)
+        except (IOError, OSError, ValueError):
+            failures = {}
+    return failures
+
+def _saveFailures():
+    directory = os.path.dirname(failuresPath)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(failuresPath, 'w') as handle:
+            json.dump(failures, handle)
+    except (IOError, OSError) as exc:
+        bnLog.warning('Could not save shader failures: %s', exc)
+
+def knownFailure(path):
+    '''True if path failed to register before and has not changed since'''
+    stamp = scanned.get(path)
+    return stamp is not None and _loadFailures().get(path) == list(stamp)
+
+def registerInOrder(paths, register):
+    '''Registers paths in dependency order with register(path). Known failures
+    and files depending on a failed file are skipped. New failures are
+    remembered between sessions.'''
+    _loadFailures()
+    graph = dependencies(paths)
+    broken = set()
+    changed = False
+    for path in dependencyOrder(graph):
+        if knownFailure(path):
+            bnLog.detail('Skipped known failure: %s', path)
+            bnLog.tally('known failures skipped')
+            broken.add(path)
+            continue
+        failed = [depend for depend in graph[path] if depend in broken or depend in skipped or knownFailure(depend)]
+        if failed:
+            bnLog.detail('Skipped %s, depends on failed %s', path, failed[0])
+            bnLog.tally('skipped')
+            skipped.add(path)
+            broken.add(path)
+            continue
+        skipped.discard(path)
+        if register(path):
+            changed = failures.pop(path, None) is not None or changed
+        else:
+            broken.add(path)
+            if path in scanned:
+                failures[path] = list(scanned[path])
+                changed = True
+    if changed:
+        _saveFailures()
 
+@traced()
+def loadLibraries(paths=None):
+    '''Loads custom shader libraries in dependency order, all of them unless paths is given'''
+    if paths is None:
+        files = scanFiles(default_lib_path, LIBRARY_EXTENSIONS)
+        scanned.update(files)
+        paths = files.keys()
+
+    with bnLog.operation('Shader Libraries'):
+        registerInOrder(paths, registerLibrary)
+
+@traced()
+def loadShaders(paths=None):
+    '''Loads custom shaders, all of them unless paths is given. Nodes using a
+    library that failed to register are skipped.'''
+    if paths is None:
+        files = scanFiles(default_shader_path, SHADER_EXTENSIONS)
+        scanned.update(files)
+        paths = files.keys()
+
+    with bnLog.operation('Shaders'):
+        registerInOrder(paths, registerShader)
+
+def retryFailures():
+    '''Forgets known failures and registers failed and skipped files again'''
+    paths = [path for path in set(_loadFailures()) | skipped if path in scanned]
+    failures.clear()
+    skipped.clear()
+    _saveFailures()
+    loadLibraries([path for path in paths if path.endswith(LIBRARY_EXTENSIONS)])
+    loadShaders([path for path in paths if path.endswith(SHADER_EXTENSIONS)])
+
+def folderFiles():
+    '''Returns bundle entry path: (folder path, (mtime, size)) of every library
+    and node file, from a stat only walk of the folders'''
+    files = {}
+    for root, folder, extensions in ((default_lib_path, bnShaderBundle.LIBRARY_FOLDER, LIBRARY_EXTENSIONS),
+                                     (default_shader_path, bnShaderBundle.SHADER_FOLDER, SHADER_EXTENSIONS)):
+        for path, stamp in scanFiles(root, extensions).items():
+            entryPath = '%s/%s' % (folder, os.path.relpath(path, root).replace('\\', '/'))
+            files[entryPath] = (path, stamp)
+    return files
+
+@traced()
+def loadBundle(path=None):
+    '''Registers everything in a shader bundle built by bnShaderBundle.py.
+    Its catalogue replaces reading references and parsing node XMLs; the folders
+    are only walked to check the bundle against them. Raises ValueError if a
+    file was added, removed or changed since the bundle was built.'''
+    bundle, files = bnShaderBundle.cachedBundle(path or bundle_path, shaderCachePath)
+    try:
+        current = folderFiles()
+        stale = bnShaderBundle.staleFiles(bundle, dict((entryPath, stamp) for entryPath, (folderPath, stamp) in current.items()))
+        if stale:
+            raise ValueError('%d files changed since the bundle was built, e.g. %s' % (len(stale), stale[0]))
+        ## Registered from the local copies, known by their folder paths like scanned files
+        localPaths = {}
+        libraries = []
+        infos = {}
+        for entry in bundle.entries:
+            folderPath, stamp = current[entry['path']]
+            localPaths[folderPath] = files[entry['path']]
+            scanned[folderPath] = stamp
+            _references[folderPath] = (stamp, (set(entry['provides']), set(entry['calls']), set(entry['includes'])))
+            if entry['kind'] == 'library':
+                libraries.append(folderPath)
+            else:
+                infos[folderPath] = tuple(entry['info'])
+        for folderPath, stamp in current.values():
+            scanned.setdefault(folderPath, stamp)
+    finally:
+        bundle.close()
+
+    with bnLog.operation('Shader Libraries'):
+        registerInOrder(libraries, lambda libPath: registerLibrary(localPaths[libPath]))
+    with bnLog.operation('Shaders'):
+        registerInOrder(infos.keys(), lambda nodePath: registerShader(localPaths[nodePath], infos[nodePath]))
+
+# ------------------------------------------------------------------------------
+## Hot reload
+# ------------------------------------------------------------------------------
+
+def changedFiles():
+    '''Returns (libraries, shaders, removed) paths that changed since the last scan,
+    then makes the current state the last scan'''
+    libraries = scanFiles(default_lib_path, LIBRARY_EXTENSIONS)
+    shaders = scanFiles(default_shader_path, SHADER_EXTENSIONS)
+    removed = [path for path in scanned if path not in libraries and path not in shaders
+               and path.startswith((default_lib_path, default_shader_path))]
+    changedLibraries = [path for path, stamp in libraries.items() if scanned.get(path) != stamp]
+    changedShaders = [path for path, stamp in shaders.items() if scanned.get(path) != stamp]
+    scanned.clear()
+    scanned.update(libraries)
+    scanned.update(shaders)
+    return changedLibraries, changedShaders, removed
+
+@traced()
+def reloadChanged():
+    '''Re-registers added or modified libraries and nodes, libraries first.
+    Returns the number of files registered'''
+    libraries, shaders, removed = changedFiles()
+    if libraries:
+        loadLibraries(libraries)
+    if shaders:
+        loadShaders(shaders)
+    for path in removed:
+        ## Mari can not unregister, the node stays until restart
+        bnLog.info('Removed, still registered until restart: %s', path)
+    return len(libraries) + len(shaders)
+
+def startWatching(interval=None):
+    '''Polls the libraries every watchInterval ms and reloads what changed.
+    Uses a Qt timer as Mari's Python has no file system notifications'''
+    global _watchTimer
+    import PythonQt.QtCore as QtCore
+    if _watchTimer is None:
+        if not scanned:
+            changedFiles()
+        _watchTimer = QtCore.QTimer()
+        _watchTimer.connect('timeout()', reloadChanged)
+    _watchTimer.start(interval or watchInterval)
+    bnLog.info('Watching %s and %s for shader changes', default_lib_path, default_shader_path)
+
+def stopWatching():
+    '''Stops the watch timer'''
+    if _watchTimer is not None:
+        _watchTimer.stop()
+        bnLog.info('Stopped watching for shader changes')
+
+def loadAll():
+    '''Registers the bundle if there is one and it matches the folders, else
+    scans the library folders'''
+    if os.path.isfile(bundle_path):
+        bnLog.info('\nLoading Shader Bundle %s.....', bundle_path)
+        bnLog.info('-----------------------------------------')
         try:
-            if shaderType == 'Procedural' or shaderType == 'Geometry':
-                mari.gl_render.registerCustomProceduralLayerFromXMLFile(shaderLocation, nodePath)
-            elif shaderType == 'Adjustment':
-                mari.gl_render.registerCustomAdjustmentLayerFromXMLFile('/Custom/%s' % shaderName, nodePath)
-            print 'Registered %s Node: %s' % (shaderType, shaderName)
-        except Exception as exc:
-            print 'Error Registering %s Node : %s : %s' % (shaderType, shaderName, str(exc))
+            loadBundle()
+            return
+        except (IOError, OSError, ValueError) as exc:
+            bnLog.warning('Could not load shader bundle, scanning folders: %s', exc)
+    bnLog.info('\nInitializing Shader Libraries.....')
+    bnLog.info('-----------------------------------------')
+    loadLibraries()
+    bnLog.info('\nLoading Shaders.....')
+    bnLog.info('-----------------------------------------')
+    loadShaders()
 
 if mari_version == '2.5':
     ##Load All
-    print '\nInitializing Shader Libraries.....'
-    print '-----------------------------------------'
-    loadLibraries()
-    print '\nLoading Shaders.....'
-    print '-----------------------------------------'
-    loadShaders()
+    loadAll()
+
+## UI
+menu_path = 'MainWindow/Scripts/bnMariTools/Shaders'
+for label, script in (('Reload Changed Shaders', 'reloadChanged()'),
+                      ('Start Watching Shaders', 'startWatching()'),
+                      ('Stop Watching Shaders', 'stopWatching()'),
+                      ('Retry Failed Shaders', 'retryFailures()')):
+    mari.menus.addAction(mari.actions.create(label, script), menu_path)